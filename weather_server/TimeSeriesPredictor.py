@@ -1,8 +1,8 @@
 import numpy as np
-from statsmodels.tsa.statespace.sarimax import SARIMAX
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-from sklearn.model_selection import ParameterGrid
+
+import metrics
 
 class TimeSeriesPredictor:
     """
@@ -13,9 +13,6 @@ class TimeSeriesPredictor:
     @param seasonal_order: The (P,D,Q,s) order of the seasonal component of the model for the AR parameters,
         differences, MA parameters, and periodicity.
     """
-    logging.basicConfig(level=logging.INFO,
-                        format='%(threadName)s: %(message)s')
-    
     def __init__(self, order=(1, 1, 1), seasonal_order=(0, 0, 0, 0)):
         self.order = order
         self.seasonal_order = seasonal_order
@@ -28,9 +25,12 @@ class TimeSeriesPredictor:
 
         @param y: The time series data.
         """
+        from statsmodels.tsa.statespace.sarimax import SARIMAX
+
         self.y = y
         self.model = SARIMAX(self.y, order=self.order, seasonal_order=self.seasonal_order)
-        self.model_fit = self.model.fit()
+        with metrics.timer('fit_seconds', model='sarimax'):
+            self.model_fit = self.model.fit()
 
     def predict(self, steps):
         """
@@ -40,7 +40,8 @@ class TimeSeriesPredictor:
 
         @return: The predicted values of the time series data.
         """
-        return self.model_fit.predict(start=len(self.y), end=len(self.y)+steps-1)
+        with metrics.timer('rollout_seconds', model='sarimax'):
+            return self.model_fit.predict(start=len(self.y), end=len(self.y)+steps-1)
 
     def _fit_and_predict(self, y, steps):
         """
@@ -59,7 +60,8 @@ class TimeSeriesPredictor:
         """
         Train the SARIMAX model on multiple time series data and predict the future values.
 
-        @param df: The DataFrame containing the time series data.
+        @param df: The DataFrame containing the time series data, or any mapping of column names to arrays
+            such as HistoryStore.read.
         @param target_columns: The columns in the DataFrame to predict.
         @param steps: The number of future steps to predict.
 
@@ -67,7 +69,7 @@ class TimeSeriesPredictor:
         """
         predictions = {}
         with ThreadPoolExecutor() as executor:
-            future_to_column = {executor.submit(self._fit_and_predict, df[column].values.astype(float), steps): column for column in target_columns}
+            future_to_column = {executor.submit(self._fit_and_predict, np.asarray(df[column], dtype=float), steps): column for column in target_columns}
             for future in as_completed(future_to_column):
                 column = future_to_column[future]
                 try:
@@ -86,6 +88,8 @@ class TimeSeriesPredictor:
 
         @return: The best parameters for the SARIMAX model.
         """
+        from sklearn.model_selection import ParameterGrid
+
         grid = ParameterGrid(param_grid)
         best_score = float('inf')
         best_params = None
@@ -0,0 +1,153 @@
+import argparse
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from database.db_constants import DB_CONFIG
+
+"""
+  Backtest of the stored forecasts against the measurements that arrived later.
+
+  One set-based query joins PredictedSeaConditions with SeaConditions hour by hour and computes the mean absolute
+  error of every location and column for the recent window and for the window before it. The result is kept in
+  the ForecastAccuracy table, which doubles as the accuracy dashboard, and decides which locations are retrained:
+  only series whose recent error is above its threshold or clearly worse than before. All other locations keep
+  their stored models and only roll their forecasts forward.
+"""
+
+# Days of the recent window and of the previous window it is compared with
+RECENT_DAYS = 7
+PREVIOUS_DAYS = 21
+# Recent error this much above the previous error counts as drift
+TREND_TOLERANCE = 0.25
+
+# Column, kind of error and the mean absolute error above which a series is retrained
+BACKTEST_COLUMNS = [
+    ('waveheight', 'linear', 0.5),
+    ('windwaveheight', 'linear', 0.5),
+    ('swellwaveheight', 'linear', 0.5),
+    ('waveperiod', 'linear', 2.0),
+    ('windwaveperiod', 'linear', 2.0),
+    ('swellwaveperiod', 'linear', 2.0),
+    ('windspeed', 'linear', 10.0),
+    ('wavedirection', 'circular', 45.0),
+    ('windwavedirection', 'circular', 45.0),
+    ('swellwavedirection', 'circular', 45.0),
+]
+
+
+def create_accuracy_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ForecastAccuracy (
+            LocationID INT REFERENCES Locations(LocationID),
+            ColumnName VARCHAR(50),
+            WindowEnd DATE,
+            RecentMAE DECIMAL,
+            PreviousMAE DECIMAL,
+            Samples INT,
+            NeedsRetraining BOOLEAN,
+            ComputedAt TIMESTAMP,
+            CONSTRAINT forecastaccuracy_location_column_window UNIQUE (LocationID, ColumnName, WindowEnd)
+        )
+    """)
+
+
+def backtest_sql():
+    """
+    Builds the query returning (location, column, recent MAE, previous MAE, samples) for every series.
+    """
+    values = []
+    for column, kind, _ in BACKTEST_COLUMNS:
+        if kind == 'circular':
+            error = f"LEAST(ABS(p.{column} - s.{column}), 360 - ABS(p.{column} - s.{column}))"
+        else:
+            error = f"ABS(p.{column} - s.{column})"
+        values.append(f"('{column}', ({error})::float)")
+    return f"""
+        SELECT p.LocationID, e.column_name,
+               AVG(e.error) FILTER (WHERE p.Date >= CURRENT_DATE - %(recent)s),
+               AVG(e.error) FILTER (WHERE p.Date < CURRENT_DATE - %(recent)s),
+               COUNT(e.error) FILTER (WHERE p.Date >= CURRENT_DATE - %(recent)s)
+        FROM PredictedSeaConditions p
+        JOIN SeaConditions s
+          ON s.LocationID = p.LocationID
+         AND s.Date = p.Date
+         AND to_timestamp(s.TimeOfDay, 'YYYY-MM-DD HH24:MI')::time = p.TimeOfDay::time
+        CROSS JOIN LATERAL (VALUES {', '.join(values)}) AS e(column_name, error)
+        WHERE p.Date >= CURRENT_DATE - %(total)s AND p.Date < CURRENT_DATE
+          AND (%(location_ids)s::int[] IS NULL OR p.LocationID = ANY(%(location_ids)s::int[]))
+        GROUP BY p.LocationID, e.column_name
+    """
+
+
+def needs_retraining(column, recent, previous):
+    """
+    A series drifted when its recent error is above the threshold of its column or clearly worse than before.
+    A series without recent data is retrained like a location without any backtest data, its error is unknown.
+    """
+    threshold = next(limit for name, _, limit in BACKTEST_COLUMNS if name == column)
+    if recent is None:
+        return True
+    return recent > threshold or (previous is not None and recent > previous * (1 + TREND_TOLERANCE))
+
+
+def run_backtest(conn, location_ids=None):
+    """
+    Computes the rolling error of every series, stores it in ForecastAccuracy and returns the locations to retrain.
+    Locations without any backtest data are retrained as well, nothing is known about their models.
+
+    @param conn: An open psycopg2 connection.
+    @param location_ids: Optional list of locations to backtest, all locations by default.
+
+    @return: Set of location ids whose models have to be retrained.
+    """
+    with conn.cursor() as cur:
+        create_accuracy_table(cur)
+        cur.execute(backtest_sql(), {
+            'recent': RECENT_DAYS,
+            'total': RECENT_DAYS + PREVIOUS_DAYS,
+            'location_ids': list(location_ids) if location_ids is not None else None,
+        })
+        rows = cur.fetchall()
+
+        retrain = set()
+        accuracy = []
+        for location_id, column, recent, previous, samples in rows:
+            drifted = needs_retraining(column, recent, previous)
+            if drifted:
+                retrain.add(location_id)
+            accuracy.append((location_id, column, recent, previous, samples, drifted))
+
+        execute_values(cur, """
+            INSERT INTO ForecastAccuracy (LocationID, ColumnName, WindowEnd, RecentMAE, PreviousMAE, Samples, NeedsRetraining, ComputedAt)
+            VALUES %s
+            ON CONFLICT ON CONSTRAINT forecastaccuracy_location_column_window DO UPDATE
+            SET RecentMAE = EXCLUDED.RecentMAE,
+                PreviousMAE = EXCLUDED.PreviousMAE,
+                Samples = EXCLUDED.Samples,
+                NeedsRetraining = EXCLUDED.NeedsRetraining,
+                ComputedAt = EXCLUDED.ComputedAt
+        """, accuracy, template="(%s, %s, CURRENT_DATE, %s, %s, %s, %s, NOW())", page_size=1000)
+    conn.commit()
+
+    tested = {row[0] for row in rows}
+    if location_ids is not None:
+        retrain |= set(location_ids) - tested
+    print(f"Backtest: {len(tested)} locations with data, {len(retrain)} to retrain")
+    return retrain
+
+
+if __name__ == "__main__":
+    """
+      Refreshes the ForecastAccuracy table and prints the locations that would be retrained.
+    """
+    parser = argparse.ArgumentParser(description="Backtest stored forecasts against measurements")
+    parser.add_argument("--locations", help="comma separated location ids, all by default")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        location_ids = [int(value) for value in args.locations.split(",")] if args.locations else None
+        print("Locations to retrain:", sorted(run_backtest(conn, location_ids)))
+    finally:
+        conn.close()
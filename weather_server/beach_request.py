@@ -1,28 +1,35 @@
 import psycopg2
-import requests
-from psycopg2 import sql
+from psycopg2.extras import execute_values
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from math import asin, cos, radians, sin, sqrt
 
 from database.db_constants import API_BEACH, DB_CONFIG
+from upstream_client import get_session
 
 """
   This script will be run only once for creating and putting beach name and lat and long to the database which
   be stored for all users.
 """
 
-conn = psycopg2.connect(**DB_CONFIG)
-cur = conn.cursor()
+# Beaches with the same name closer than this are treated as one beach (e.g. a node inside a way)
+DUPLICATE_DISTANCE_KM = 1.0
+# Number of parallel geocoding requests for beaches without geometry
+GEOCODE_WORKERS = 8
 
+@lru_cache(maxsize=None)
 def get_lat_long(address):
     """
     This function uses the Positionstack API to get the latitude and longitude of a given address.
+    Results are cached, so a name shared by several beaches is only geocoded once.
     """
     base_url = "http://api.positionstack.com/v1/forward"
     params = {
         "access_key": API_BEACH,
         "query": address
     }
-    response = requests.get(base_url, params=params)
+    response = get_session('positionstack').get(base_url, params=params)
     if response.status_code == 200:
         data = response.json()
         if data['data']:
@@ -32,11 +39,13 @@ def get_lat_long(address):
 
 def get_beaches_in_ireland():
     """
-      This function fetches the names of all the beaches in Ireland using the Overpass API.
+      This function fetches all the named beaches in Ireland using the Overpass API.
       The Overpass API is a read-only API that serves up custom selected parts of the OSM map data.
+      With `out center;` nodes come with their coordinates and ways and relations with the center of their geometry.
 
       Returns:
-          list: A list of beach names if the API request is successful. Returns an empty list otherwise.
+          list: A list of dictionaries with osm_id, name, latitude and longitude (None when the element has no
+          geometry) if the API request is successful. Returns an empty list otherwise.
     """
     overpass_url = "http://overpass-api.de/api/interpreter"
     overpass_query = """
@@ -47,44 +56,138 @@ def get_beaches_in_ireland():
         way["natural"="beach"](area.ireland);
         relation["natural"="beach"](area.ireland);
       );
-      out;
+      out center;
     """
 
-    response = requests.get(overpass_url, params={'data': overpass_query})
+    response = get_session('overpass').get(overpass_url, params={'data': overpass_query})
 
     if response.status_code == 200:
         data = response.json()
-        beaches_with_names = [element['tags']['name'] for element in data['elements'] if 'tags' in element and 'name' in element['tags']]
-        return beaches_with_names
+        beaches = []
+        for element in data['elements']:
+            if 'tags' not in element or 'name' not in element['tags']:
+                continue
+            geometry = element.get('center', element)
+            beaches.append({
+                'osm_id': f"{element['type']}/{element['id']}",
+                'name': element['tags']['name'],
+                'latitude': geometry.get('lat'),
+                'longitude': geometry.get('lon'),
+            })
+        return beaches
     else:
         print("Error fetching data:", response.text)
         return []
 
-if __name__ == "__main__":
-    cur = conn.cursor()
+def distance_km(a, b):
+    """
+    Great circle distance in kilometres between two beaches.
+    """
+    lat1, lon1, lat2, lon2 = map(radians, (a['latitude'], a['longitude'], b['latitude'], b['longitude']))
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0088 * asin(sqrt(h))
+
+def deduplicate_beaches(beaches):
+    """
+    Removes repeated OSM elements and beaches mapped twice under the same name, e.g. as a node and as a way.
+    Beaches sharing a name but further apart than DUPLICATE_DISTANCE_KM are kept, names like "White Strand"
+    are common around the coast.
+    """
+    unique = {}
+    for beach in beaches:
+        unique.setdefault(beach['osm_id'], beach)
+
+    kept_by_name = {}
+    result = []
+    # Ways and relations first, their center is a better position than a loose node
+    for beach in sorted(unique.values(), key=lambda b: b['osm_id'].startswith('node/')):
+        same_name = kept_by_name.setdefault(beach['name'], [])
+        if beach['latitude'] is not None and any(
+            other['latitude'] is not None and distance_km(beach, other) < DUPLICATE_DISTANCE_KM for other in same_name
+        ):
+            continue
+        if beach['latitude'] is None and same_name:
+            continue
+        same_name.append(beach)
+        result.append(beach)
+    return result
+
+def geocode_missing(beaches):
     """
-      This is the main entry point of the program. It calls the function get_beaches_in_ireland() to
-      fetch the names of all the beaches in Ireland.
-      It then prints the number of beaches found and their names.
+    Geocodes the beaches which came without geometry, concurrently. Beaches that can not be geocoded are dropped.
+    """
+    missing = [beach for beach in beaches if beach['latitude'] is None or beach['longitude'] is None]
+    with ThreadPoolExecutor(GEOCODE_WORKERS) as executor:
+        for beach, (lat, lng) in zip(missing, executor.map(get_lat_long, [beach['name'] for beach in missing])):
+            beach['latitude'], beach['longitude'] = lat, lng
+    return [beach for beach in beaches if beach['latitude'] is not None and beach['longitude'] is not None]
+
+def ensure_osm_id(cur):
+    """
+    Adds the OsmID column used as the key of the sync and the UpdatedAt column marking changed rows to databases
+    created before they existed.
+    """
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS OsmID VARCHAR(32)")
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS UpdatedAt TIMESTAMP")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS locations_osmid_key ON Locations (OsmID)")
+
+def upsert_beaches(cur, beaches):
+    """
+    Synchronises the beaches into the Locations table in bulk. Rows seeded before OsmID existed are matched
+    by their unique name first, so they keep their LocationID. Unchanged rows are not touched.
+
+    @return: The number of inserted or updated rows.
+    """
+    rows = [(beach['osm_id'], beach['name'], json.dumps({'latitude': beach['latitude'], 'longitude': beach['longitude']}))
+            for beach in beaches]
+
+    name_counts = {}
+    for beach in beaches:
+        name_counts[beach['name']] = name_counts.get(beach['name'], 0) + 1
+    execute_values(cur, """
+        UPDATE Locations SET OsmID = v.osm_id
+        FROM (VALUES %s) AS v(osm_id, name)
+        WHERE Locations.OsmID IS NULL
+          AND Locations.LocationName = v.name
+          AND (SELECT COUNT(*) FROM Locations l WHERE l.LocationName = v.name) = 1
+    """, [(beach['osm_id'], beach['name']) for beach in beaches if name_counts[beach['name']] == 1])
+
+    changed = execute_values(cur, """
+        INSERT INTO Locations (OsmID, LocationName, Coordinates, CreatedAt)
+        VALUES %s
+        ON CONFLICT (OsmID) DO UPDATE
+        SET LocationName = EXCLUDED.LocationName,
+            Coordinates = EXCLUDED.Coordinates,
+            UpdatedAt = NOW()
+        WHERE (Locations.LocationName, Locations.Coordinates) IS DISTINCT FROM (EXCLUDED.LocationName, EXCLUDED.Coordinates)
+        RETURNING LocationID
+    """, rows, template="(%s, %s, %s::jsonb, NOW())", page_size=500, fetch=True)
+    return len(changed)
+
+def main():
+    """
+      This is the main entry point of the program. It fetches all the beaches in Ireland together with their
+      coordinates, geocodes only those without geometry and synchronises them into the Locations table.
+      Running it again only applies the changes made in OSM since the last run.
     """
     beaches = get_beaches_in_ireland()
     print("Number of beaches found:", len(beaches))
-    # Insert each beach into the Locations table
-    for beach in beaches:
-        lat, lng = get_lat_long(beach)
-        coordinates = json.dumps({'latitude': lat, 'longitude': lng})
-        # print(beach)
-        # print(coordinates)
-        cur.execute(
-            sql.SQL("""
-                INSERT INTO Locations (LocationName, Coordinates, CreatedAt)
-                VALUES (%s, %s, NOW())
-            """),
-            (beach, coordinates)
-        )
-
-    # Commit the transaction
-    conn.commit()
-
-    # Close the connection
-    conn.close()
+    beaches = deduplicate_beaches(beaches)
+    print("Number of unique beaches:", len(beaches))
+    beaches = geocode_missing(beaches)
+    print("Number of beaches with coordinates:", len(beaches))
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cur = conn.cursor()
+        ensure_osm_id(cur)
+        print("Inserted or updated locations:", upsert_beaches(cur, beaches))
+
+        # Commit the transaction
+        conn.commit()
+    finally:
+        # Close the connection
+        conn.close()
+
+if __name__ == "__main__":
+    main()
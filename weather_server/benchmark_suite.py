@@ -0,0 +1,419 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+from database import db_constants
+from database.database_creation import create_tables
+import metrics
+import pipeline
+import prediction_calculation
+import synthetic_data
+from training_budget import MIN_TRAINING_SECONDS
+import upstream_client
+import weather_request
+
+"""
+  End-to-end benchmark of the pipeline against local stand-ins, e.g.
+
+      python benchmark_suite.py --scales 10,100,1000 --years 1 --output benchmark_report.json
+      python benchmark_suite.py --scales 10 --pg-host localhost --pg-user postgres --pg-password secret
+
+  For every scale a fresh database with the database_creation schema is seeded with synthetic history for N
+  locations over M years. Open-Meteo and weatherapi.com are served by a local stub, so nothing leaves the
+  machine. The stages are then run one after another through the pipeline runner and timed:
+
+      ingest        grid cell resolution and yesterday's data of every cell
+      training      LSTM training of up to --train-cells cells, --train-budget seconds each
+      forecasting   72 hour forecasts of every cell, TFLite for trained cells and the baseline for the others
+      scoring       quality scores of every location
+
+  The database runs in a throwaway cluster created with initdb unless --pg-host points at an existing server,
+  PostgreSQL refuses to start a cluster as root. Every scale runs in its own working directory, so model, history,
+  cache and metrics files of one scale do not influence the next.
+"""
+
+SCALES = [10, 100, 1000]
+STAGES = ['ingest', 'training', 'forecasting', 'scoring']
+
+# Resolution of the stub marine model, nearby beaches share a cell like in the real one
+GRID_STEP = 0.05
+
+SEA_CONDITIONS_COLUMNS = [
+    'Date', 'TimeOfDay', 'LocationID', 'WaveHeight', 'WindWaveHeight', 'SwellWaveHeight',
+    'WaveDirection', 'WindWaveDirection', 'SwellWaveDirection', 'WavePeriod', 'WindWavePeriod',
+    'SwellWavePeriod', 'WindWavePeakPeriod', 'SwellWavePeakPeriod', 'WindSpeed', 'WindDirection',
+    'Weather', 'Icon', 'CreatedAt',
+]
+
+
+def snap(value):
+    return round(round(float(value) / GRID_STEP) * GRID_STEP, 4)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves /v1/marine in the Open-Meteo flatbuffers format and /v1/history.json like weatherapi.com. The data
+    only depends on the grid cell and the day, so repeated requests return the same values.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            if url.path == '/v1/marine':
+                latitude, longitude = snap(query['latitude'][0]), snap(query['longitude'][0])
+                start = datetime.datetime.strptime(query['start_date'][0], "%Y-%m-%d")
+                end = datetime.datetime.strptime(query['end_date'][0], "%Y-%m-%d")
+                variables = [name for value in query['hourly'] for name in value.split(',')]
+                conditions = synthetic_data.generate_conditions(
+                    start, ((end - start).days + 1) * 24, synthetic_data.rng_for('cell', latitude, longitude, start.date())
+                )
+                body = synthetic_data.marine_response(latitude, longitude, start, conditions, variables)
+                content_type = 'application/octet-stream'
+            elif url.path == '/v1/history.json':
+                latitude, longitude = (snap(value) for value in query['q'][0].split(','))
+                start = datetime.datetime.strptime(query['dt'][0], "%Y-%m-%d")
+                conditions = synthetic_data.generate_conditions(
+                    start, 24, synthetic_data.rng_for('cell', latitude, longitude, start.date())
+                )
+                body = json.dumps(synthetic_data.weatherapi_response(start, conditions)).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstream:
+    """
+    Local HTTP server standing in for both upstream APIs.
+
+    @param latency: Seconds added to every response, to model the network.
+    """
+
+    def __init__(self, latency=0.0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.latency = latency
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalPostgres:
+    """
+    Throwaway PostgreSQL cluster in a temporary directory, tuned for speed over durability.
+
+    @param directory: Directory holding the cluster, its socket and its log.
+    @param bindir: Directory of initdb and pg_ctl, found on the PATH or through pg_config by default.
+    """
+
+    def __init__(self, directory, bindir=None):
+        self.directory = directory
+        self.bindir = bindir
+        self.data = os.path.join(directory, 'data')
+        self.server = None
+
+    def _binary(self, name):
+        if self.bindir:
+            return os.path.join(self.bindir, name)
+        path = shutil.which(name)
+        if path is None and shutil.which('pg_config'):
+            bindir = subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True).stdout.strip()
+            path = os.path.join(bindir, name)
+        if path is None or not os.path.exists(path):
+            raise RuntimeError(f"{name} not found, install PostgreSQL or pass --pg-bindir or --pg-host")
+        return path
+
+    def start(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise RuntimeError("PostgreSQL does not run as root, run the benchmark as another user or pass --pg-host")
+        subprocess.run([self._binary('initdb'), '-D', self.data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync'],
+                       check=True, capture_output=True)
+        port = free_port()
+        options = f"-p {port} -k {self.directory} -c listen_addresses=127.0.0.1 -c fsync=off " \
+                  f"-c synchronous_commit=off -c full_page_writes=off -c max_connections=200"
+        subprocess.run([self._binary('pg_ctl'), '-D', self.data, '-l', os.path.join(self.directory, 'postgres.log'),
+                        '-o', options, '-w', 'start'], check=True, capture_output=True)
+        self.server = {'host': '127.0.0.1', 'port': port, 'user': 'postgres', 'password': ''}
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            subprocess.run([self._binary('pg_ctl'), '-D', self.data, '-m', 'fast', '-w', 'stop'], capture_output=True)
+            self.server = None
+
+
+def create_database(server, name):
+    """
+    Creates an empty database with the schema of database_creation, dropping an earlier one of the same name.
+
+    @return: Connection parameters in the format of DB_CONFIG.
+    """
+    conn = psycopg2.connect(dbname='postgres', **server)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name}")
+        cur.execute(f"CREATE DATABASE {name}")
+    conn.close()
+
+    config = dict(server, dbname=name)
+    conn = psycopg2.connect(**config)
+    with conn.cursor() as cur:
+        create_tables(cur)
+    conn.commit()
+    conn.close()
+    return config
+
+
+def sea_conditions_csv(location_id, start, conditions, created_at):
+    """
+    Formats the history of one location for COPY into SeaConditions.
+    """
+    hours = len(conditions['wave_height'])
+    times = (np.datetime64(start, 'm') + np.arange(hours).astype('timedelta64[h]')).astype(str)
+    columns = [np.round(conditions[name], 2).astype(str) for name in (
+        'wave_height', 'wind_wave_height', 'swell_wave_height', 'wave_direction', 'wind_wave_direction',
+        'swell_wave_direction', 'wave_period', 'wind_wave_period', 'swell_wave_period', 'wind_wave_peak_period',
+        'swell_wave_peak_period', 'wind_kph'
+    )]
+    wind_directions = synthetic_data.compass(conditions['wind_degree'])
+    temperatures = np.round(conditions['temp_c'], 1).astype(str)
+    lines = []
+    for i, time_of_day in enumerate(times):
+        time_of_day = time_of_day.replace('T', ' ')
+        lines.append(",".join([time_of_day[:10], time_of_day, str(location_id)] + [column[i] for column in columns]
+                              + [wind_directions[i], temperatures[i], synthetic_data.ICON, created_at]))
+    return "\n".join(lines) + "\n"
+
+
+def seed_database(config, count, start, hours, seed=0):
+    """
+    Inserts count synthetic locations with hours of history each.
+
+    @return: The number of history rows.
+    """
+    created_at = datetime.datetime.now().isoformat(sep=' ')
+    conn = psycopg2.connect(**config)
+    try:
+        with conn.cursor() as cur:
+            location_ids = execute_values(cur, """
+                INSERT INTO Locations (LocationName, Coordinates, CreatedAt) VALUES %s RETURNING LocationID
+            """, [(name, json.dumps({'latitude': latitude, 'longitude': longitude}))
+                  for name, latitude, longitude in synthetic_data.generate_locations(count, seed)],
+                template="(%s, %s::jsonb, NOW())", fetch=True)
+            for (location_id,) in location_ids:
+                conditions = synthetic_data.generate_conditions(start, hours, synthetic_data.rng_for('history', seed, location_id))
+                cur.copy_expert(
+                    f"COPY SeaConditions ({', '.join(SEA_CONDITIONS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                    io.StringIO(sea_conditions_csv(location_id, start, conditions, created_at))
+                )
+        conn.commit()
+    finally:
+        conn.close()
+    return count * hours
+
+
+def count_rows(sql, params=()):
+    conn = psycopg2.connect(**db_constants.DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_stage(name, tasks, workers, rows_sql=None, rows_params=()):
+    """
+    Runs independent tasks of one pipeline stage through the pipeline runner and times them.
+    """
+    tasks = {tid: task._replace(upstream=[]) for tid, task in tasks.items()}
+    checkpoint = pipeline.Checkpoint(os.path.join(db_constants.PIPELINE_STATE_DIR, f"benchmark-{name}.json"))
+    print(f"Stage {name}: {len(tasks)} tasks")
+    start = time.perf_counter()
+    failed = pipeline.execute(tasks, {task.stage for task in tasks.values()}, checkpoint, workers) if tasks else {}
+    seconds = time.perf_counter() - start
+    result = {
+        'seconds': seconds,
+        'tasks': len(tasks),
+        'failed': len(failed),
+        'tasks_per_second': len(tasks) / seconds if seconds else None,
+    }
+    if rows_sql:
+        result['rows'] = count_rows(rows_sql, rows_params)
+        result['rows_per_second'] = result['rows'] / seconds if seconds else None
+    return result
+
+
+def run_scale(server, count, args):
+    """
+    Seeds a fresh database with count locations and runs the selected stages on it.
+
+    @return: The report entry of the scale.
+    """
+    workspace = tempfile.mkdtemp(prefix=f"weather-bench-{count}-", dir=args.workdir)
+    os.chdir(workspace)
+    db_constants.DB_CONFIG.clear()
+    db_constants.DB_CONFIG.update(create_database(server, f"weather_bench_{count}"))
+    upstream_client.reset_sessions()
+    metrics.reset()
+    os.environ.pop(metrics.RUN_ID_VARIABLE, None)
+    metrics.start_run()
+
+    today = datetime.date.today()
+    ingest_day = today - datetime.timedelta(days=1)
+    history_start = datetime.datetime.combine(ingest_day - datetime.timedelta(days=365 * args.years), datetime.time())
+    hours = 365 * args.years * 24
+
+    print(f"Scale {count}: seeding {count} locations with {args.years} years of history in {workspace}")
+    entry = {'locations': count, 'years': args.years, 'workspace': workspace, 'stages': {}}
+    start = time.perf_counter()
+    entry['history_rows'] = seed_database(db_constants.DB_CONFIG, count, history_start, hours, args.seed)
+    entry['seed_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tasks = pipeline.plan(pipeline.STAGES, ingest_day.strftime("%Y-%m-%d"), None, True, args.workers)
+    entry['plan_seconds'] = time.perf_counter() - start
+    forecast_tasks = [task for task in tasks.values() if task.stage == 'forecast']
+    entry['cells'] = len(forecast_tasks)
+
+    def select(stage):
+        return {tid: task for tid, task in tasks.items() if task.stage == stage}
+
+    if 'ingest' in args.stages:
+        entry['stages']['ingest'] = run_stage('ingest', select('ingest'), args.workers,
+                                              "SELECT COUNT(*) FROM SeaConditions WHERE Date = %s", (ingest_day,))
+    if 'training' in args.stages:
+        training = {pipeline.task_id('forecast', task.partition): task._replace(args=(task.args[0], args.train_budget, None, True))
+                    for task in forecast_tasks[:args.train_cells]}
+        entry['stages']['training'] = run_stage('training', training, args.workers)
+    if 'forecasting' in args.stages:
+        # Cells trained above roll forward with TFLite, the others get the seasonal baseline
+        forecasting = {pipeline.task_id('forecast', task.partition): task._replace(args=(task.args[0], 0, None, False))
+                       for task in forecast_tasks}
+        entry['stages']['forecasting'] = run_stage('forecasting', forecasting, args.workers,
+                                                   "SELECT COUNT(*) FROM PredictedSeaConditions")
+    if 'scoring' in args.stages:
+        entry['stages']['scoring'] = run_stage('scoring', select('score'), args.workers,
+                                               "SELECT COUNT(*) FROM ComputedSeaConditions")
+        start = time.perf_counter()
+        pipeline.run_rankings()
+        entry['stages']['scoring']['ranking_seconds'] = time.perf_counter() - start
+
+    report_path = metrics.write_run_report()
+    if report_path:
+        with open(report_path) as f:
+            run_report = json.load(f)
+        entry['metrics'] = {key: run_report[key] for key in ('counters', 'timers', 'peak_rss_bytes')}
+    return entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data against local stand-ins")
+    parser.add_argument("--scales", default=",".join(str(scale) for scale in SCALES), help="comma separated location counts")
+    parser.add_argument("--years", type=int, default=1, help="years of seeded history per location")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated stages, of {','.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 8))
+    parser.add_argument("--train-cells", type=int, default=10, help="cells trained per scale, training all of them takes hours")
+    parser.add_argument("--train-budget", type=float, default=MIN_TRAINING_SECONDS,
+                        help="training seconds per cell, at least training_budget.MIN_TRAINING_SECONDS, 0 trains without limit")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stub response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--workdir", default=None, help="parent of the per scale working directories")
+    parser.add_argument("--keep", action="store_true", help="keep the working directories and the database cluster")
+    parser.add_argument("--pg-bindir", help="directory of initdb and pg_ctl")
+    parser.add_argument("--pg-host", help="use this existing server instead of a throwaway cluster")
+    parser.add_argument("--pg-port", type=int, default=5432)
+    parser.add_argument("--pg-user", default="postgres")
+    parser.add_argument("--pg-password", default="")
+    args = parser.parse_args()
+    args.stages = [stage for stage in STAGES if stage in args.stages.split(',')]
+    args.output = os.path.abspath(args.output)
+    # 0 opts into unlimited training, train_model would take a 0 budget for a baseline forecast
+    args.train_budget = args.train_budget or None
+    scales = [int(value) for value in args.scales.split(',')]
+
+    # Everything goes to the local stand-ins, every location is forecast and the stub is never rate limited
+    stub = StubUpstream(args.latency).start()
+    weather_request.MARINE_API_URL = f"{stub.url}/v1/marine"
+    weather_request.WEATHER_HISTORY_URL = f"{stub.url}/v1/history.json"
+    upstream_client.MODE = "live"
+    for endpoint in upstream_client.ENDPOINTS.values():
+        endpoint.update(rate=10000, daily_quota=10 ** 9)
+    prediction_calculation.FORECAST_LOCATION_RANGE = None
+
+    cluster_dir = None
+    postgres = None
+    if args.pg_host:
+        server = {'host': args.pg_host, 'port': args.pg_port, 'user': args.pg_user, 'password': args.pg_password}
+    else:
+        cluster_dir = tempfile.mkdtemp(prefix="weather-bench-pg-", dir=args.workdir)
+        postgres = LocalPostgres(cluster_dir, args.pg_bindir).start()
+        server = postgres.server
+
+    report = {
+        'started': time.time(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key != 'pg_password'},
+        'scales': [],
+    }
+    try:
+        for count in scales:
+            entry = run_scale(server, count, args)
+            report['scales'].append(entry)
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+            for stage, result in entry['stages'].items():
+                print(f"  {stage:12} {result['seconds']:9.1f} s  {result['tasks_per_second'] or 0:9.2f} tasks/s  "
+                      f"{result['failed']} failed")
+            if not args.keep:
+                os.chdir(args.workdir or tempfile.gettempdir())
+                shutil.rmtree(entry['workspace'], ignore_errors=True)
+    finally:
+        stub.stop()
+        if postgres is not None:
+            postgres.stop()
+        if cluster_dir and not args.keep:
+            shutil.rmtree(cluster_dir, ignore_errors=True)
+    print(f"Benchmark report written to {args.output}")
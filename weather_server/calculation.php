@@ -1,14 +1,12 @@
 <?php
 try {
     putenv('TF_ENABLE_ONEDNN_OPTS=0');
-    // Install the Python requirements
-    shell_exec('pip install --upgrade pip');
-    shell_exec('pip install -r requirements.txt');
+    // Dependencies are installed once when the environment is built (see startup.sh), not on every run.
 
     // Execute the Python script
-    $calc_output = shell_exec('python quality_calculation.py');
+    $calc_output = shell_exec('python pipeline.py run --only score 2>&1');
     if ($calc_output === null) {
-        throw new Exception("Failed to execute 'python weather_request.py'");
+        throw new Exception("Failed to execute 'python pipeline.py run --only score'");
     }
 
     // Print the output of the Python script
@@ -1,118 +1,187 @@
+import argparse
+
 import psycopg2
 from psycopg2 import sql
 
 from database.db_constants import DB_CONFIG
+from quality_calculation import create_summary_tables
+from retention import create_rollup_tables
+
+def create_tables(cur):
+    """
+    Creates the tables, constraints and indexes of the weather server.
+
+    @param cur: A cursor of the database to create the schema in.
+    """
+    # Create SeaConditions table
+    cur.execute("""
+        CREATE TABLE SeaConditions (
+            ConditionID SERIAL PRIMARY KEY,
+            Date DATE,
+            TimeOfDay VARCHAR(50),
+            LocationID INT,
+            WaveHeight DECIMAL,
+            WindWaveHeight DECIMAL,
+            SwellWaveHeight DECIMAL,
+            WaveDirection DECIMAL,
+            WindWaveDirection DECIMAL,
+            SwellWaveDirection DECIMAL,
+            WavePeriod DECIMAL,
+            WindWavePeriod DECIMAL,
+            SwellWavePeriod DECIMAL,
+            WindWavePeakPeriod DECIMAL,
+            SwellWavePeakPeriod DECIMAL,
+            WindSpeed DECIMAL,
+            WindDirection VARCHAR(50),
+            Weather VARCHAR(100),
+            Icon VARCHAR(255),
+            CreatedAt TIMESTAMP,
+            DeletedAt TIMESTAMP
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE PredictedSeaConditions (
+            ConditionID SERIAL PRIMARY KEY,
+            Date DATE,
+            TimeOfDay VARCHAR(50),
+            LocationID INT,
+            WaveHeight DECIMAL,
+            WindWaveHeight DECIMAL,
+            SwellWaveHeight DECIMAL,
+            WaveDirection DECIMAL,
+            WindWaveDirection DECIMAL,
+            SwellWaveDirection DECIMAL,
+            WavePeriod DECIMAL,
+            WindWavePeriod DECIMAL,
+            SwellWavePeriod DECIMAL,
+            WindWavePeakPeriod DECIMAL,
+            SwellWavePeakPeriod DECIMAL,
+            WindSpeed DECIMAL,
+            WindDirection VARCHAR(50),
+            Weather VARCHAR(100),
+            CreatedAt TIMESTAMP,
+            DeletedAt TIMESTAMP,
+            CONSTRAINT unique_date_time_location UNIQUE (Date, TimeOfDay, LocationID)
+        )
+    """)
+
+    # Create ComputedSeaConditions table
+    cur.execute("""
+        CREATE TABLE ComputedSeaConditions (
+            ConditionID SERIAL PRIMARY KEY,
+            TimeOfDay VARCHAR(50),
+            LocationID INT,
+            SurfDifficulty VARCHAR(50),
+            WaveQuality VARCHAR(50),
+            WindImpact DECIMAL,
+            Recommendation VARCHAR(255),
+            QualityScore DECIMAL,
+            ComputationTime TIMESTAMP,
+            CreatedAt TIMESTAMP,
+            DeletedAt TIMESTAMP,
+            CONSTRAINT computedseaconditions_locationid_timeofday UNIQUE (LocationID, TimeOfDay)
+        )
+    """)
+
+    # # Create Locations table
+    cur.execute("""
+        CREATE TABLE Locations (
+            LocationID SERIAL PRIMARY KEY,
+            LocationName VARCHAR(100),
+            Coordinates JSONB,
+            OsmID VARCHAR(32) UNIQUE,
+            GridLatitude DECIMAL,
+            GridLongitude DECIMAL,
+            CreatedAt TIMESTAMP,
+            UpdatedAt TIMESTAMP,
+            DeletedAt TIMESTAMP
+        )
+    """)
+
+    # Add foreign key constraint to SeaConditions table
+    cur.execute("""
+        ALTER TABLE SeaConditions
+        ADD CONSTRAINT fk_location
+        FOREIGN KEY (LocationID)
+        REFERENCES Locations(LocationID)
+    """)
+
+    cur.execute("""
+        ALTER TABLE PredictedSeaConditions
+        ADD CONSTRAINT fk_location
+        FOREIGN KEY (LocationID)
+        REFERENCES Locations(LocationID)
+    """)
+
+    # Add foreign key constraint to ComputedSeaConditions table
+    cur.execute("""
+        ALTER TABLE ComputedSeaConditions
+        ADD CONSTRAINT fk_condition
+        FOREIGN KEY (LocationID)
+        REFERENCES Locations(LocationID)
+    """)
+
+    # Spatial index used by the "point" backend of /locations/nearest and /locations/bbox,
+    # the expression must match POSITION_SQL in location_index.py
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS locations_position_idx
+        ON Locations USING gist (point((Coordinates->>'longitude')::float, (Coordinates->>'latitude')::float))
+    """)
+
+    # The forecast snapshot reads a window of computed hours by their fixed format 'YYYY-MM-DD HH:MM:SS' key
+    cur.execute("CREATE INDEX IF NOT EXISTS computedseaconditions_timeofday_idx ON ComputedSeaConditions (TimeOfDay)")
+
+    # Daily and weekly aggregates of the hourly history past the retention window
+    create_rollup_tables(cur)
+
+    # Per-location daily summaries and beach rankings written by the scoring stage
+    create_summary_tables(cur)
+
+def migrate(cur):
+    """
+    Brings a database created by an earlier version up to the current schema. Every statement is idempotent,
+    run it once after upgrading, not on every pipeline run.
+
+    @param cur: A cursor of the database to migrate.
+    """
+    # Key of the beach sync, marker of changed rows in the Locations version, and marine grid cell of a location
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS OsmID VARCHAR(32)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS locations_osmid_key ON Locations (OsmID)")
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS UpdatedAt TIMESTAMP")
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS GridLatitude DECIMAL")
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS GridLongitude DECIMAL")
+    # Same expression as in create_tables, see POSITION_SQL in location_index.py
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS locations_position_idx
+        ON Locations USING gist (point((Coordinates->>'longitude')::float, (Coordinates->>'latitude')::float))
+    """)
+
+    cur.execute("ALTER TABLE ComputedSeaConditions ADD COLUMN IF NOT EXISTS QualityScore DECIMAL")
+    cur.execute("CREATE INDEX IF NOT EXISTS computedseaconditions_timeofday_idx ON ComputedSeaConditions (TimeOfDay)")
+    create_rollup_tables(cur)
+    create_summary_tables(cur)
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or migrate the weather server schema")
+    parser.add_argument("--migrate", action="store_true", help="upgrade an existing database instead of creating one")
+    args = parser.parse_args()
+
+    # Establish a connection to the database
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        # Create a cursor object
+        cur = conn.cursor()
+        if args.migrate:
+            migrate(cur)
+        else:
+            create_tables(cur)
+
+        # Commit the transaction
+        conn.commit()
+    finally:
+        # Close the connection
+        conn.close()
 
-# Establish a connection to the database
-conn = psycopg2.connect(**DB_CONFIG)
-
-# Create a cursor object
-cur = conn.cursor()
-
-# Create SeaConditions table
-cur.execute("""
-    CREATE TABLE SeaConditions (
-        ConditionID SERIAL PRIMARY KEY,
-        Date DATE,
-        TimeOfDay VARCHAR(50),
-        LocationID INT,
-        WaveHeight DECIMAL,
-        WindWaveHeight DECIMAL,
-        SwellWaveHeight DECIMAL,
-        WaveDirection DECIMAL,
-        WindWaveDirection DECIMAL,
-        SwellWaveDirection DECIMAL,
-        WavePeriod DECIMAL,
-        WindWavePeriod DECIMAL,
-        SwellWavePeriod DECIMAL,
-        WindWavePeakPeriod DECIMAL,
-        SwellWavePeakPeriod DECIMAL,
-        WindSpeed DECIMAL,
-        WindDirection VARCHAR(50),
-        Weather VARCHAR(100),
-        CreatedAt TIMESTAMP,
-        DeletedAt TIMESTAMP
-    )
-""")
-
-cur.execute("""
-    CREATE TABLE PredictedSeaConditions (
-        ConditionID SERIAL PRIMARY KEY,
-        Date DATE,
-        TimeOfDay VARCHAR(50),
-        LocationID INT,
-        WaveHeight DECIMAL,
-        WindWaveHeight DECIMAL,
-        SwellWaveHeight DECIMAL,
-        WaveDirection DECIMAL,
-        WindWaveDirection DECIMAL,
-        SwellWaveDirection DECIMAL,
-        WavePeriod DECIMAL,
-        WindWavePeriod DECIMAL,
-        SwellWavePeriod DECIMAL,
-        WindWavePeakPeriod DECIMAL,
-        SwellWavePeakPeriod DECIMAL,
-        WindSpeed DECIMAL,
-        WindDirection VARCHAR(50),
-        Weather VARCHAR(100),
-        CreatedAt TIMESTAMP,
-        DeletedAt TIMESTAMP
-        CONSTRAINT unique_date_location UNIQUE (Date, TimeOfDay, LocationID)
-    )
-""")
-
-# Create ComputedSeaConditions table
-cur.execute("""
-    CREATE TABLE ComputedSeaConditions (
-        ConditionID SERIAL PRIMARY KEY,
-        TimeOfDay VARCHAR(50),
-        LocationID INT,
-        SurfDifficulty VARCHAR(50),
-        WaveQuality VARCHAR(50),
-        WindImpact DECIMAL,
-        Recommendation VARCHAR(255),
-        ComputationTime TIMESTAMP,
-        CreatedAt TIMESTAMP,
-        DeletedAt TIMESTAMP
-    )
-""")
-
-# # Create Locations table
-cur.execute("""
-    CREATE TABLE Locations (
-        LocationID SERIAL PRIMARY KEY,
-        LocationName VARCHAR(100),
-        Coordinates JSONB,
-        CreatedAt TIMESTAMP,
-        DeletedAt TIMESTAMP
-    )
-""")
-
-# Add foreign key constraint to SeaConditions table
-cur.execute("""
-    ALTER TABLE SeaConditions
-    ADD CONSTRAINT fk_location
-    FOREIGN KEY (LocationID)
-    REFERENCES Locations(LocationID)
-""")
-
-cur.execute("""
-    ALTER TABLE PredictedSeaConditions
-    ADD CONSTRAINT fk_location
-    FOREIGN KEY (LocationID)
-    REFERENCES Locations(LocationID)
-""")
-
-# Add foreign key constraint to ComputedSeaConditions table
-cur.execute("""
-    ALTER TABLE ComputedSeaConditions
-    ADD CONSTRAINT fk_condition
-    FOREIGN KEY (LocationID)
-    REFERENCES Locations(LocationID)
-""")
-
-# Commit the transaction
-conn.commit()
-
-# Close the connection
-conn.close()
+if __name__ == "__main__":
+    main()
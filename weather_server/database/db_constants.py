@@ -8,3 +8,44 @@ DB_CONFIG = {
 
 API_BEACH = ""
 API_WEATHER = ""
+
+# Directory where trained forecaster models are exported for TFLite inference
+MODEL_DIR = "models"
+
+# Backend of /locations/nearest and /locations/bbox: "memory" (BallTree) or "point" (GiST index in PostgreSQL)
+LOCATION_INDEX_BACKEND = "memory"
+
+# Local memory-mapped copy of the SeaConditions history used for training, None reads from the database
+HISTORY_DIR = "history"
+
+# Locations (first, last id) whose forecasters are trained, None trains every location
+FORECAST_LOCATION_RANGE = (375, 385)
+
+# Wall clock time (HH:MM) by which the nightly training has to be finished, None trains without a deadline
+TRAINING_DEADLINE = None
+
+# Directory of the pipeline checkpoints, one file per run day
+PIPELINE_STATE_DIR = "pipeline_state"
+
+# URL of the forecast API reload endpoint called after a pipeline run, e.g. "http://localhost:5000/forecast/reload"
+FORECAST_RELOAD_URL = None
+
+# Environment variable holding the shared token of the reload endpoint. Without it only localhost may reload,
+# with it every caller has to send it in the X-Reload-Token header
+FORECAST_RELOAD_TOKEN_VARIABLE = "FORECAST_RELOAD_TOKEN"
+
+# Directory of the run reports and the Prometheus textfile written by metrics.py, None disables them
+METRICS_DIR = "metrics"
+
+# Days of hourly SeaConditions history kept by retention.py, older hours are rolled up into daily and weekly
+# aggregates. None disables retention and the loaders read hourly rows only
+HOURLY_RETENTION_DAYS = None
+
+# Days the daily rollups are kept before only the weekly ones are left
+DAILY_ROLLUP_RETENTION_DAYS = 5 * 365
+
+# Directory of the gzipped CSV archive of rolled up hourly rows, None deletes them without archiving
+RETENTION_ARCHIVE_DIR = "archive"
+
+# Beaches stored per day and region by the scoring stage, the most the /rankings endpoint can return
+RANKING_SIZE = 10
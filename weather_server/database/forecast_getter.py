@@ -0,0 +1,322 @@
+from datetime import datetime, timedelta
+import gzip
+import hmac
+import json
+import os
+import threading
+import time
+import numpy as np
+from flask import Response, jsonify, request
+
+from database.db_constants import FORECAST_RELOAD_TOKEN_VARIABLE, RANKING_SIZE
+from database.location_getter import app, query
+from database.location_index import decode_location_name
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+"""
+  Read API for the forecasts. The predicted and computed sea conditions of all locations are loaded
+  into one columnar snapshot after each pipeline run and every read is answered from memory, so the
+  app no longer queries PredictedSeaConditions and ComputedSeaConditions for every screen.
+  The daily summaries and beach rankings written by the scoring stage are part of the snapshot, ready to
+  serve payloads keyed by location and by (day, region), so a ranking read only copies its k entries.
+  The routes are registered on the location_getter app, running this module serves both APIs.
+"""
+
+# Hours covered by a snapshot, starting at midnight today. Predictions start at 01:00 and run for 72 hours.
+SNAPSHOT_HOURS = 96
+# Minimum number of seconds between two checks for a newer pipeline run
+VERSION_CHECK_INTERVAL = 300
+
+PREDICTED_COLUMNS = [
+    'waveheight', 'windwaveheight', 'swellwaveheight', 'wavedirection',
+    'windwavedirection', 'swellwavedirection', 'waveperiod', 'windwaveperiod',
+    'swellwaveperiod', 'windspeed', 'weather'
+]
+VALUE_COLUMNS = PREDICTED_COLUMNS + ['windimpact']
+LABEL_COLUMNS = ['winddirection', 'surfdifficulty', 'wavequality', 'recommendation']
+
+# Latest write of each forecast table, a change means a pipeline run wrote new data
+VERSION_SQL = """
+    SELECT (SELECT MAX(CreatedAt) FROM PredictedSeaConditions), (SELECT MAX(CreatedAt) FROM ComputedSeaConditions),
+           (SELECT MAX(ComputedAt) FROM DailyBeachRankings)
+"""
+
+# Format of the ComputedSeaConditions TimeOfDay keys, which sort like the times they hold
+TIME_KEY_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Region of the national ranking, the others are named after their lat/lon square, see quality_calculation.region_of
+NATIONAL_REGION = 'all'
+
+
+class ForecastSnapshot:
+    """
+    Immutable columnar view of the forecasts of all locations.
+
+    values[column] is a float32 array of shape (locations, SNAPSHOT_HOURS) with NaN for missing hours,
+    labels[column] holds uint8 codes into label_values[column] with 0 meaning missing.
+    summaries maps location ids to their daily summaries, rankings maps (day, region) to the ranked beaches.
+    """
+
+    def __init__(self, start, location_ids, values, labels, label_values, version, summaries=None, rankings=None):
+        self.start = start
+        self.location_ids = location_ids
+        self.rows = {location_id: i for i, location_id in enumerate(location_ids)}
+        self.values = values
+        self.labels = labels
+        self.label_values = label_values
+        self.version = version
+        self.summaries = summaries or {}
+        self.rankings = rankings or {}
+
+    def location(self, location_id):
+        """
+        Returns the forecast of one location as a dictionary of hourly columns, or None if unknown.
+        """
+        row = self.rows.get(location_id)
+        if row is None:
+            return None
+        hours = np.flatnonzero(~np.isnan(self.values['waveheight'][row]) | (self.labels['surfdifficulty'][row] > 0))
+        forecast = {'times': [(self.start + timedelta(hours=int(h))).isoformat() for h in hours]}
+        for column, array in self.values.items():
+            values = np.round(array[row, hours].astype(float), 3)
+            forecast[column] = np.where(np.isnan(values), None, values).tolist()
+        for column, codes in self.labels.items():
+            names = self.label_values[column]
+            forecast[column] = [names[code] if code else None for code in codes[row, hours]]
+        return forecast
+
+
+def load_rankings(start, end):
+    """
+    Loads the daily summaries and rankings of the days from start to end (exclusive) as response payloads.
+
+    @return: (summaries by location id, rankings by (ISO day, region)).
+    """
+    summaries = {}
+    for location_id, date, best_hour, best_score, mean_score, peak_wave_height, recommendation in query("""
+        SELECT LocationID, Date, BestHour, BestScore, MeanScore, PeakWaveHeight, DominantRecommendation
+        FROM DailySurfSummaries
+        WHERE Date >= %s AND Date < %s
+        ORDER BY Date
+    """, (start, end)):
+        summaries.setdefault(location_id, []).append({
+            'date': date.isoformat(), 'best_hour': best_hour.isoformat(), 'best_score': float(best_score),
+            'mean_score': round(float(mean_score), 3), 'peak_wave_height': round(float(peak_wave_height), 3),
+            'recommendation': recommendation,
+        })
+
+    rankings = {}
+    for date, region, location_id, name, score, best_hour in query("""
+        SELECT r.Date, r.Region, r.LocationID, l.LocationName, r.Score, r.BestHour
+        FROM DailyBeachRankings r
+        JOIN Locations l ON l.LocationID = r.LocationID
+        WHERE r.Date >= %s AND r.Date < %s
+        ORDER BY r.Date, r.Region, r.Rank
+    """, (start, end)):
+        rankings.setdefault((date.isoformat(), region), []).append({
+            'location_id': location_id, 'name': decode_location_name(name), 'score': float(score), 'best_hour': best_hour.isoformat(),
+        })
+    return summaries, rankings
+
+
+def load_snapshot():
+    """
+    Loads the current forecast window of all locations with one query per table.
+    """
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end = start + timedelta(hours=SNAPSHOT_HOURS)
+    # Read the version first, rows written meanwhile only make the snapshot newer than its version
+    version = query(VERSION_SQL)[0]
+
+    predicted = query(f"""
+        SELECT LocationID, Date, EXTRACT(HOUR FROM TimeOfDay::time)::int,
+               {', '.join(PREDICTED_COLUMNS)}, WindDirection
+        FROM PredictedSeaConditions
+        WHERE Date >= %s AND Date < %s
+    """, (start.date(), end.date() + timedelta(days=1)))
+    # Compared as text, so the range can use the TimeOfDay index and a malformed key does not fail the query
+    computed = query("""
+        SELECT LocationID, TimeOfDay, WindImpact, SurfDifficulty, WaveQuality, Recommendation
+        FROM ComputedSeaConditions
+        WHERE TimeOfDay >= %s AND TimeOfDay < %s
+    """, (start.strftime(TIME_KEY_FORMAT), end.strftime(TIME_KEY_FORMAT)))
+
+    location_ids = sorted({row[0] for row in predicted} | {row[0] for row in computed})
+    rows = {location_id: i for i, location_id in enumerate(location_ids)}
+    shape = (len(location_ids), SNAPSHOT_HOURS)
+    values = {column: np.full(shape, np.nan, dtype=np.float32) for column in VALUE_COLUMNS}
+    labels = {column: np.zeros(shape, dtype=np.uint8) for column in LABEL_COLUMNS}
+    label_values = {column: [None] for column in LABEL_COLUMNS}
+    label_codes = {column: {} for column in LABEL_COLUMNS}
+
+    def encode_label(column, value):
+        if value is None:
+            return 0
+        codes = label_codes[column]
+        if value not in codes:
+            codes[value] = len(label_values[column])
+            label_values[column].append(value)
+        return codes[value]
+
+    for location_id, date, hour, *measurements, wind_direction in predicted:
+        index = (date - start.date()).days * 24 + hour
+        if not 0 <= index < SNAPSHOT_HOURS:
+            continue
+        row = rows[location_id]
+        for column, value in zip(PREDICTED_COLUMNS, measurements):
+            if value is not None:
+                values[column][row, index] = float(value)
+        labels['winddirection'][row, index] = encode_label('winddirection', wind_direction)
+
+    for location_id, time_of_day, wind_impact, *computed_labels in computed:
+        try:
+            index = int((datetime.strptime(time_of_day, TIME_KEY_FORMAT) - start).total_seconds() // 3600)
+        except ValueError:
+            continue
+        row = rows[location_id]
+        if wind_impact is not None:
+            values['windimpact'][row, index] = float(wind_impact)
+        for column, value in zip(LABEL_COLUMNS[1:], computed_labels):
+            labels[column][row, index] = encode_label(column, value)
+
+    summaries, rankings = load_rankings(start.date(), end.date())
+    return ForecastSnapshot(start, location_ids, values, labels, label_values, version, summaries, rankings)
+
+
+class ForecastStore:
+    """
+    Holds the current snapshot. A new snapshot is built next to the old one and swapped in with a
+    single assignment, so readers always see one complete run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.checked_at = 0.0
+
+    def current_version(self):
+        return query(VERSION_SQL)[0]
+
+    def reload(self, blocking=True):
+        """
+        Builds and swaps in a new snapshot.
+
+        @param blocking: False returns None instead of waiting when another reload is running.
+        """
+        if not self.lock.acquire(blocking=blocking):
+            return None
+        try:
+            self.snapshot = load_snapshot()
+            self.checked_at = time.monotonic()
+        finally:
+            self.lock.release()
+        return self.snapshot
+
+    def get(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return self.reload()
+        if time.monotonic() - self.checked_at >= VERSION_CHECK_INTERVAL and not self.lock.locked():
+            self.checked_at = time.monotonic()
+            # Rebuild in the background, the current snapshot keeps serving meanwhile
+            if self.current_version() != snapshot.version or snapshot.start.date() != datetime.now().date():
+                threading.Thread(target=self.reload, kwargs={'blocking': False}, daemon=True).start()
+        return snapshot
+
+
+forecast_store = ForecastStore()
+
+
+def encode(payload):
+    """
+    Encodes a response as MessagePack when asked with ?format=msgpack, otherwise as JSON, gzipped when the
+    client accepts it. MessagePack requests are answered with 406 when msgpack is not installed.
+    """
+    if request.args.get('format') == 'msgpack':
+        if msgpack is None:
+            return jsonify({'error': 'msgpack is not available on this server'}), 406
+        return Response(msgpack.packb(payload), mimetype='application/msgpack')
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    if request.accept_encodings['gzip'] and len(body) > 512:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route('/forecast/<int:location_id>', methods=['GET'])
+def get_forecast(location_id):
+    forecast = forecast_store.get().location(location_id)
+    if forecast is None:
+        return jsonify({'error': f'No forecast for location {location_id}'}), 404
+    return encode(forecast)
+
+@app.route('/forecast', methods=['GET'])
+def get_forecasts():
+    try:
+        location_ids = [int(value) for value in request.args.get('ids', '').split(',') if value]
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma separated list of location ids'}), 400
+    if not location_ids or len(location_ids) > 200:
+        return jsonify({'error': 'between 1 and 200 location ids are required'}), 400
+
+    snapshot = forecast_store.get()
+    forecasts = {}
+    for location_id in location_ids:
+        forecast = snapshot.location(location_id)
+        if forecast is not None:
+            forecasts[str(location_id)] = forecast
+    return encode(forecasts)
+
+@app.route('/forecast/<int:location_id>/summary', methods=['GET'])
+def get_summary(location_id):
+    summaries = forecast_store.get().summaries.get(location_id)
+    if summaries is None:
+        return jsonify({'error': f'No summary for location {location_id}'}), 404
+    return encode(summaries)
+
+@app.route('/rankings', methods=['GET'])
+def get_rankings():
+    """
+    Best beaches of a day, ?date=YYYY-MM-DD (today by default), ?region=<lat>,<lon> or all, ?k=<count>.
+    """
+    date = request.args.get('date', datetime.now().date().isoformat())
+    region = request.args.get('region', NATIONAL_REGION)
+    try:
+        k = int(request.args.get('k', RANKING_SIZE))
+    except ValueError:
+        return jsonify({'error': 'k must be a number'}), 400
+    if not 1 <= k <= RANKING_SIZE:
+        return jsonify({'error': f'k must be between 1 and {RANKING_SIZE}'}), 400
+
+    ranking = forecast_store.get().rankings.get((date, region))
+    if ranking is None:
+        return jsonify({'error': f'No ranking for {date} in region {region}'}), 404
+    return encode({'date': date, 'region': region, 'beaches': ranking[:k]})
+
+@app.route('/forecast/reload', methods=['POST'])
+def reload_forecasts():
+    """
+    Called at the end of a pipeline run to swap in the new forecasts immediately. Only localhost may call it,
+    unless a shared token is configured, see FORECAST_RELOAD_TOKEN_VARIABLE.
+    """
+    token = os.environ.get(FORECAST_RELOAD_TOKEN_VARIABLE)
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('X-Reload-Token', ''), token)
+    else:
+        allowed = request.remote_addr in ('127.0.0.1', '::1')
+    if not allowed:
+        return jsonify({'error': 'Reload not allowed'}), 403
+    snapshot = forecast_store.reload(blocking=False)
+    if snapshot is None:
+        return jsonify({'error': 'A reload is already running'}), 409
+    return jsonify({'locations': len(snapshot.location_ids), 'start': snapshot.start.isoformat()})
+
+if __name__ == '__main__':
+    forecast_store.reload()
+    app.run()
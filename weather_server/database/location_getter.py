@@ -1,43 +1,178 @@
-from flask import Flask, jsonify
-import psycopg2
-import json
-from database.db_constants import DB_CONFIG
+from flask import Flask, Response, jsonify, request
+import gzip
+import hashlib
+import threading
+import time
+from psycopg2.pool import ThreadedConnectionPool
+from database.db_constants import DB_CONFIG, LOCATION_INDEX_BACKEND
+from database.location_index import LocationIndex, PointLocationIndex, decode_location_name
 
 app = Flask(__name__)
 
+# Minimum number of seconds between two checks of the Locations version
+VERSION_CHECK_INTERVAL = 5
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the shared connection pool, created on first use so importing this module does not connect.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(1, 8, **DB_CONFIG)
+    return _pool
+
+
+def query(sql, params=None):
+    """
+    Runs a query on a pooled connection and returns all rows.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        conn.rollback()
+        return rows
+    finally:
+        pool.putconn(conn)
+
+
+class LocationCache:
+    """
+    Keeps the serialised /getLocations body, its gzip version and ETag in memory. The Locations table
+    almost never changes, so the body is only rebuilt when the version of the table changes.
+    The version is the row count together with the latest CreatedAt/UpdatedAt/DeletedAt.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0.0
+        # (etag, body, gzip body), swapped as a whole so readers never see a mix of two versions
+        self.entry = None
+        self.listeners = []
+
+    def current_version(self):
+        return query("SELECT COUNT(*), MAX(GREATEST(CreatedAt, UpdatedAt, DeletedAt)) FROM Locations")[0]
+
+    def build_body(self):
+        rows = query("SELECT LocationID, LocationName, Coordinates, CreatedAt, DeletedAt FROM Locations")
+        locations = []
+        for location_id, location_name, coordinates, created_at, deleted_at in rows:
+            # Check if coordinates are complete
+            if coordinates['latitude'] is not None and coordinates['longitude'] is not None:
+                locations.append({
+                    'locationid': location_id,
+                    # Decode the location name
+                    'locationname': decode_location_name(location_name),
+                    'coordinates': coordinates,
+                    'createdat': created_at,
+                    'deletedat': deleted_at
+                })
+        with app.app_context():
+            body = app.json.dumps(locations).encode('utf-8')
+        return locations, body
+
+    def refresh(self, force=False):
+        """
+        Rebuilds the cached body when the Locations version changed. Checks run at most once every
+        VERSION_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if not force and self.entry is not None and now - self.checked_at < VERSION_CHECK_INTERVAL:
+            return
+        with self.lock:
+            if not force and self.entry is not None and now - self.checked_at < VERSION_CHECK_INTERVAL:
+                return
+            version = self.current_version()
+            if force or version != self.version or self.entry is None:
+                locations, body = self.build_body()
+                self.entry = (hashlib.sha1(body).hexdigest(), body, gzip.compress(body, compresslevel=9))
+                self.version = version
+                for listener in self.listeners:
+                    listener(locations)
+            self.checked_at = now
+
+    def on_change(self, listener):
+        """
+        Registers a function called with the decoded locations every time the body is rebuilt.
+        """
+        self.listeners.append(listener)
+
+
+location_cache = LocationCache()
+
+# In-memory spatial index, replaced as a whole whenever the locations change
+location_index = LocationIndex([])
+
+
+def rebuild_location_index(locations):
+    global location_index
+    location_index = LocationIndex(locations)
+
+
+location_cache.on_change(rebuild_location_index)
+
+
+def get_location_index():
+    if LOCATION_INDEX_BACKEND == 'point':
+        return PointLocationIndex(query)
+    location_cache.refresh()
+    return location_index
+
+
 #need to put it server with link
 @app.route('/getLocations', methods=['GET'])
 def get_locations():
-    # Connect to your PostgreSQL database
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-
-    # Query all locations
-    cur.execute("SELECT * FROM Locations")
-    rows = cur.fetchall()
-
-    locations = []
-    for row in rows:
-        loc_dict = dict((cur.description[i][0], value) for i, value in enumerate(row))
-        # Check if coordinates are complete
-        if loc_dict['coordinates']['latitude'] is not None and loc_dict['coordinates']['longitude'] is not None:
-            # Decode the location name
-            locationname = json.loads('"' + loc_dict['locationname'] + '"')
-            # Structure the output
-            location = {
-                'locationid': loc_dict['locationid'],
-                'locationname': locationname,
-                'coordinates': loc_dict['coordinates'],
-                'createdat': loc_dict['createdat'],
-                'deletedat': loc_dict['deletedat']
-            }
-            locations.append(location)
-
-    # Close the connection
-    cur.close()
-    conn.close()
-
-    return jsonify(locations)
+    location_cache.refresh()
+    etag, body, gzip_body = location_cache.entry
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.accept_encodings['gzip']:
+        response = Response(gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/locations/nearest', methods=['GET'])
+def get_nearest_locations():
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = int(request.args.get('k', 10))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lon are required numbers, k an integer'}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or k < 1:
+        return jsonify({'error': 'lat, lon or k out of range'}), 400
+
+    nearest = get_location_index().nearest(lat, lon, min(k, 100))
+    return jsonify([dict(location, distance_km=round(distance, 3)) for location, distance in nearest])
+
+@app.route('/locations/bbox', methods=['GET'])
+def get_bbox_locations():
+    try:
+        box = [float(request.args[name]) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+    except (KeyError, ValueError):
+        return jsonify({'error': 'min_lat, min_lon, max_lat and max_lon are required numbers'}), 400
+    if box[0] > box[2]:
+        return jsonify({'error': 'min_lat must not be greater than max_lat'}), 400
+
+    return jsonify(get_location_index().bbox(*box))
 
 if __name__ == '__main__':
+    # Build the cache and the spatial index before serving the first request
+    location_cache.refresh(force=True)
     app.run()
@@ -0,0 +1,139 @@
+import json
+import numpy as np
+from sklearn.neighbors import BallTree
+
+"""
+  Spatial lookups over the Locations table so the app can ask for the beaches near it instead of
+  downloading every location.
+
+  Two backends answer the same queries:
+      LocationIndex       in-memory BallTree with haversine distance, rebuilt when the locations change
+      PointLocationIndex  PostgreSQL point expression with a GiST index, see database_creation.py
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Must match the expression of the locations_position_idx GiST index
+POSITION_SQL = "point((Coordinates->>'longitude')::float, (Coordinates->>'latitude')::float)"
+
+
+def decode_location_name(location_name):
+    """
+    Decodes the JSON escapes a stored location name may contain, the same way for every API returning it.
+    """
+    return json.loads('"' + location_name + '"')
+
+
+def haversine_km(lat, lon, latitudes, longitudes):
+    """
+    Great circle distance in kilometres from one point to arrays of points.
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((latitudes - lat) / 2) ** 2 + np.cos(lat) * np.cos(latitudes) * np.sin((longitudes - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def in_bbox(latitudes, longitudes, min_lat, min_lon, max_lat, max_lon):
+    """
+    Boolean mask of the points inside a bounding box. A box with min_lon > max_lon crosses the antimeridian.
+    """
+    lat_mask = (latitudes >= min_lat) & (latitudes <= max_lat)
+    if min_lon <= max_lon:
+        return lat_mask & (longitudes >= min_lon) & (longitudes <= max_lon)
+    return lat_mask & ((longitudes >= min_lon) | (longitudes <= max_lon))
+
+
+class LocationIndex:
+    """
+    In-memory BallTree over the coordinates of all locations.
+
+    @param locations: List of location dictionaries as served by /getLocations.
+    """
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.latitudes = np.array([float(loc['coordinates']['latitude']) for loc in locations])
+        self.longitudes = np.array([float(loc['coordinates']['longitude']) for loc in locations])
+        self.tree = None
+        if locations:
+            self.tree = BallTree(np.radians(np.column_stack([self.latitudes, self.longitudes])), metric='haversine')
+
+    def nearest(self, lat, lon, k):
+        """
+        Finds the k locations closest to a point.
+
+        @return: List of (location, distance in km) ordered by distance.
+        """
+        if self.tree is None:
+            return []
+        k = min(k, len(self.locations))
+        distances, indices = self.tree.query(np.radians([[lat, lon]]), k=k)
+        return [(self.locations[i], float(d) * EARTH_RADIUS_KM) for d, i in zip(distances[0], indices[0])]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Finds all locations inside a bounding box.
+
+        @return: List of locations.
+        """
+        mask = in_bbox(self.latitudes, self.longitudes, min_lat, min_lon, max_lat, max_lon)
+        return [self.locations[i] for i in np.flatnonzero(mask)]
+
+
+class PointLocationIndex:
+    """
+    Same queries as LocationIndex answered by PostgreSQL through the locations_position_idx GiST index.
+    The index orders by planar distance in degrees, so more candidates than requested are fetched and
+    re-ranked by haversine distance.
+
+    @param query: Function running a SQL query and returning all rows.
+    """
+
+    COLUMNS = "LocationID, LocationName, Coordinates, CreatedAt, DeletedAt"
+    CANDIDATE_FACTOR = 4
+
+    def __init__(self, query):
+        self.query = query
+
+    def _to_location(self, row):
+        location_id, location_name, coordinates, created_at, deleted_at = row
+        return {
+            'locationid': location_id,
+            'locationname': decode_location_name(location_name),
+            'coordinates': coordinates,
+            'createdat': created_at,
+            'deletedat': deleted_at
+        }
+
+    def nearest(self, lat, lon, k):
+        rows = self.query(f"""
+            SELECT {self.COLUMNS} FROM Locations
+            WHERE Coordinates->>'latitude' IS NOT NULL AND Coordinates->>'longitude' IS NOT NULL
+            ORDER BY {POSITION_SQL} <-> point(%s, %s)
+            LIMIT %s
+        """, (lon, lat, k * self.CANDIDATE_FACTOR))
+        locations = [self._to_location(row) for row in rows]
+        if not locations:
+            return []
+        distances = haversine_km(
+            lat, lon,
+            np.array([float(loc['coordinates']['latitude']) for loc in locations]),
+            np.array([float(loc['coordinates']['longitude']) for loc in locations]),
+        )
+        order = np.argsort(distances)[:k]
+        return [(locations[i], float(distances[i])) for i in order]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        if min_lon <= max_lon:
+            boxes = [(min_lon, min_lat, max_lon, max_lat)]
+        else:
+            boxes = [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon, max_lat)]
+        locations = []
+        for box in boxes:
+            rows = self.query(f"""
+                SELECT {self.COLUMNS} FROM Locations
+                WHERE {POSITION_SQL} <@ box(point(%s, %s), point(%s, %s))
+            """, box)
+            locations.extend(self._to_location(row) for row in rows)
+        return locations
@@ -0,0 +1,55 @@
+import argparse
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+  Small load test for the /getLocations endpoint. Run it against a server backed by a local PostgreSQL,
+  once before and once after a change, and compare the requests per second, e.g.
+      python database/location_load_test.py http://127.0.0.1:5000/getLocations --requests 2000
+      python database/location_load_test.py http://127.0.0.1:5000/getLocations --revalidate
+"""
+
+def fetch(url, gzip_enabled, etag):
+    """
+    Sends one request and returns the status code, body size and ETag of the response.
+    """
+    req = urllib.request.Request(url)
+    if gzip_enabled:
+        req.add_header('Accept-Encoding', 'gzip')
+    if etag:
+        req.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, len(response.read()), response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        # urllib raises for 304 Not Modified
+        return e.code, 0, e.headers.get('ETag')
+
+def run(url, requests, concurrency, gzip_enabled, revalidate):
+    etag = None
+    if revalidate:
+        _, _, etag = fetch(url, gzip_enabled, None)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda _: fetch(url, gzip_enabled, etag), range(requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"Requests: {requests}, concurrency: {concurrency}, elapsed: {elapsed:.2f}s")
+    print(f"Requests/sec: {requests / elapsed:.1f}")
+    print(f"Status codes: {statuses}")
+    print(f"Average body bytes: {sum(size for _, size, _ in results) / len(results):.0f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test for /getLocations')
+    parser.add_argument('url')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--no-gzip', action='store_true')
+    parser.add_argument('--revalidate', action='store_true', help='send If-None-Match like a repeat app launch')
+    args = parser.parse_args()
+    run(args.url, args.requests, args.concurrency, not args.no_gzip, args.revalidate)
@@ -0,0 +1,64 @@
+"""
+  Many beaches fall into the same cell of the Open-Meteo marine model. The marine API answers every request
+  with the coordinates of the grid cell it used (Latitude()/Longitude() of the response). Those coordinates are
+  stored on the location, so fetching, storing and forecasting can run once per cell and be fanned out to all
+  member locations.
+"""
+
+# Decimals used to compare grid cell coordinates, the API returns them as float32
+GRID_DECIMALS = 4
+
+
+def grid_key(latitude, longitude):
+    """
+    Key identifying a grid cell.
+    """
+    return round(float(latitude), GRID_DECIMALS), round(float(longitude), GRID_DECIMALS)
+
+
+def ensure_grid_columns(cur):
+    """
+    Adds the grid cell columns to databases created before they existed.
+    """
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS GridLatitude DECIMAL")
+    cur.execute("ALTER TABLE Locations ADD COLUMN IF NOT EXISTS GridLongitude DECIMAL")
+
+
+def store_grid_cell(cur, location_id, response):
+    """
+    Stores the grid cell an Open-Meteo response was computed for on the location.
+
+    @param response: A WeatherApiResponse of the marine API for the location.
+
+    @return: The grid key of the cell.
+    """
+    key = grid_key(response.Latitude(), response.Longitude())
+    cur.execute("""
+        UPDATE Locations SET GridLatitude = %s, GridLongitude = %s WHERE LocationID = %s
+    """, (key[0], key[1], location_id))
+    return key
+
+
+def get_grid_cells(cur, location_ids=None):
+    """
+    Groups locations by grid cell. Locations without a known cell form a cell of their own.
+
+    @param location_ids: Optional list of location ids to restrict the grouping to.
+
+    @return: A list of lists of location ids, every inner list is one cell ordered by location id.
+    """
+    if location_ids is None:
+        cur.execute("SELECT LocationID, GridLatitude, GridLongitude FROM Locations ORDER BY LocationID")
+    else:
+        cur.execute("""
+            SELECT LocationID, GridLatitude, GridLongitude FROM Locations
+            WHERE LocationID = ANY(%s) ORDER BY LocationID
+        """, (list(location_ids),))
+
+    cells = {}
+    for location_id, grid_latitude, grid_longitude in cur.fetchall():
+        if grid_latitude is None or grid_longitude is None:
+            cells[('location', location_id)] = [location_id]
+        else:
+            cells.setdefault(grid_key(grid_latitude, grid_longitude), []).append(location_id)
+    return list(cells.values())
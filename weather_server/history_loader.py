@@ -0,0 +1,187 @@
+import argparse
+import resource
+import time
+
+import numpy as np
+import psycopg2
+from psycopg2.extensions import DECIMAL, new_type, register_type
+
+from database.db_constants import DB_CONFIG, HOURLY_RETENTION_DAYS
+
+"""
+  Fast read path for the SeaConditions history used by training and scoring.
+
+  Only the needed columns are selected, already numeric and in time order, and streamed through a server-side
+  cursor straight into one preallocated float32 block. Each column is returned as a contiguous view of that
+  block, instead of a list of tuples of Decimal objects wrapped in an object DataFrame.
+"""
+
+DIRECTION_TO_ANGLE = {
+    'N': 0, 'NNE': 22.5, 'NE': 45, 'ENE': 67.5,
+    'E': 90, 'ESE': 112.5, 'SE': 135, 'SSE': 157.5,
+    'S': 180, 'SSW': 202.5, 'SW': 225, 'WSW': 247.5,
+    'W': 270, 'WNW': 292.5, 'NW': 315, 'NNW': 337.5
+}
+
+HISTORY_COLUMNS = [
+    'waveheight', 'windwaveheight', 'swellwaveheight', 'wavedirection',
+    'windwavedirection', 'swellwavedirection', 'waveperiod',
+    'windwaveperiod', 'swellwaveperiod', 'windwavepeakperiod',
+    'swellwavepeakperiod', 'windspeed', 'winddirection', 'weather'
+]
+
+# Columns stored as text which are converted to numbers in the query
+COLUMN_SQL = {
+    'winddirection': "CASE WindDirection "
+                     + " ".join(f"WHEN '{direction}' THEN {angle}" for direction, angle in DIRECTION_TO_ANGLE.items())
+                     + " END",
+    'weather': r"CASE WHEN Weather ~ '^-?[0-9]+(\.[0-9]+)?$' THEN Weather::float END",
+}
+
+FETCH_SIZE = 10000
+
+# Rollup tables written by retention.py and the hours covered by one of their rows
+ROLLUP_TABLES = [('SeaConditionsDaily', 24), ('SeaConditionsWeekly', 7 * 24)]
+
+DECIMAL_TO_FLOAT = new_type(DECIMAL.values, 'DECIMAL_TO_FLOAT', lambda value, cur: float(value) if value is not None else None)
+
+
+def register_decimal_typecaster():
+    """
+    Makes psycopg2 return DECIMAL columns as float instead of Decimal for every connection of the process.
+    """
+    register_type(DECIMAL_TO_FLOAT)
+
+
+def rollup_column(column, stat):
+    return f"{column}_{stat}"
+
+
+def rollup_history_sql(columns):
+    """
+    Expands the daily rollups, and the weekly rollups of weeks without daily rollups, to one row per hour.
+    """
+    (daily, daily_hours), (weekly, weekly_hours) = ROLLUP_TABLES
+    parts = []
+    for table, hours, uncovered in [
+        (daily, daily_hours, ""),
+        (weekly, weekly_hours, f"""WHERE NOT EXISTS (
+            SELECT 1 FROM {daily} d
+            WHERE d.LocationID = r.LocationID AND d.PeriodStart >= r.PeriodStart AND d.PeriodStart < r.PeriodStart + 7
+        )"""),
+    ]:
+        hour = "r.PeriodStart + h * interval '1 hour'"
+        select = ", ".join([f"({hour})::date", f"to_char({hour}, 'YYYY-MM-DD HH24:MI')", "r.LocationID"]
+                           + [f"r.{rollup_column(column, 'mean')}" for column in columns])
+        parts.append(f"SELECT {select} FROM {table} r CROSS JOIN generate_series(0, {hours - 1}) AS h {uncovered}")
+    return " UNION ALL ".join(parts)
+
+
+def history_source_sql(columns):
+    """
+    The history as a subquery with Date, TimeOfDay, LocationID and the given columns as floats.
+    """
+    select = ", ".join(["Date", "TimeOfDay", "LocationID"]
+                       + [f"({COLUMN_SQL.get(column, column)})::float8 AS {column}" for column in columns])
+    hourly = f"SELECT {select} FROM SeaConditions"
+    if HOURLY_RETENTION_DAYS is None:
+        return f"({hourly}) AS history"
+    return f"({hourly} UNION ALL {rollup_history_sql(columns)}) AS history"
+
+
+def history_sql(columns, where="LocationID = %s", keys=(), order_by="Date, TimeOfDay"):
+    """
+    Builds the query selecting the given columns as floats in time order, after the unconverted key columns.
+    """
+    select = ", ".join(list(keys) + list(columns))
+    return f"SELECT {select} FROM {history_source_sql(columns)} WHERE {where} ORDER BY {order_by}"
+
+
+def history_count_sql(where="LocationID = %s", keys=()):
+    """
+    Builds the query counting the history rows history_sql returns, per key columns if given.
+    """
+    select = ", ".join(list(keys) + ["COUNT(*)"])
+    group_by = f" GROUP BY {', '.join(keys)}" if keys else ""
+    return f"SELECT {select} FROM {history_source_sql([])} WHERE {where}{group_by}"
+
+
+def load_history(conn, location_id, columns=HISTORY_COLUMNS, fetch_size=FETCH_SIZE):
+    """
+    Loads the history of one location into float32 arrays.
+
+    @param conn: An open psycopg2 connection.
+    @param location_id: The location to load.
+    @param columns: The columns to load, lower case.
+    @param fetch_size: Number of rows transferred per round trip.
+
+    @return: A dictionary mapping every column to a float32 array in time order, NaN for missing values.
+    """
+    register_decimal_typecaster()
+    with conn.cursor() as cur:
+        cur.execute(history_count_sql(), (location_id,))
+        expected = cur.fetchone()[0]
+
+    # One row per column, so every column is a contiguous view
+    block = np.empty((len(columns), expected), dtype=np.float32)
+    size = 0
+    with conn.cursor(name=f"history_{location_id}") as cur:
+        cur.itersize = fetch_size
+        cur.execute(history_sql(columns), (location_id,))
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.float32).T
+            if size + chunk.shape[1] > block.shape[1]:
+                # Rows were inserted after counting
+                block = np.concatenate([block[:, :size], np.empty((len(columns), chunk.shape[1]), dtype=np.float32)], axis=1)
+            block[:, size:size + chunk.shape[1]] = chunk
+            size += chunk.shape[1]
+    conn.commit()
+
+    return {column: block[i, :size] for i, column in enumerate(columns)}
+
+
+def load_history_legacy(conn, location_id):
+    """
+    The previous read path of train_model, kept for the benchmark.
+    """
+    import pandas as pd
+
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM SeaConditions WHERE locationid = %s", (location_id,))
+    data = cur.fetchall()
+    colnames = [desc[0] for desc in cur.description]
+    df_location = pd.DataFrame(data, columns=colnames)
+    df_location['winddirection'] = df_location['winddirection'].map(DIRECTION_TO_ANGLE)
+    cur.close()
+    return {column: df_location[column].values.astype(float) for column in HISTORY_COLUMNS}
+
+
+if __name__ == "__main__":
+    """
+      Benchmark of the two read paths. Run each method in its own process so the peak RSS is not shared, e.g.
+          python history_loader.py --method legacy --locations 375,376,377
+          python history_loader.py --method fast --locations 375,376,377
+    """
+    parser = argparse.ArgumentParser(description="Benchmark SeaConditions history loading")
+    parser.add_argument("--method", choices=["legacy", "fast"], default="fast")
+    parser.add_argument("--locations", required=True, help="comma separated location ids")
+    args = parser.parse_args()
+
+    location_ids = [int(value) for value in args.locations.split(",")]
+    loader = load_history_legacy if args.method == "legacy" else load_history
+    conn = psycopg2.connect(**DB_CONFIG)
+    start = time.perf_counter()
+    rows = 0
+    for location_id in location_ids:
+        history = loader(conn, location_id)
+        rows += len(history['waveheight'])
+    elapsed = time.perf_counter() - start
+    conn.close()
+
+    print(f"Method: {args.method}")
+    print(f"Locations: {len(location_ids)}, rows: {rows}")
+    print(f"Load time: {elapsed:.2f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+
+from history_loader import HISTORY_COLUMNS, history_sql, register_decimal_typecaster
+
+"""
+  Local columnar copy of the SeaConditions history for model training.
+
+  Ingested history never changes, so it is synced once from PostgreSQL and then read locally. Every location
+  and month is one uncompressed Arrow IPC file, opened through a memory map so reading does not copy the data:
+
+      <directory>/location=<id>/<YYYY-MM>.arrow
+      <directory>/state.json    last synced TimeOfDay per location
+"""
+
+SCHEMA = pa.schema([('timeofday', pa.string())] + [(column, pa.float32()) for column in HISTORY_COLUMNS])
+
+
+class HistoryStore:
+    """
+    Memory-mapped, month-partitioned history of every location.
+
+    @param directory: The root directory of the store.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.state_path = os.path.join(directory, "state.json")
+        os.makedirs(directory, exist_ok=True)
+
+    def _location_dir(self, location_id):
+        return os.path.join(self.directory, f"location={location_id}")
+
+    def _read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _read_file(self, path):
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _write_month(self, location_id, month, table):
+        location_dir = self._location_dir(location_id)
+        os.makedirs(location_dir, exist_ok=True)
+        path = os.path.join(location_dir, f"{month}.arrow")
+        if os.path.exists(path):
+            table = pa.concat_tables([self._read_file(path), table])
+        tmp_path = f"{path}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, SCHEMA) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    def sync(self, conn, location_ids):
+        """
+        Appends the rows ingested since the last sync. Only rows with a TimeOfDay newer than the last synced
+        one of the location are transferred.
+
+        @param conn: An open psycopg2 connection.
+        @param location_ids: The locations to sync.
+
+        @return: The number of new rows.
+        """
+        register_decimal_typecaster()
+        state = self._read_state()
+        total = 0
+        for location_id in location_ids:
+            last = state.get(str(location_id), "")
+            with conn.cursor() as cur:
+                cur.execute(
+                    history_sql(HISTORY_COLUMNS, where="LocationID = %s AND TimeOfDay > %s", keys=["TimeOfDay"]),
+                    (location_id, last)
+                )
+                rows = cur.fetchall()
+            if not rows:
+                continue
+
+            times = [row[0] for row in rows]
+            values = np.array([row[1:] for row in rows], dtype=np.float32)
+            months = np.array([time_of_day[:7] for time_of_day in times])
+            for month in np.unique(months):
+                mask = months == month
+                arrays = [pa.array([t for t, m in zip(times, mask) if m], pa.string())]
+                arrays += [pa.array(values[mask, i]) for i in range(len(HISTORY_COLUMNS))]
+                self._write_month(location_id, month, pa.Table.from_arrays(arrays, schema=SCHEMA))
+
+            state[str(location_id)] = times[-1]
+            self._write_state(state)
+            total += len(rows)
+        conn.commit()
+        return total
+
+    def read_table(self, location_id, columns=HISTORY_COLUMNS):
+        """
+        Reads the history of one location as an Arrow table in time order, one chunk per month, without copying.
+        """
+        location_dir = self._location_dir(location_id)
+        if not os.path.isdir(location_dir):
+            return SCHEMA.empty_table().select(columns)
+        files = sorted(name for name in os.listdir(location_dir) if name.endswith(".arrow"))
+        tables = [self._read_file(os.path.join(location_dir, name)).select(columns) for name in files]
+        return pa.concat_tables(tables) if tables else SCHEMA.empty_table().select(columns)
+
+    def read(self, location_id, columns=HISTORY_COLUMNS):
+        """
+        Reads the history of one location as float32 NumPy arrays, the format returned by history_loader.load_history.
+        Arrays of a single month are views of the memory map, longer histories are combined into one array.
+        """
+        table = self.read_table(location_id, columns)
+        history = {}
+        for column in columns:
+            chunks = table.column(column).chunks
+            if len(chunks) == 1:
+                history[column] = chunks[0].to_numpy(zero_copy_only=True)
+            else:
+                history[column] = np.concatenate([chunk.to_numpy(zero_copy_only=True) for chunk in chunks]) \
+                    if chunks else np.empty(0, dtype=np.float32)
+        return history
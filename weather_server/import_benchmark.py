@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+"""
+  Cold-start cost of every entry point, measured with python -X importtime in a fresh interpreter per module.
+
+      python import_benchmark.py
+      python import_benchmark.py --json import_times.json
+      python import_benchmark.py --baseline import_times.json
+
+  Besides the import time the report lists which heavy libraries an import pulled in. Importing an entry point
+  should not load TensorFlow, statsmodels or pandas, they are imported where they are used.
+"""
+
+ENTRY_POINTS = [
+    'pipeline', 'weather_request', 'prediction_calculation', 'quality_calculation', 'beach_request',
+    'backtest', 'retention', 'rescore_backfill', 'history_loader', 'model_export', 'parity_check', 'training_budget', 'TimeSeriesPredictor',
+    'lstm_time_series_predictor', 'database.database_creation', 'database.location_getter',
+    'database.forecast_getter',
+]
+
+HEAVY_MODULES = ['tensorflow', 'keras', 'statsmodels', 'pandas', 'sklearn']
+
+# Slowdown against the baseline reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+
+def parse_importtime(output):
+    """
+    Parses the -X importtime report.
+
+    @return: List of (module, self microseconds, cumulative microseconds, nesting level) in report order.
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return entries
+
+
+def measure(module, repeats=3):
+    """
+    Imports a module in fresh interpreters and keeps the fastest run.
+
+    @return: Dictionary with the import time in milliseconds, the heavy libraries loaded and the slowest modules.
+    """
+    best = None
+    for _ in range(repeats):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+        )
+        entries = parse_importtime(process.stderr)
+        if process.returncode != 0:
+            error = [line for line in process.stderr.splitlines() if not line.startswith('import time:')]
+            return {'module': module, 'error': error[-1] if error else f'exit code {process.returncode}'}
+
+        # Top level imports, including those of the interpreter startup
+        total = sum(cumulative for _, _, cumulative, level in entries if level == 0)
+        if best is None or total < best['milliseconds'] * 1000:
+            loaded = {name.split('.')[0] for name, _, _, _ in entries}
+            slowest = sorted(entries, key=lambda entry: entry[1], reverse=True)[:5]
+            best = {
+                'module': module,
+                'milliseconds': total / 1000,
+                'heavy_modules': [name for name in HEAVY_MODULES if name in loaded],
+                'slowest': [{'module': name, 'self_milliseconds': self_us / 1000} for name, self_us, _, _ in slowest],
+            }
+    return best
+
+
+def compare(results, baseline):
+    """
+    Lists the entry points which got slower than the baseline or started loading a heavy library.
+    """
+    previous = {entry['module']: entry for entry in baseline if 'error' not in entry}
+    regressions = []
+    for entry in results:
+        before = previous.get(entry['module'])
+        if before is None or 'error' in entry:
+            continue
+        if entry['milliseconds'] > before['milliseconds'] * (1 + REGRESSION_TOLERANCE):
+            regressions.append(f"{entry['module']}: {before['milliseconds']:.0f} ms -> {entry['milliseconds']:.0f} ms")
+        for name in set(entry['heavy_modules']) - set(before['heavy_modules']):
+            regressions.append(f"{entry['module']}: now imports {name}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time of the entry points")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --json")
+    args = parser.parse_args()
+
+    results = [measure(module, args.repeats) for module in args.modules]
+    for entry in results:
+        if 'error' in entry:
+            print(f"{entry['module']:32} failed: {entry['error']}")
+        else:
+            heavy = ', '.join(entry['heavy_modules']) or '-'
+            print(f"{entry['module']:32} {entry['milliseconds']:8.1f} ms   heavy: {heavy}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print("Regression:", regression)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if regressions else 0)
@@ -1,6 +1,5 @@
-from keras.callbacks import EarlyStopping
+from keras.callbacks import Callback, EarlyStopping
 from math import sqrt
-import pandas as pd
 import numpy as np
 from keras.models import Sequential
 from keras.layers import Bidirectional, LSTM, Dense, Dropout, Input
@@ -9,6 +8,30 @@ from datetime import datetime
 from sklearn.metrics import mean_absolute_error, mean_squared_error
 import tensorflow as tf
 from sklearn.model_selection import KFold
+import time
+
+import metrics
+
+class TimeBudget(Callback):
+    """
+    Keras callback stopping training at the end of the batch in which the deadline passed, so a long epoch
+    does not overrun it.
+
+    Parameters:
+    deadline (float): time.monotonic() value after which training stops.
+    """
+
+    def __init__(self, deadline):
+        super().__init__()
+        self.deadline = deadline
+
+    def on_train_batch_end(self, batch, logs=None):
+        if time.monotonic() >= self.deadline:
+            self.model.stop_training = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        if time.monotonic() >= self.deadline:
+            self.model.stop_training = True
 
 class LSTMTimeSeriesPredictor:
     """
@@ -40,6 +63,8 @@ class LSTMTimeSeriesPredictor:
         self.batch_size = batch_size
         self.dropout_rate = dropout_rate
         self.neurons = neurons
+        self.models = {}
+        self.epochs_run = {}
         self.model = Sequential()
         self.model.add(Input(shape=(1, look_back)))
         self.model.add(Bidirectional(LSTM(neurons, return_sequences=True)))
@@ -143,28 +168,56 @@ class LSTMTimeSeriesPredictor:
             predictions.append(prediction)
         return predictions
 
-    def train_and_predict(self, df, target_columns, steps):
+    def train_and_predict(self, df, target_columns, steps, time_budget=None):
         """
         Trains the model on the data and generates predictions.
 
         Parameters:
-        df (pd.DataFrame): The dataframe containing the time series data.
+        df (pd.DataFrame): The dataframe containing the time series data, or any mapping of column names to
+            arrays such as HistoryStore.read.
         target_columns (List[str]): The columns in the dataframe to predict.
         steps (int): The number of future time steps to predict.
+        time_budget (float): Optional number of seconds for training all columns. Every column gets an equal
+            share plus whatever the previous columns left unused, training stops when it runs out and columns
+            reached after the budget is used up are left out of the result.
 
         Returns:
         Dict[str, List[float]]: A dictionary mapping column names to their predicted values.
         """
         predictions = {}
-        for column in target_columns:
+        start = time.monotonic()
+        for i, column in enumerate(target_columns):
+            deadline = None
+            if time_budget is not None:
+                deadline = start + time_budget * (i + 1) / len(target_columns)
+                if time.monotonic() >= deadline:
+                    print(f"{datetime.now()}: Training budget used up, skipping {column}")
+                    continue
             try:
                 # Initialize a new model for each column
                 model = self._initialize_model()
-                predictions[column] = self._fit_and_predict(model, df[column].values.astype(float), steps)
+                predictions[column] = self._fit_and_predict(model, np.asarray(df[column], dtype=float), steps, deadline, column)
+                self.models[column] = model
             except Exception as exc:
                 print('%r generated an exception: %s' % (column, exc))
         return predictions
 
+    def export(self, directory, df, quantization="none", keep_keras=False):
+        """
+        Exports the models trained by train_and_predict to TFLite for lightweight inference.
+
+        Parameters:
+        directory (str): The output directory for this location.
+        df (pd.DataFrame): The dataframe the models were trained on.
+        quantization (str): 'none', 'dynamic' or 'int8'.
+        keep_keras (bool): Also saves the Keras models next to the TFLite ones.
+
+        Returns:
+        Dict: The manifest of the exported models.
+        """
+        from model_export import export_models
+        return export_models(self.models, df, directory, self.look_back, quantization=quantization, keep_keras=keep_keras)
+
     def _initialize_model(self):
         """
         Initializes a new model.
@@ -188,7 +241,7 @@ class LSTMTimeSeriesPredictor:
         model.compile(loss='mean_squared_error', optimizer=optimizer)
         return model
 
-    def _fit_and_predict(self, model, y, steps):
+    def _fit_and_predict(self, model, y, steps, deadline=None, column=None):
         """
         Fits the model to the given data and generates predictions.
 
@@ -196,6 +249,8 @@ class LSTMTimeSeriesPredictor:
         model (keras.models.Sequential): The model to fit.
         y (np.array): The time series data.
         steps (int): The number of future time steps to predict.
+        deadline (float): Optional time.monotonic() value after which training stops, shared between the folds.
+        column (str): The name of the column, used to count the epochs run.
 
         Returns:
         List[float]: The predicted values.
@@ -211,17 +266,29 @@ class LSTMTimeSeriesPredictor:
         kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
         # Initialize results
         results = []
+        fold_start = time.monotonic()
 
         # Loop over the folds
-        for train_index, test_index in kf.split(X):
+        for fold, (train_index, test_index) in enumerate(kf.split(X)):
+            # The remaining folds only refine the error estimate, the model of the folds run so far is kept
+            if deadline is not None and results and time.monotonic() >= deadline:
+                print(f"{datetime.now()}: Training budget used up after {fold} folds for {column}")
+                break
+
             # Split the data
             X_train, X_test = X[train_index], X[test_index]
             Y_train, Y_test = Y[train_index], Y[test_index]
 
             # Early stopping
             early_stopping = EarlyStopping(monitor='val_loss', patience=10, verbose=1, restore_best_weights=True)
+            callbacks = [early_stopping]
+            if deadline is not None:
+                # Every fold gets its share of the column budget plus what the previous folds left
+                callbacks.append(TimeBudget(fold_start + (deadline - fold_start) * (fold + 1) / n_splits))
             # Fit the model
-            history = model.fit(X_train, Y_train, epochs=self.epochs, batch_size=self.batch_size, validation_data=(X_test, Y_test), callbacks=[early_stopping], verbose=0)
+            with metrics.timer('fit_seconds', model='lstm'):
+                history = model.fit(X_train, Y_train, epochs=self.epochs, batch_size=self.batch_size, validation_data=(X_test, Y_test), callbacks=callbacks, verbose=0)
+            self.epochs_run[column] = self.epochs_run.get(column, 0) + len(history.epoch)
 
             # Calculate error metrics on the test set
             Y_pred = model.predict(X_test)
@@ -240,9 +307,10 @@ class LSTMTimeSeriesPredictor:
 
         # Make predictions
         predictions = []
-        for _ in range(steps):
-            x = np.reshape(y[-self.look_back:], (1, 1, self.look_back))
-            prediction = model.predict(x)
-            y = np.append(y, prediction)
-            predictions.append(prediction)
+        with metrics.timer('rollout_seconds', model='lstm'):
+            for _ in range(steps):
+                x = np.reshape(y[-self.look_back:], (1, 1, self.look_back))
+                prediction = model.predict(x)
+                y = np.append(y, prediction)
+                predictions.append(prediction)
         return predictions
@@ -3,14 +3,12 @@ try {
     $start_time = microtime(true);
 
     putenv('TF_ENABLE_ONEDNN_OPTS=0');
-    // Install the Python requirements
-    shell_exec('pip install --upgrade pip');
-    shell_exec('pip install -r requirements.txt');
+    // Dependencies are installed once when the environment is built (see startup.sh), not on every run.
 
     // Execute the second Python script
-    $prediction_output = shell_exec('python prediction_calculation.py');
+    $prediction_output = shell_exec('python pipeline.py run --only forecast 2>&1');
     if ($prediction_output === null) {
-        throw new Exception("Failed to execute 'python prediction_calculation.py'");
+        throw new Exception("Failed to execute 'python pipeline.py run --only forecast'");
     }
 
     // Print the output of the second Python script
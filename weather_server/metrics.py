@@ -0,0 +1,268 @@
+import cProfile
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from database.db_constants import METRICS_DIR
+
+"""
+  Counters, timers and per-location figures of a run, written to a JSON run report and a Prometheus textfile.
+
+  Every process keeps its own registry and flushes it to <METRICS_DIR>/<run id>/process-<pid>.json after each unit
+  of work, so nothing is lost when a pool worker exits without running atexit handlers. The process that
+  started the run merges those files at the end:
+
+      <METRICS_DIR>/<run id>/report.json     totals, per-location figures and peak RSS of every process
+      <METRICS_DIR>/weather_server.prom      totals for the node_exporter textfile collector
+
+  The run id and the profiled locations are passed to child processes through the environment. Profiling is
+  opt-in: locations listed in METRICS_PROFILE_LOCATIONS (comma separated) get a cProfile dump and, when
+  TensorFlow is installed, a TensorFlow profiler trace in <METRICS_DIR>/<run id>/profiles.
+"""
+
+PREFIX = "weather_server"
+RUN_ID_VARIABLE = "METRICS_RUN_ID"
+PROFILE_VARIABLE = "METRICS_PROFILE_LOCATIONS"
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_locations = {}
+
+
+def reset():
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+    _timers.clear()
+    _locations.clear()
+
+
+# A forked worker starts with a copy of the parent registry, which the parent reports itself
+os.register_at_fork(after_in_child=reset)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """
+    Adds to a counter, e.g. increment('rows_written', len(rows), table='seaconditions').
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """
+    Records one duration of a timer. Timers keep count, sum and maximum.
+    """
+    key = _key(name, labels)
+    with _lock:
+        count, total, maximum = _timers.get(key, (0, 0.0, 0.0))
+        _timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Times the enclosed block, also when it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def record_location(location_id, **values):
+    """
+    Adds figures of one location to the run report, numbers are summed over repeated calls.
+    """
+    with _lock:
+        entry = _locations.setdefault(str(location_id), {})
+        for name, value in values.items():
+            entry[name] = entry.get(name, 0) + value
+
+
+def run_id():
+    return os.environ.get(RUN_ID_VARIABLE)
+
+
+def start_run(profile_locations=None):
+    """
+    Starts a run in this process and its children unless a parent already started one.
+
+    @param profile_locations: Optional location ids to profile.
+
+    @return: True when this process started the run and has to write the report.
+    """
+    if profile_locations:
+        os.environ[PROFILE_VARIABLE] = ",".join(str(location_id) for location_id in profile_locations)
+    if run_id():
+        return False
+    os.environ[RUN_ID_VARIABLE] = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    return True
+
+
+def _run_dir():
+    return os.path.join(METRICS_DIR, run_id())
+
+
+def profiled_locations():
+    value = os.environ.get(PROFILE_VARIABLE, "")
+    return {int(location_id) for location_id in value.split(",") if location_id}
+
+
+@contextmanager
+def profile(location_id):
+    """
+    Profiles the enclosed block when the location was selected for profiling, otherwise does nothing.
+    """
+    if not METRICS_DIR or not run_id() or location_id not in profiled_locations():
+        yield
+        return
+
+    directory = os.path.join(_run_dir(), "profiles")
+    os.makedirs(directory, exist_ok=True)
+    # TensorFlow is otherwise only loaded inside the block, importing it here makes its trace cover the training
+    try:
+        import tensorflow as tf
+    except ImportError:
+        tf_profiler = None
+    else:
+        tf_profiler = tf.profiler.experimental
+        tf_profiler.start(os.path.join(directory, f"tf-{location_id}"))
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(directory, f"location-{location_id}.prof"))
+        if tf_profiler is not None:
+            tf_profiler.stop()
+
+
+def snapshot():
+    """
+    The registry of this process in the format of the process files.
+    """
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            "timers": [[name, dict(labels), list(values)] for (name, labels), values in _timers.items()],
+            "locations": {location_id: dict(entry) for location_id, entry in _locations.items()},
+        }
+
+
+def flush():
+    """
+    Writes the registry of this process to its file in the run directory.
+    """
+    if not METRICS_DIR or not run_id():
+        return
+    os.makedirs(_run_dir(), exist_ok=True)
+    path = os.path.join(_run_dir(), f"process-{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def merge(processes):
+    """
+    Combines the snapshots of all processes of a run.
+    """
+    counters = {}
+    timers = {}
+    locations = {}
+    for process in processes:
+        for name, labels, value in process["counters"]:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, (count, total, maximum) in process["timers"]:
+            key = _key(name, labels)
+            previous = timers.get(key, (0, 0.0, 0.0))
+            timers[key] = (previous[0] + count, previous[1] + total, max(previous[2], maximum))
+        for location_id, entry in process["locations"].items():
+            merged = locations.setdefault(location_id, {})
+            for name, value in entry.items():
+                merged[name] = merged.get(name, 0) + value
+    return counters, timers, locations
+
+
+def _labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+def prometheus_text(counters, timers, peak_rss_bytes, finished):
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{PREFIX}_{name}_total{_labels(labels)} {value}")
+    for name in sorted({name for name, _ in timers}):
+        lines.append(f"# TYPE {PREFIX}_{name} summary")
+        for (metric, labels), (count, total, maximum) in sorted(timers.items()):
+            if metric == name:
+                lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {count}")
+                lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{PREFIX}_{name}{_labels(labels, quantile='1')} {maximum}")
+    lines.append(f"# TYPE {PREFIX}_peak_rss_bytes gauge")
+    lines.append(f"{PREFIX}_peak_rss_bytes {peak_rss_bytes}")
+    lines.append(f"# TYPE {PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{PREFIX}_last_run_timestamp_seconds {finished}")
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report():
+    """
+    Merges the files of every process of the run and writes the JSON report and the Prometheus textfile.
+    Called by the process that started the run, after its workers finished.
+
+    @return: The path of the JSON report, None when metrics are disabled.
+    """
+    if not METRICS_DIR or not run_id():
+        return None
+    flush()
+    processes = []
+    for path in glob.glob(os.path.join(_run_dir(), "process-*.json")):
+        with open(path) as f:
+            processes.append(json.load(f))
+    counters, timers, locations = merge(processes)
+    finished = time.time()
+    peak_rss_bytes = max(process["peak_rss_bytes"] for process in processes)
+
+    report = {
+        "run_id": run_id(),
+        "finished": finished,
+        "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(counters.items())],
+        "timers": [{"name": name, "labels": dict(labels), "count": count, "sum": total, "max": maximum}
+                   for (name, labels), (count, total, maximum) in sorted(timers.items())],
+        "locations": locations,
+        "processes": [{"pid": process["pid"], "peak_rss_bytes": process["peak_rss_bytes"]} for process in processes],
+        "peak_rss_bytes": peak_rss_bytes,
+    }
+    report_path = os.path.join(_run_dir(), "report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    prom_path = os.path.join(METRICS_DIR, f"{PREFIX}.prom")
+    with open(f"{prom_path}.tmp", "w") as f:
+        f.write(prometheus_text(counters, timers, peak_rss_bytes, finished))
+    os.replace(f"{prom_path}.tmp", prom_path)
+    print(f"Run report written to {report_path}")
+    return report_path
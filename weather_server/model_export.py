@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy as np
+
+import metrics
+
+"""
+  Export trained LSTMTimeSeriesPredictor models to TensorFlow Lite and run the forecast rollout from the
+  exported files. Cells the backtest did not flag for retraining are rolled forward with the exported models,
+  those forecast processes only need the small LiteRT interpreter instead of the full TensorFlow/Keras runtime.
+  Cells that are retrained load TensorFlow for training anyway and keep the Keras rollout.
+
+  Layout of an exported location directory:
+      manifest.json        look back, and the quantization and seed window of every column
+      <column>.tflite      converted model used for inference
+      <column>.keras       original model, only with keep_keras for the Keras benchmark
+
+  The parity of the exported models against Keras is checked by parity_check.py, not by the nightly export.
+"""
+
+MANIFEST_FILE = "manifest.json"
+
+
+def get_interpreter_class():
+    """
+    Returns the TFLite interpreter class. The standalone LiteRT package (ai-edge-litert, formerly
+    tflite_runtime) is preferred because it does not pull the whole TensorFlow runtime into memory.
+    """
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def unrolled(model):
+    """
+    Copy of the model with its recurrent layers unrolled. The inputs hold a single time step, so the copy computes
+    the same, but it converts to builtin TFLite ops instead of a while loop over tensor lists, which the converter
+    can not lower.
+    """
+    import keras
+
+    def clone_layer(layer):
+        config = layer.get_config()
+        if isinstance(layer, keras.layers.Bidirectional):
+            config["layer"]["config"]["unroll"] = True
+            if "backward_layer" in config:
+                config["backward_layer"]["config"]["unroll"] = True
+        elif isinstance(layer, keras.layers.RNN):
+            config["unroll"] = True
+        return layer.__class__.from_config(config)
+
+    clone = keras.models.clone_model(model, clone_function=clone_layer)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+def convert_model(model, quantization="dynamic", representative_data=None):
+    """
+    Converts a Keras model to a TFLite flatbuffer.
+
+    @param model: The trained keras model.
+    @param quantization: 'none', 'dynamic' (dynamic-range weights) or 'int8' (calibrated with representative_data).
+    @param representative_data: Array of model inputs of shape (n, 1, look_back), required for 'int8'.
+
+    @return: The serialized TFLite model as bytes.
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(unrolled(model))
+    if quantization == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "int8":
+        if representative_data is None:
+            raise ValueError("int8 quantization needs representative data")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: (
+            [sample[np.newaxis].astype(np.float32)] for sample in representative_data[:200]
+        )
+    elif quantization != "none":
+        raise ValueError(f"Unknown quantization: {quantization}")
+    return converter.convert()
+
+
+def keras_rollout(model, y, look_back, steps):
+    """
+    Reference rollout through keras.Model.predict, same as LSTMTimeSeriesPredictor._fit_and_predict.
+    """
+    y = np.asarray(y, dtype=float)
+    predictions = []
+    for _ in range(steps):
+        x = np.reshape(y[-look_back:], (1, 1, look_back))
+        prediction = model.predict(x, verbose=0)
+        y = np.append(y, prediction)
+        predictions.append(prediction.item())
+    return np.array(predictions)
+
+
+class TFLiteForecaster:
+    """
+    Loads the exported TFLite models of one location and produces the autoregressive rollout.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.look_back = self.manifest["look_back"]
+        Interpreter = get_interpreter_class()
+        self.interpreters = {}
+        for column, entry in self.manifest["columns"].items():
+            interpreter = Interpreter(model_path=os.path.join(directory, entry["tflite"]))
+            interpreter.allocate_tensors()
+            self.interpreters[column] = interpreter
+
+    def rollout(self, column, y, steps):
+        """
+        Predicts the next steps of one column from its history.
+
+        @param column: The column to predict.
+        @param y: The history of the column, at least look_back values.
+        @param steps: The number of future time steps to predict.
+
+        @return: np.array of predicted values.
+        """
+        interpreter = self.interpreters[column]
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+
+        window = np.array(y[-self.look_back:], dtype=np.float32)
+        x = np.empty((1, 1, self.look_back), dtype=np.float32)
+        predictions = np.empty(steps, dtype=np.float32)
+        with metrics.timer('rollout_seconds', model='tflite'):
+            for i in range(steps):
+                x[0, 0, :] = window
+                interpreter.set_tensor(input_index, x)
+                interpreter.invoke()
+                prediction = interpreter.get_tensor(output_index)[0, 0]
+                predictions[i] = prediction
+                window[:-1] = window[1:]
+                window[-1] = prediction
+        return predictions
+
+    def predict(self, df, target_columns, steps):
+        """
+        Generates predictions for all target columns, same output shape as
+        LSTMTimeSeriesPredictor.train_and_predict.
+
+        @param df: The dataframe (or mapping of arrays) holding the history of every column.
+        @param target_columns: The columns to predict.
+        @param steps: The number of future time steps to predict.
+
+        @return: A dictionary mapping column names to their predicted values.
+        """
+        predictions = {}
+        for column in target_columns:
+            try:
+                predictions[column] = self.rollout(column, np.asarray(df[column], dtype=np.float32), steps)
+            except Exception as exc:
+                print('%r generated an exception: %s' % (column, exc))
+        return predictions
+
+
+def export_models(models, df, directory, look_back, quantization="none", keep_keras=False):
+    """
+    Exports the trained model of every column to TFLite. The entries of columns exported earlier and not in
+    models are kept, so a partly trained location still rolls every column forward.
+
+    @param models: Dictionary mapping column names to trained keras models.
+    @param df: The dataframe the models were trained on.
+    @param directory: The output directory for this location.
+    @param look_back: The look back the models were trained with.
+    @param quantization: Quantization mode passed to convert_model. Quantized weights drift from Keras over
+        the autoregressive rollout, see parity_check.py, so the full precision model is the default.
+    @param keep_keras: Also saves the Keras models, needed by the Keras backend of benchmark.
+
+    @return: The manifest written to the directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {"look_back": look_back, "quantization": quantization, "columns": {}}
+    # Columns the time budget did not reach keep their earlier models, unless those used another look back
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            previous = json.load(f)
+        if previous.get("look_back") == look_back:
+            manifest["columns"].update({column: entry for column, entry in previous["columns"].items()
+                                        if column not in models})
+    except (OSError, ValueError, KeyError):
+        pass
+
+    for column, model in models.items():
+        y = np.asarray(df[column], dtype=float)
+        representative_data = None
+        if quantization == "int8":
+            representative_data = np.stack([y[i:i + look_back] for i in range(len(y) - look_back)])[:, np.newaxis, :]
+
+        tflite_file = f"{column}.tflite"
+        with open(os.path.join(directory, tflite_file), "wb") as f:
+            f.write(convert_model(model, quantization, representative_data))
+        manifest["columns"][column] = {"tflite": tflite_file, "quantization": quantization,
+                                       "seed_window": y[-look_back:].tolist()}
+        if keep_keras:
+            manifest["columns"][column]["keras"] = f"{column}.keras"
+            model.save(os.path.join(directory, f"{column}.keras"))
+
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def parity_errors(models, df, directory, look_back, steps=72):
+    """
+    Compares the rollout of the exported TFLite models with the Keras rollout on the training history.
+
+    @param models: Dictionary mapping column names to the trained keras models that were exported.
+    @param df: The dataframe the models were trained on.
+    @param directory: The exported location directory.
+    @param look_back: The look back the models were trained with.
+    @param steps: Number of rollout steps compared.
+
+    @return: Dictionary mapping column names to the maximum absolute difference.
+    """
+    forecaster = TFLiteForecaster(directory)
+    errors = {}
+    for column, model in models.items():
+        y = np.asarray(df[column], dtype=float)
+        expected = keras_rollout(model, y, look_back, steps)
+        actual = forecaster.rollout(column, y, steps)
+        errors[column] = float(np.max(np.abs(expected - actual)))
+    return errors
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process. VmHWM starts over on exec, ru_maxrss is the fallback where /proc is
+    missing but also counts the peak of the parent which started the process.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(directory, backend, steps=72, repeats=5):
+    """
+    Measures rollout latency and peak RSS of one backend for an exported location. Run each backend in
+    its own process, otherwise the RSS of the first one leaks into the second.
+
+    @param directory: The exported location directory.
+    @param backend: 'tflite' or 'keras'.
+    @param steps: Number of rollout steps.
+    @param repeats: Number of timed rollouts per column.
+
+    @return: Dictionary with load time, mean rollout latency per column and peak RSS in MB.
+    """
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    look_back = manifest["look_back"]
+
+    start = time.perf_counter()
+    if backend == "tflite":
+        forecaster = TFLiteForecaster(directory)
+        run = lambda column, y: forecaster.rollout(column, y, steps)
+    elif backend == "keras":
+        if any("keras" not in entry for entry in manifest["columns"].values()):
+            raise ValueError("The Keras models were not kept, export with keep_keras=True")
+        import keras
+        models = {column: keras.models.load_model(os.path.join(directory, entry["keras"]))
+                  for column, entry in manifest["columns"].items()}
+        run = lambda column, y: keras_rollout(models[column], y, look_back, steps)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    for column, entry in manifest["columns"].items():
+        y = np.array(entry["seed_window"], dtype=float)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run(column, y)
+            latencies.append(time.perf_counter() - start)
+
+    return {
+        "backend": backend,
+        "load_seconds": load_time,
+        "rollout_seconds": float(np.mean(latencies)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    """
+      Benchmark an exported location, e.g.
+          python model_export.py models/375 --backend tflite
+          python model_export.py models/375 --backend keras
+    """
+    parser = argparse.ArgumentParser(description="Benchmark exported forecaster models")
+    parser.add_argument("directory")
+    parser.add_argument("--backend", choices=["tflite", "keras"], default="tflite")
+    parser.add_argument("--steps", type=int, default=72)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.directory, args.backend, args.steps), indent=2))
@@ -0,0 +1,101 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+"""
+  Parity of the TFLite export against Keras, kept out of the nightly training run.
+
+      python parity_check.py
+      python parity_check.py --quantization dynamic --tolerance 3
+      python parity_check.py --location 375
+      python parity_check.py --benchmark
+
+  Trains a small forecaster on synthetic conditions, or on the history of a location, exports it like the
+  nightly run does and compares the TFLite rollout with the Keras rollout. Exits with 1 when the difference of
+  any column is above the tolerance. --benchmark also measures the rollout latency and peak RSS of both backends
+  with model_export.benchmark, each in a fresh process. test_model_export.py runs the parity check as a test.
+"""
+
+# Largest accepted absolute difference between the Keras and the TFLite rollout, in the unit of the column
+PARITY_TOLERANCE = 0.05
+
+SYNTHETIC_COLUMNS = ['wave_height', 'swell_wave_period', 'wind_kph']
+
+
+def synthetic_history(hours, seed=0):
+    import synthetic_data
+
+    start = datetime.datetime(2024, 1, 1)
+    conditions = synthetic_data.generate_conditions(start, hours, synthetic_data.rng_for("parity", seed))
+    return {column: conditions[column] for column in SYNTHETIC_COLUMNS}, SYNTHETIC_COLUMNS
+
+
+def location_history(location_id):
+    import psycopg2
+
+    from database.db_constants import DB_CONFIG
+    from history_loader import HISTORY_COLUMNS, load_history
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        return load_history(conn, location_id, HISTORY_COLUMNS), HISTORY_COLUMNS
+    finally:
+        conn.close()
+
+
+def run_benchmark(directory, steps):
+    """
+    Benchmarks both backends of an export in their own processes, so their RSS does not mix.
+
+    @return: List of benchmark results.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_export.py")
+    results = []
+    for backend in ["keras", "tflite"]:
+        output = subprocess.run([sys.executable, script, directory, "--backend", backend, "--steps", str(steps)],
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output[output.index("{"):]))
+    return results
+
+
+def check(history, columns, quantization, steps, epochs, benchmark=False):
+    """
+    Trains, exports and compares every column.
+
+    @return: (dictionary mapping column names to the maximum absolute difference, benchmark results or None).
+    """
+    from keras import optimizers
+    from lstm_time_series_predictor import LSTMTimeSeriesPredictor
+    from model_export import parity_errors
+
+    regression = LSTMTimeSeriesPredictor(optimizer=optimizers.Adam(learning_rate=0.001), look_back=16,
+                                         epochs=epochs, batch_size=16, neurons=64)
+    regression.train_and_predict(history, target_columns=columns, steps=steps)
+    with tempfile.TemporaryDirectory() as directory:
+        regression.export(directory, history, quantization=quantization, keep_keras=benchmark)
+        errors = parity_errors(regression.models, history, directory, regression.look_back, steps)
+        return errors, run_benchmark(directory, steps) if benchmark else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the TFLite export against Keras")
+    parser.add_argument("--location", type=int, help="train on the history of this location instead of synthetic data")
+    parser.add_argument("--hours", type=int, default=24 * 90, help="hours of synthetic history")
+    parser.add_argument("--quantization", choices=["none", "dynamic", "int8"], default="none")
+    parser.add_argument("--steps", type=int, default=72)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE)
+    parser.add_argument("--benchmark", action="store_true", help="also measure latency and RSS of both backends")
+    args = parser.parse_args()
+
+    history, columns = location_history(args.location) if args.location else synthetic_history(args.hours)
+    errors, benchmarks = check(history, columns, args.quantization, args.steps, args.epochs, args.benchmark)
+    print(json.dumps({"max_abs_error": errors, "benchmark": benchmarks}, indent=2))
+    failed = [column for column, error in errors.items() if error > args.tolerance]
+    for column in failed:
+        print(f"Parity failed: {column} differs by {errors[column]:.4f}, tolerance {args.tolerance}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,276 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# The server modules import each other by their plain names, also when started as weather_server.pipeline
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import psycopg2
+import requests
+
+from database.db_constants import (DB_CONFIG, FORECAST_RELOAD_TOKEN_VARIABLE, FORECAST_RELOAD_URL, HISTORY_DIR,
+                                   PIPELINE_STATE_DIR, TRAINING_DEADLINE)
+import metrics
+import prediction_calculation
+import quality_calculation
+import weather_request
+from training_budget import write_report
+
+"""
+  Nightly pipeline replacing startup.sh and the PHP wrappers:
+
+      python -m weather_server.pipeline run
+      python -m weather_server.pipeline run --from forecast
+      python -m weather_server.pipeline run --only score
+
+  The run is a DAG of three stages partitioned by grid cell and location:
+
+      ingest:<cell>  ->  forecast:<cell>  ->  score:<location>  (every member location of the cell)
+
+  A cell is named after its smallest location id. A task starts as soon as its upstream partition is done, so
+  the first cells are scored while others are still being ingested. Every finished task is written to the
+  checkpoint of the run day, running the pipeline again the same day resumes with the tasks that are left.
+  Tasks of stages that are not selected count as done. The beach rankings need every location, they are
+  rebuilt once the score tasks ran.
+"""
+
+STAGES = ['ingest', 'forecast', 'score']
+
+Task = namedtuple('Task', ['stage', 'partition', 'function', 'args', 'upstream'])
+
+
+def task_id(stage, partition):
+    return f"{stage}:{partition}"
+
+
+def run_ingest(key, location_ids, start_date_str, marine=None):
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            stored = weather_request.ingest_cell(cur, key, location_ids, start_date_str, marine)
+        conn.commit()
+    finally:
+        conn.close()
+        metrics.flush()
+    return {'locations': stored}
+
+
+def run_forecast(member_ids, time_budget, deadline, retrain):
+    with metrics.profile(member_ids[0]):
+        report = prediction_calculation.train_model(member_ids[0], member_ids, time_budget, deadline, retrain)
+    if report['mode'] == 'failed':
+        raise RuntimeError(report['error'])
+    return report
+
+
+def run_score(location_id):
+    quality_calculation.process_location(location_id)
+    return {}
+
+
+class Checkpoint:
+    """
+    Finished and failed tasks of one run day, saved after every task.
+
+    @param path: The JSON file of the run day.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.done = state.get('done', {})
+        # Failed tasks are retried by the next run, they are only kept for the record
+        self.failed = {}
+
+    def mark_done(self, task, result):
+        self.done[task_id(task.stage, task.partition)] = result
+        self.failed.pop(task_id(task.stage, task.partition), None)
+        self.save()
+
+    def mark_failed(self, task, error):
+        self.failed[task_id(task.stage, task.partition)] = error
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'done': self.done, 'failed': self.failed}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def plan(stages, start_date_str, deadline, retrain_all, workers):
+    """
+    Builds the tasks of a run, in the order they should be started.
+
+    @param stages: The selected stages, tasks of the other stages are still planned so dependencies resolve.
+    @param start_date_str: The day ingested, YYYY-MM-DD.
+    @param deadline: Optional wall clock time (time.time()) the run has to finish by.
+    @param retrain_all: True retrains every cell, not only those that drifted.
+    @param workers: Number of worker processes.
+
+    @return: Dictionary mapping task ids to Task.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            # Cells of new locations are only requested from the marine API when they are ingested or trained
+            cells = weather_request.plan_grid_cells(cur, resolve='ingest' in stages or 'forecast' in stages)
+        conn.commit()
+    finally:
+        conn.close()
+
+    partitions = {}
+    for key, cell in cells.items():
+        member_ids = sorted(location_id for location_id, _ in cell['members'])
+        partitions[member_ids[0]] = (key, member_ids, cell['marine'])
+
+    tasks = {}
+    for cell_id, (key, member_ids, marine) in partitions.items():
+        # The marine response fetched to resolve a new cell is yesterday's data of that cell, ingest reuses it
+        tasks[task_id('ingest', cell_id)] = Task('ingest', cell_id, run_ingest, (key, member_ids, start_date_str, marine), [])
+
+    if 'forecast' in stages:
+        # Forecasts are limited to the locations prediction_calculation trains
+        scope = set(prediction_calculation.fetch_location_ids())
+        forecast_cells = [member_ids for _, member_ids, _ in partitions.values() if scope & set(member_ids)]
+        cell_budgets, training_deadline = prediction_calculation.plan_training(forecast_cells, deadline, retrain_all, workers)
+        for member_ids, time_budget, retrain in cell_budgets:
+            tasks[task_id('forecast', member_ids[0])] = Task(
+                'forecast', member_ids[0], run_forecast, (member_ids, time_budget, training_deadline, retrain),
+                [task_id('ingest', member_ids[0])]
+            )
+
+    for cell_id, (_, member_ids, _) in partitions.items():
+        upstream = task_id('forecast', cell_id)
+        if upstream not in tasks:
+            upstream = task_id('ingest', cell_id)
+        for location_id in member_ids:
+            tasks[task_id('score', location_id)] = Task('score', location_id, run_score, (location_id,), [upstream])
+    return tasks
+
+
+def execute(tasks, stages, checkpoint, workers):
+    """
+    Runs the tasks of the selected stages with at most workers in flight. Ready tasks of later stages are
+    started first, so partitions move through the whole pipeline instead of waiting for the slowest cell.
+
+    @return: Dictionary mapping the ids of tasks that could not run, because they or their upstream failed, to the reason.
+    """
+    finished = {tid for tid, task in tasks.items() if task.stage not in stages or tid in checkpoint.done}
+    pending = [tid for tid in tasks if tid not in finished]
+    print(f"{len(pending)} tasks to run, {len(finished)} done or not selected")
+    failed = {}
+    running = {}
+
+    with ProcessPoolExecutor(workers) as executor:
+        while pending or running:
+            ready = [tid for tid in pending if all(upstream in finished for upstream in tasks[tid].upstream)]
+            ready.sort(key=lambda tid: -STAGES.index(tasks[tid].stage))
+            for tid in ready[:workers - len(running)]:
+                task = tasks[tid]
+                if task.stage == 'forecast' and HISTORY_DIR:
+                    # Bring the local history of the cell up to date with what was just ingested
+                    prediction_calculation.sync_history([task.partition])
+                pending.remove(tid)
+                running[executor.submit(task.function, *task.args)] = tid
+
+            if not running:
+                # Everything left waits for a failed task
+                break
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                tid = running.pop(future)
+                try:
+                    checkpoint.mark_done(tasks[tid], future.result())
+                    finished.add(tid)
+                except Exception as e:
+                    print(f"Task {tid} failed: {e}")
+                    checkpoint.mark_failed(tasks[tid], str(e))
+                    failed[tid] = str(e)
+
+    for tid in pending:
+        failed[tid] = "upstream failed"
+    return failed
+
+
+def run_rankings():
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        quality_calculation.rank_locations(conn)
+    finally:
+        conn.close()
+
+
+def reload_forecasts():
+    """
+    Lets the forecast API swap in the new predictions instead of waiting for its next version check.
+    """
+    if not FORECAST_RELOAD_URL:
+        return
+    try:
+        token = os.environ.get(FORECAST_RELOAD_TOKEN_VARIABLE)
+        headers = {'X-Reload-Token': token} if token else {}
+        response = requests.post(FORECAST_RELOAD_URL, headers=headers, timeout=30)
+        print(f"Forecast reload: {response.status_code}")
+    except Exception as e:
+        print(f"Forecast reload failed: {e}")
+
+
+def run(args):
+    if args.only:
+        stages = [stage for stage in STAGES if stage in args.only.split(',')]
+    else:
+        stages = STAGES[STAGES.index(args.from_stage):]
+    today = datetime.date.today()
+    start_date_str = (today - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    deadline = prediction_calculation.parse_deadline(args.deadline) if args.deadline else None
+
+    metrics.start_run([int(value) for value in args.profile_locations.split(',')] if args.profile_locations else None)
+    checkpoint_path = os.path.join(PIPELINE_STATE_DIR, f"{today.isoformat()}.json")
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    print(f"Pipeline run {today.isoformat()}, stages: {', '.join(stages)}")
+    tasks = plan(stages, start_date_str, deadline, args.retrain_all, args.workers)
+    failed = execute(tasks, stages, checkpoint, args.workers)
+
+    if 'forecast' in stages:
+        reports = [result for tid, result in checkpoint.done.items() if tid.startswith('forecast:')]
+        write_report('training_report.json', reports, deadline)
+    if 'score' in stages:
+        # Rankings need the summaries of every location, they are built once all score tasks ran
+        run_rankings()
+    if 'forecast' in stages or 'score' in stages:
+        reload_forecasts()
+
+    metrics.write_run_report()
+    for tid, reason in failed.items():
+        print(f"Not finished: {tid} ({reason})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the ingest, forecast and score pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the pipeline, resuming today's checkpoint")
+    selection = run_parser.add_mutually_exclusive_group()
+    selection.add_argument("--only", help=f"comma separated stages to run, of {','.join(STAGES)}")
+    selection.add_argument("--from", dest="from_stage", choices=STAGES, default=STAGES[0], help="first stage to run")
+    run_parser.add_argument("--deadline", default=TRAINING_DEADLINE, help="HH:MM by which the run has to be finished")
+    run_parser.add_argument("--retrain-all", action="store_true", help="retrain every cell, not only those that drifted")
+    run_parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 8), help="parallel tasks")
+    run_parser.add_argument("--restart", action="store_true", help="ignore today's checkpoint")
+    run_parser.add_argument("--profile-locations", help="comma separated location ids to capture cProfile/TensorFlow traces for")
+    args = parser.parse_args()
+
+    sys.exit(run(args))
@@ -1,96 +1,162 @@
+import argparse
 from datetime import datetime, timedelta
-import pandas as pd
+import os
 import psycopg2
-from keras import optimizers, backend as K
-from lstm_time_series_predictor import LSTMTimeSeriesPredictor
+from psycopg2.extras import execute_values
 from multiprocessing import Pool, cpu_count
 import time
 
+import metrics
+from database.db_constants import DB_CONFIG, FORECAST_LOCATION_RANGE, HISTORY_DIR, MODEL_DIR, TRAINING_DEADLINE
+from backtest import run_backtest
+from grid_cells import get_grid_cells
+from history_loader import DIRECTION_TO_ANGLE, HISTORY_COLUMNS, load_history
+from history_store import HistoryStore
+from model_export import MANIFEST_FILE, TFLiteForecaster
+from shared_history import SharedHistory
+from training_budget import (EXPORT_SECONDS, MIN_TRAINING_SECONDS, OVERHEAD_SECONDS, RESERVE_SECONDS,
+                             allocate_budgets, baseline_forecast, write_report)
+
+# History of all locations of the run, attached by every worker process
+shared_history = None
+
+def attach_shared_history(handle):
+    global shared_history
+    shared_history = SharedHistory.attach(handle)
+
 def get_nearest_direction(angle, angle_to_direction):
     return min(angle_to_direction.keys(), key=lambda x: abs(x - angle))
 
 def create_connection():
-    return psycopg2.connect(
-        "host=postgresql.r6.websupport.sk "
-        "port=5432 "
-        "dbname=wavefinderapp "
-        "user=wavefinderapp "
-        "password=Bl7Vqw4/)0",
-
-    )
-
-def train_model(location_id):
-    # Define the direction_to_angle dictionary
-    direction_to_angle = {
-        'N': 0, 'NNE': 22.5, 'NE': 45, 'ENE': 67.5,
-        'E': 90, 'ESE': 112.5, 'SE': 135, 'SSE': 157.5,
-        'S': 180, 'SSW': 202.5, 'SW': 225, 'WSW': 247.5,
-        'W': 270, 'WNW': 292.5, 'NW': 315, 'NNW': 337.5
-    }
-
-    target_columns = [
-        'WaveHeight', 'WindWaveHeight', 'SwellWaveHeight', 'WaveDirection',
-        'WindWaveDirection', 'SwellWaveDirection', 'WavePeriod',
-        'WindWavePeriod', 'SwellWavePeriod', 'WindWavePeakPeriod',
-        'SwellWavePeakPeriod', 'WindSpeed', 'WindDirection', 'Weather'
-    ]
-
-    optimizer = optimizers.Adam(learning_rate=0.001)
+    return psycopg2.connect(**DB_CONFIG)
+
+def train_model(location_id, member_ids=None, time_budget=None, deadline=None, retrain=True):
+    """
+    Trains the forecasters on the history of one location and stores the predictions for it and for every
+    other location sharing its marine grid cell.
+
+    @param location_id: The location whose history is used for training.
+    @param member_ids: All locations of the grid cell, defaults to the location alone.
+    @param time_budget: Optional number of training seconds given to this cell by the budget allocator.
+    @param deadline: Optional wall clock time (time.time()) by which training of all cells has to be finished.
+    @param retrain: False keeps the exported models of the cell and only rolls the forecast forward with them.
+
+    @return: Report entry describing what the cell received and used.
+    """
+    member_ids = member_ids or [location_id]
+    started = time.time()
+    report = {'location_id': location_id, 'members': member_ids, 'budget_seconds': time_budget,
+              'mode': 'lstm', 'epochs': {}, 'baseline_columns': []}
+    direction_to_angle = DIRECTION_TO_ANGLE
+    target_columns = HISTORY_COLUMNS
+
     look_back = 16
     epochs = 100
     batch_size = 16
     dropout_rate = 0.2
     neurons = 64
+    regression = None
+    conn = None
 
     try:
-        # First connection to retrieve data
-        conn = create_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM SeaConditions WHERE locationid = %s", (location_id,))
-        data = cur.fetchall()
-        colnames = [desc[0] for desc in cur.description]
-        df_location = pd.DataFrame(data, columns=colnames)
-
-        target_columns = [column.lower() for column in target_columns]
-        df_location['winddirection'] = df_location['winddirection'].map(direction_to_angle)
+        # Wind direction already comes as an angle, the database is only read when no local history is attached
+        if shared_history is not None and location_id in shared_history:
+            history = shared_history.read(location_id, target_columns)
+        elif HISTORY_DIR:
+            history = HistoryStore(HISTORY_DIR).read(location_id, target_columns)
+        else:
+            conn = create_connection()
+            try:
+                history = load_history(conn, location_id, target_columns)
+            finally:
+                conn.close()
+                conn = None
+        # The predictors only index the history by column, no DataFrame is needed
+        df_location = history
 
         print('Location id ', location_id)
 
-        regression = LSTMTimeSeriesPredictor(
-            optimizer=optimizer, look_back=look_back, epochs=epochs,
-            batch_size=batch_size, dropout_rate=dropout_rate, neurons=neurons
-        )
+        model_dir = os.path.join(MODEL_DIR, str(location_id))
+        # The backtest found no drift, the stored models are reused
+        reroll = not retrain and os.path.exists(os.path.join(model_dir, MANIFEST_FILE))
+        if deadline is not None and not reroll:
+            # Never train past the end of the window, whatever the allocated budget, the export still follows
+            left = deadline - time.time() - OVERHEAD_SECONDS - EXPORT_SECONDS
+            time_budget = left if time_budget is None else min(time_budget, left)
+
+        phase_start = time.perf_counter()
+        if reroll:
+            report['mode'] = 'reroll'
+            predictions = TFLiteForecaster(model_dir).predict(df_location, target_columns, 72)
+        elif time_budget is not None and time_budget < MIN_TRAINING_SECONDS:
+            report['mode'] = 'baseline'
+            predictions = {}
+        else:
+            # Keras and TensorFlow are only loaded by processes which actually train
+            from keras import optimizers
+            from lstm_time_series_predictor import LSTMTimeSeriesPredictor
+
+            regression = LSTMTimeSeriesPredictor(
+                optimizer=optimizers.Adam(learning_rate=0.001), look_back=look_back, epochs=epochs,
+                batch_size=batch_size, dropout_rate=dropout_rate, neurons=neurons
+            )
+            predictions = regression.train_and_predict(df_location, target_columns=target_columns, steps=72, time_budget=time_budget)
+            report['epochs'] = regression.epochs_run
+        phase_seconds = time.perf_counter() - phase_start
+        metrics.observe('forecast_seconds', phase_seconds, mode=report['mode'])
+        metrics.increment('epochs_run', sum(report['epochs'].values()))
+        metrics.record_location(location_id, epochs=sum(report['epochs'].values()),
+                                **{'train_seconds' if report['mode'] == 'lstm' else 'predict_seconds': phase_seconds})
 
-        predictions = regression.train_and_predict(df_location, target_columns=target_columns, steps=72)
+        # Columns the budget did not reach get the seasonal baseline
+        for column in target_columns:
+            if column not in predictions:
+                predictions[column] = baseline_forecast(df_location[column], 72)
+                report['baseline_columns'].append(column)
 
         results = {col: [prediction.item() for prediction in predictions[col]] for col in target_columns}
 
         print(f"Predictions for location {location_id} completed")
 
+        # Rerolled and baseline cells keep their stored models, there is nothing to export
+        if regression is not None and regression.models:
+            try:
+                regression.export(model_dir, df_location)
+                print(f"Exported models for location {location_id}")
+            except Exception as e:
+                print(f"Model export failed for location {location_id}: {e}")
+
         date_now = datetime.now()
         now = date_now.replace(hour=1, minute=0, second=0, microsecond=0)
         angle_to_direction = {v: k for k, v in direction_to_angle.items()}
 
-        # Close the initial connection after data retrieval and prediction
-        cur.close()
-        conn.close()
-
-        # Re-establish the connection before inserting predictions
+        # Connect for inserting the predictions only, training can take a long time
         conn = create_connection()
         cur = conn.cursor()
 
+        rows = []
         for i in range(72):
             future_time = now + timedelta(hours=i)
             wind_dir_str = angle_to_direction[get_nearest_direction(round(results['winddirection'][i]) % 360, angle_to_direction)]
+            for member_id in member_ids:
+                rows.append((
+                    future_time.date(), future_time.time(), member_id,
+                    results['waveheight'][i], results['windwaveheight'][i],
+                    results['swellwaveheight'][i], results['wavedirection'][i],
+                    results['windwavedirection'][i], results['swellwavedirection'][i],
+                    results['windspeed'][i], results['weather'][i],
+                    results['waveperiod'][i], results['windwaveperiod'][i],
+                    results['swellwaveperiod'][i], wind_dir_str
+                ))
 
-            cur.execute("""
+        execute_values(cur, """
                 INSERT INTO PredictedSeaConditions (
                     Date, Timeofday, LocationID, WaveHeight, WindWaveHeight,
                     SwellWaveHeight, WaveDirection, WindWaveDirection,
                     SwellWaveDirection, CreatedAt, WindSpeed, Weather,
                     WavePeriod, WindWavePeriod, SwellWavePeriod, WindDirection
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s, %s, %s)
+                VALUES %s
                 ON CONFLICT ON CONSTRAINT unique_date_time_location DO UPDATE
                 SET Timeofday = excluded.Timeofday,
                     WaveHeight = excluded.WaveHeight,
@@ -106,28 +172,33 @@ def train_model(location_id):
                     WindWavePeriod = excluded.WindWavePeriod,
                     SwellWavePeriod = excluded.SwellWavePeriod,
                     WindDirection = excluded.WindDirection
-            """, (
-                future_time.date(), future_time.time(), location_id,
-                results['waveheight'][i], results['windwaveheight'][i],
-                results['swellwaveheight'][i], results['wavedirection'][i],
-                results['windwavedirection'][i], results['swellwavedirection'][i],
-                results['windspeed'][i], results['weather'][i],
-                results['waveperiod'][i], results['windwaveperiod'][i],
-                results['swellwaveperiod'][i], wind_dir_str
-            ))
+            """, rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s, %s, %s)", page_size=1000)
         conn.commit()
+        metrics.increment('rows_written', len(rows), table='predictedseaconditions')
     except Exception as e:
         print(f"An error occurred: {e}")
+        report['mode'] = 'failed'
+        report['error'] = str(e)
     finally:
-        cur.close()
-        conn.close()
-        K.clear_session()  # Clear the session to prevent memory leaks
+        if conn is not None:
+            conn.close()
+        if regression is not None:
+            from keras import backend as K
+            K.clear_session()  # Clear the session to prevent memory leaks
+
+    report['seconds'] = time.time() - started
+    metrics.increment('cells_forecast', mode=report['mode'])
+    metrics.flush()
+    return report
 
 def fetch_location_ids():
     try:
         conn = create_connection()
         cur = conn.cursor()
-        cur.execute("SELECT locationid FROM Locations WHERE locationid BETWEEN 375 AND 385")
+        if FORECAST_LOCATION_RANGE is None:
+            cur.execute("SELECT locationid FROM Locations")
+        else:
+            cur.execute("SELECT locationid FROM Locations WHERE locationid BETWEEN %s AND %s", FORECAST_LOCATION_RANGE)
         location_data = cur.fetchall()
         location_ids = [row[0] for row in location_data]
     finally:
@@ -136,16 +207,121 @@ def fetch_location_ids():
 
     return location_ids
 
-def train_models(location_ids):
-    for location_id in location_ids:
-        train_model(location_id)
+def fetch_grid_cells(location_ids):
+    """
+    Groups the locations by marine grid cell, every cell is trained once.
+    """
+    try:
+        conn = create_connection()
+        cur = conn.cursor()
+        cells = get_grid_cells(cur, location_ids)
+    finally:
+        cur.close()
+        conn.close()
+
+    return cells
+
+def sync_history(location_ids):
+    """
+    Brings the local history store up to date before the workers start reading from it.
+    """
+    try:
+        conn = create_connection()
+        new_rows = HistoryStore(HISTORY_DIR).sync(conn, location_ids)
+    finally:
+        conn.close()
+    print(f"Synced {new_rows} new history rows to {HISTORY_DIR}")
+
+def train_models(work):
+    cells, deadline = work
+    reports = []
+    for member_ids, time_budget, retrain in cells:
+        with metrics.profile(member_ids[0]):
+            reports.append(train_model(member_ids[0], member_ids, time_budget, deadline, retrain))
+    return reports
+
+def parse_deadline(value):
+    """
+    Converts a HH:MM deadline to the wall clock time of its next occurrence.
+    """
+    hour, minute = (int(part) for part in value.split(':'))
+    deadline = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if deadline <= datetime.now():
+        deadline += timedelta(days=1)
+    return deadline.timestamp()
+
+def plan_training(cells, deadline, retrain_all, num_processes):
+    """
+    Decides which cells are retrained and how much training time each of them gets.
+
+    @param cells: List of member id lists, one per grid cell.
+    @param deadline: Optional wall clock time (time.time()) the run has to finish by.
+    @param retrain_all: True retrains every cell, not only those that drifted.
+    @param num_processes: Number of parallel training processes.
+
+    @return: (list of (member_ids, time_budget, retrain) ordered by priority, training deadline or None).
+    """
+    representative_ids = [member_ids[0] for member_ids in cells]
+    # Only cells whose forecasts drifted are retrained, the others roll forward with their stored models
+    if retrain_all:
+        retrain = set(representative_ids)
+    else:
+        conn = create_connection()
+        try:
+            retrain = run_backtest(conn, representative_ids)
+        finally:
+            conn.close()
+
+    # Cells serving more beaches come first and get a larger share of the window
+    cells = sorted(cells, key=lambda member_ids: (member_ids[0] in retrain, len(member_ids)), reverse=True)
+    budgets = {member_ids[0]: None for member_ids in cells}
+    training_deadline = None
+    if deadline is not None:
+        budgets.update(allocate_budgets(
+            deadline, {member_ids[0]: len(member_ids) for member_ids in cells if member_ids[0] in retrain}, num_processes,
+            cells=len(cells)
+        ))
+        training_deadline = deadline - RESERVE_SECONDS
+
+    return [(member_ids, budgets[member_ids[0]], member_ids[0] in retrain) for member_ids in cells], training_deadline
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the forecasters and store 72 hour predictions')
+    parser.add_argument('--deadline', default=TRAINING_DEADLINE, help='HH:MM by which the run has to be finished')
+    parser.add_argument('--retrain-all', action='store_true', help='retrain every cell, not only those that drifted')
+    parser.add_argument('--profile-locations', help='comma separated location ids to capture cProfile/TensorFlow traces for')
+    args = parser.parse_args()
+    owns_run = metrics.start_run([int(value) for value in args.profile_locations.split(',')] if args.profile_locations else None)
+
     location_ids = fetch_location_ids()
+    cells = fetch_grid_cells(location_ids)
+    print(f"{len(location_ids)} locations in {len(cells)} grid cells")
+    representative_ids = [member_ids[0] for member_ids in cells]
+    # Load every history once, the workers only take views of the shared block
+    if HISTORY_DIR:
+        sync_history(representative_ids)
+        history = SharedHistory.from_store(HistoryStore(HISTORY_DIR), representative_ids)
+    else:
+        conn = create_connection()
+        try:
+            history = SharedHistory.from_database(conn, representative_ids)
+        finally:
+            conn.close()
+    print(f"Loaded {history.block.shape[1]} history rows into shared memory ({history.block.nbytes / 2**20:.1f} MB)")
     cpu = cpu_count()
-    num_processes = min(len(location_ids), 8)  # Use the available CPU cores
-    
-    location_sets = [location_ids[i::num_processes] for i in range(num_processes)]
+    num_processes = min(len(cells), 8)  # Use the available CPU cores
+    deadline = parse_deadline(args.deadline) if args.deadline else None
+
+    cell_budgets, training_deadline = plan_training(cells, deadline, args.retrain_all, num_processes)
+    location_sets = [(cell_budgets[i::num_processes], training_deadline) for i in range(num_processes)]
+
+    try:
+        with Pool(num_processes, initializer=attach_shared_history, initargs=(history.handle(),)) as p:
+            reports = [entry for entries in p.map(train_models, location_sets) for entry in entries]
+    finally:
+        history.close()
+        history.unlink()
 
-    with Pool(num_processes) as p:
-        p.map(train_models, location_sets)
+    write_report('training_report.json', reports, deadline)
+    if owns_run:
+        metrics.write_run_report()
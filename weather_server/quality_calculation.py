@@ -1,9 +1,32 @@
+from collections import Counter
 from datetime import datetime, timedelta
+import heapq
+import math
+import numpy as np
 import psycopg2
-import pandas as pd
+from psycopg2.extras import execute_values
 from multiprocessing import Pool, cpu_count
+import time
 
-from database.db_constants import DB_CONFIG
+import metrics
+from database.db_constants import DB_CONFIG, RANKING_SIZE
+
+# Hours of the day (first, last) in which the best hour of a day is picked
+SURF_HOURS = (6, 20)
+# Size of the lat/lon squares in degrees that beaches are ranked in, besides the national ranking
+REGION_STEP = 1.0
+NATIONAL_REGION = 'all'
+
+WAVE_QUALITY_SCORES = {'Excellent': 7.5, 'Good': 5.0, 'Fair': 2.5, 'Poor': 0.0}
+
+# Thresholds shared by the row functions and their vectorised versions, checked in order, the first match wins
+# (label, wave height above, wind speed above, swell wave height above)
+SURF_DIFFICULTY_LEVELS = [('High', 2, 5, 2), ('Medium', 1, 3, 1)]
+# (label, wave height above, wave period above, swell wave period above, wind wave height below)
+WAVE_QUALITY_LEVELS = [('Excellent', 2, 10, 10, 1.5), ('Good', 1, 7, 7, 2), ('Fair', 1, 5, 5, 3)]
+# Wind speed and wind wave height above which the wind has the strong impact multiplier
+STRONG_WIND = (5, 2)
+GOOD_WAVE_QUALITIES = ['Excellent', 'Good']
 
 # Define functions for calculations
 def calculate_surf_difficulty(row):
@@ -14,12 +37,10 @@ def calculate_surf_difficulty(row):
 
     @return: A string representing the difficulty of surfing ('High', 'Medium', 'Low').
     """
-    if row['waveheight'] > 2 and row['windspeed'] > 5 and row['swellwaveheight'] > 2:
-        return 'High'
-    elif row['waveheight'] > 1 and row['windspeed'] > 3 and row['swellwaveheight'] > 1:
-        return 'Medium'
-    else:
-        return 'Low'
+    for label, wave_height, wind_speed, swell_wave_height in SURF_DIFFICULTY_LEVELS:
+        if row['waveheight'] > wave_height and row['windspeed'] > wind_speed and row['swellwaveheight'] > swell_wave_height:
+            return label
+    return 'Low'
 
 def calculate_wave_quality(row):
     """
@@ -29,14 +50,11 @@ def calculate_wave_quality(row):
 
     @return: A string representing the quality of waves ('Excellent', 'Good', 'Fair', 'Poor').
     """
-    if row['waveheight'] > 2 and row['waveperiod'] > 10 and row['swellwaveperiod'] > 10 and row['windwaveheight'] < 1.5:
-        return 'Excellent'
-    elif row['waveheight'] > 1 and row['waveperiod'] > 7 and row['swellwaveperiod'] > 7 and row['windwaveheight'] < 2:
-        return 'Good'
-    elif row['waveheight'] > 1 and row['waveperiod'] > 5 and row['swellwaveperiod'] > 5 and row['windwaveheight'] < 3:
-        return 'Fair'
-    else:
-        return 'Poor'
+    for label, wave_height, wave_period, swell_wave_period, wind_wave_height in WAVE_QUALITY_LEVELS:
+        if (row['waveheight'] > wave_height and row['waveperiod'] > wave_period
+                and row['swellwaveperiod'] > swell_wave_period and row['windwaveheight'] < wind_wave_height):
+            return label
+    return 'Poor'
 
 def calculate_wind_impact(row):
     """
@@ -48,71 +66,256 @@ def calculate_wind_impact(row):
 
     @return: A integer
     """
-    if row['windspeed'] > 5 and row['windwaveheight'] > 2:
+    if row['windspeed'] > STRONG_WIND[0] and row['windwaveheight'] > STRONG_WIND[1]:
         return float(row['windspeed']) * 0.8
     else:
         return float(row['windspeed']) * 0.5
 
+def calculate_quality_score(row):
+    """
+    Numeric surf quality from 0 to 10 for ranking. The wave quality label sets the band, a long swell
+    period and a small wind chop move the score up within it.
+
+    @param row: A dictionary or similar data structure that includes 'waveheight', 'waveperiod', 'swellwaveperiod', and 'windwaveheight'.
+
+    @return: A float between 0 and 10.
+    """
+    score = WAVE_QUALITY_SCORES[calculate_wave_quality(row)]
+    score += 1.5 * min(float(row['swellwaveperiod']), 14) / 14
+    score += 1.0 * (1 - min(float(row['windwaveheight']), 3) / 3)
+    return round(score, 3)
+
 def generate_recommendation(surfDifficulty, waveQuality):
     recommendations = []
     for surf_difficulty, wave_quality in zip(surfDifficulty, waveQuality):
-        if surf_difficulty == 'Low' and wave_quality in ['Excellent', 'Good']:
+        if surf_difficulty == 'Low' and wave_quality in GOOD_WAVE_QUALITIES:
             recommendations.append('Great conditions for all surfers')
-        elif surf_difficulty != 'Low' and wave_quality in ['Excellent', 'Good']:
+        elif surf_difficulty != 'Low' and wave_quality in GOOD_WAVE_QUALITIES:
             recommendations.append('Good conditions for experienced surfers')
         else:
             recommendations.append('Not recommended for surfing')
     return recommendations
 
+def score_arrays(values):
+    """
+    Vectorised versions of the functions above for many hours at once, with the same thresholds and results.
+    Missing values (NaN) fail every threshold, like the lowest label.
+
+    @param values: Dictionary of float arrays with 'waveheight', 'windspeed', 'swellwaveheight', 'waveperiod',
+                   'swellwaveperiod' and 'windwaveheight'.
+
+    @return: Dictionary of arrays 'surfdifficulty', 'wavequality', 'recommendation' (strings), 'windimpact' and 'qualityscore'.
+    """
+    wave_height, wind_speed, swell_wave_height = values['waveheight'], values['windspeed'], values['swellwaveheight']
+    wave_period, swell_wave_period, wind_wave_height = values['waveperiod'], values['swellwaveperiod'], values['windwaveheight']
+
+    surf_difficulty = np.select(
+        [(wave_height > height) & (wind_speed > speed) & (swell_wave_height > swell) for _, height, speed, swell in SURF_DIFFICULTY_LEVELS],
+        [label for label, *_ in SURF_DIFFICULTY_LEVELS], default='Low'
+    )
+    wave_quality = np.select(
+        [(wave_height > height) & (wave_period > period) & (swell_wave_period > swell_period) & (wind_wave_height < chop)
+         for _, height, period, swell_period, chop in WAVE_QUALITY_LEVELS],
+        [label for label, *_ in WAVE_QUALITY_LEVELS], default='Poor'
+    )
+    strong_wind = (wind_speed > STRONG_WIND[0]) & (wind_wave_height > STRONG_WIND[1])
+    wind_impact = wind_speed * np.where(strong_wind, 0.8, 0.5)
+
+    good = np.isin(wave_quality, GOOD_WAVE_QUALITIES)
+    recommendation = np.select(
+        [good & (surf_difficulty == 'Low'), good],
+        ['Great conditions for all surfers', 'Good conditions for experienced surfers'], default='Not recommended for surfing'
+    )
+    quality_score = np.select([wave_quality == label for label in WAVE_QUALITY_SCORES], list(WAVE_QUALITY_SCORES.values()))
+    quality_score = quality_score + 1.5 * np.minimum(swell_wave_period, 14) / 14 + 1.0 * (1 - np.minimum(wind_wave_height, 3) / 3)
+    return {
+        'surfdifficulty': surf_difficulty,
+        'wavequality': wave_quality,
+        'windimpact': wind_impact,
+        'recommendation': recommendation,
+        'qualityscore': np.round(quality_score, 3),
+    }
+
+def create_summary_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS DailySurfSummaries (
+            LocationID INT REFERENCES Locations(LocationID),
+            Date DATE,
+            BestHour TIMESTAMP,
+            BestScore DECIMAL,
+            MeanScore DECIMAL,
+            PeakWaveHeight DECIMAL,
+            DominantRecommendation VARCHAR(255),
+            Hours INT,
+            ComputedAt TIMESTAMP,
+            PRIMARY KEY (LocationID, Date)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS DailyBeachRankings (
+            Date DATE,
+            Region VARCHAR(32),
+            Rank SMALLINT,
+            LocationID INT REFERENCES Locations(LocationID),
+            Score DECIMAL,
+            BestHour TIMESTAMP,
+            ComputedAt TIMESTAMP,
+            PRIMARY KEY (Date, Region, Rank)
+        )
+    """)
+
+def summarise_day(times, scores, wave_heights, recommendations):
+    """
+    Summarises the scored hours of one location and day.
+
+    @return: (best hour, best score, mean score, peak wave height, dominant recommendation, hours).
+    """
+    surf_hours = [i for i, time_of_day in enumerate(times) if SURF_HOURS[0] <= time_of_day.hour <= SURF_HOURS[1]]
+    best = max(surf_hours or range(len(times)), key=lambda i: scores[i])
+    dominant = Counter(recommendations).most_common(1)[0][0]
+    return (times[best], scores[best], sum(scores) / len(scores), max(float(height) for height in wave_heights),
+            dominant, len(times))
+
 def process_location(location_id):
+    import pandas as pd
+
     # Establish a connection to the database inside the process
     conn = psycopg2.connect(**DB_CONFIG)
     cur = conn.cursor()
-    
+    started = time.perf_counter()
+
     start_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     end_date = start_date + timedelta(days=3)
     print("Processing Location ID:", location_id)
-    current_date = start_date
-    while current_date < end_date:
-        cur.execute("""
-            SELECT * FROM PredictedSeaConditions
-            WHERE "date" = %s AND "locationid" = %s
-            ORDER BY "timeofday" ASC
-        """, (current_date.date(), location_id))
-        rows = cur.fetchall()
-        df = pd.DataFrame(rows, columns=[desc[0] for desc in cur.description])
-        
+    # The whole window in one query, every hour is scored and stored under its own time
+    cur.execute("""
+        SELECT * FROM PredictedSeaConditions
+        WHERE "locationid" = %s AND "date" >= %s AND "date" < %s
+        ORDER BY "date" ASC, "timeofday" ASC
+    """, (location_id, start_date.date(), end_date.date()))
+    rows = cur.fetchall()
+    df = pd.DataFrame(rows, columns=[desc[0] for desc in cur.description])
+
+    computed = []
+    summaries = []
+    if not df.empty:
+        times = [datetime.strptime(f"{date} {time_of_day}", "%Y-%m-%d %H:%M:%S")
+                 for date, time_of_day in zip(df['date'], df['timeofday'])]
         surfDifficulty = df.apply(calculate_surf_difficulty, axis=1)
         waveQuality = df.apply(calculate_wave_quality, axis=1)
         windImpact = df.apply(calculate_wind_impact, axis=1)
+        qualityScore = df.apply(calculate_quality_score, axis=1).tolist()
         recommendation = generate_recommendation(surfDifficulty, waveQuality)
-        
-        for index, row in df.iterrows():
-            cur.execute("""
-                INSERT INTO ComputedSeaConditions (LocationID, TimeofDay, SurfDifficulty, WaveQuality, WindImpact, Recommendation, CreatedAt)
-                VALUES (%s, %s, %s, %s, %s, %s, NOW())
-               ON CONFLICT ON CONSTRAINT computedseaconditions_locationid_timeofday
-                DO UPDATE SET
-                    LocationID = EXCLUDED.LocationID,
-                    TimeofDay = EXCLUDED.TimeofDay,
-                    SurfDifficulty = EXCLUDED.SurfDifficulty,
-                    WaveQuality = EXCLUDED.WaveQuality,
-                    WindImpact = EXCLUDED.WindImpact,
-                    Recommendation = EXCLUDED.Recommendation,
-                    CreatedAt = NOW()
-            """, (location_id, current_date, surfDifficulty[index], waveQuality[index], windImpact[index], recommendation[index]))
-            conn.commit()
-        
-        current_date += timedelta(hours=1)
+        for index in range(len(df)):
+            computed.append((location_id, times[index], surfDifficulty[index], waveQuality[index], windImpact[index],
+                             recommendation[index], qualityScore[index]))
+
+        days = {}
+        for index, time_of_day in enumerate(times):
+            days.setdefault(time_of_day.date(), []).append(index)
+        for day, indexes in days.items():
+            summaries.append((location_id, day) + summarise_day(
+                [times[i] for i in indexes], [qualityScore[i] for i in indexes],
+                [df['waveheight'][i] for i in indexes], [recommendation[i] for i in indexes]
+            ))
+
+    execute_values(cur, """
+        INSERT INTO ComputedSeaConditions (LocationID, TimeofDay, SurfDifficulty, WaveQuality, WindImpact, Recommendation, QualityScore, CreatedAt)
+        VALUES %s
+        ON CONFLICT ON CONSTRAINT computedseaconditions_locationid_timeofday
+        DO UPDATE SET
+            SurfDifficulty = EXCLUDED.SurfDifficulty,
+            WaveQuality = EXCLUDED.WaveQuality,
+            WindImpact = EXCLUDED.WindImpact,
+            Recommendation = EXCLUDED.Recommendation,
+            QualityScore = EXCLUDED.QualityScore,
+            CreatedAt = NOW()
+    """, computed, template="(%s, %s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+    execute_values(cur, """
+        INSERT INTO DailySurfSummaries (LocationID, Date, BestHour, BestScore, MeanScore, PeakWaveHeight, DominantRecommendation, Hours, ComputedAt)
+        VALUES %s
+        ON CONFLICT (LocationID, Date) DO UPDATE SET
+            BestHour = EXCLUDED.BestHour,
+            BestScore = EXCLUDED.BestScore,
+            MeanScore = EXCLUDED.MeanScore,
+            PeakWaveHeight = EXCLUDED.PeakWaveHeight,
+            DominantRecommendation = EXCLUDED.DominantRecommendation,
+            Hours = EXCLUDED.Hours,
+            ComputedAt = NOW()
+    """, summaries, template="(%s, %s, %s, %s, %s, %s, %s, %s, NOW())")
+    conn.commit()
+
     print('Finished Location', location_id)
     cur.close()
     conn.close()
+    score_seconds = time.perf_counter() - started
+    metrics.observe('score_seconds', score_seconds)
+    metrics.increment('rows_written', len(computed), table='computedseaconditions')
+    metrics.increment('rows_written', len(summaries), table='dailysurfsummaries')
+    metrics.record_location(location_id, score_seconds=score_seconds)
+    metrics.flush()
+
+def region_of(latitude, longitude):
+    """
+    Names the REGION_STEP square containing a position by its south west corner, e.g. '53.0,-10.0'.
+    """
+    return f"{math.floor(latitude / REGION_STEP) * REGION_STEP:.1f},{math.floor(longitude / REGION_STEP) * REGION_STEP:.1f}"
+
+def rank_locations(conn, dates=None, k=RANKING_SIZE):
+    """
+    Ranks the beaches of every day by the score of their best hour, nationally and per region, and replaces
+    the DailyBeachRankings of those days. Every (day, region) keeps a heap of its k best beaches, so the
+    ranking costs O(locations log k) instead of sorting every location.
+
+    @param conn: An open psycopg2 connection.
+    @param dates: The days to rank, the three days of the forecast window by default.
+    @param k: Number of beaches kept per day and region.
+
+    @return: The number of ranking rows written.
+    """
+    today = datetime.now().date()
+    dates = dates or [today + timedelta(days=i) for i in range(3)]
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT s.Date, s.LocationID, s.BestScore, s.BestHour, l.Coordinates
+            FROM DailySurfSummaries s
+            JOIN Locations l ON l.LocationID = s.LocationID
+            WHERE s.Date = ANY(%s) AND l.DeletedAt IS NULL
+        """, (list(dates),))
+
+        heaps = {}
+        for date, location_id, score, best_hour, coordinates in cur:
+            # Ties go to the smaller location id, so reruns produce the same ranking
+            entry = (float(score), -location_id, best_hour)
+            regions = [NATIONAL_REGION]
+            if coordinates and coordinates.get('latitude') is not None and coordinates.get('longitude') is not None:
+                regions.append(region_of(float(coordinates['latitude']), float(coordinates['longitude'])))
+            for region in regions:
+                heap = heaps.setdefault((date, region), [])
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+        rows = []
+        for (date, region), heap in heaps.items():
+            for rank, (score, negative_id, best_hour) in enumerate(sorted(heap, reverse=True), start=1):
+                rows.append((date, region, rank, -negative_id, score, best_hour))
+        cur.execute("DELETE FROM DailyBeachRankings WHERE Date = ANY(%s)", (list(dates),))
+        execute_values(cur, """
+            INSERT INTO DailyBeachRankings (Date, Region, Rank, LocationID, Score, BestHour, ComputedAt) VALUES %s
+        """, rows, template="(%s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+    conn.commit()
+    metrics.increment('rows_written', len(rows), table='dailybeachrankings')
+    print(f"Ranked beaches in {len(heaps)} day and region groups")
+    return len(rows)
 
 if __name__ == "__main__":
+    owns_run = metrics.start_run()
     # Establish a connection outside the processes
     conn_master = psycopg2.connect(**DB_CONFIG)
     cur_master = conn_master.cursor()
-    
+
     # Fetch location IDs
     cur_master.execute("SELECT locationid FROM Locations")
     location_data = cur_master.fetchall()
@@ -123,4 +326,13 @@ if __name__ == "__main__":
     
     # Process each location in parallel
     with Pool(cpu_count()) as pool:
-        pool.map(process_location, location_ids)
\ No newline at end of file
+        pool.map(process_location, location_ids)
+
+    # Rank the beaches once every location is summarised
+    conn_master = psycopg2.connect(**DB_CONFIG)
+    try:
+        rank_locations(conn_master)
+    finally:
+        conn_master.close()
+    if owns_run:
+        metrics.write_run_report()
\ No newline at end of file
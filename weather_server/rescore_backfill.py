@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import psycopg2
+
+from database.db_constants import DB_CONFIG, PIPELINE_STATE_DIR
+from history_loader import COLUMN_SQL, FETCH_SIZE, register_decimal_typecaster
+import metrics
+from quality_calculation import score_arrays
+
+"""
+  Re-scores the measured SeaConditions history into ComputedSeaConditions, e.g. after the thresholds of
+  calculate_surf_difficulty or calculate_wave_quality changed:
+
+      python rescore_backfill.py
+      python rescore_backfill.py --since 2023-01-01 --workers 2 --max-rows-per-second 20000
+      python rescore_backfill.py --restart
+
+  The history is split into chunks of CHUNK_LOCATIONS locations and one year. Every chunk is streamed through a
+  server-side cursor in batches, the batches are scored with the vectorised quality_calculation.score_arrays in a
+  process pool and bulk upserted with COPY. Finished chunks are recorded in the checkpoint, a stopped backfill
+  resumes with the first unfinished chunk and redoes at most that one, the upsert makes this harmless. A chunk is
+  recorded with its days, so a run with another --since or --until re-scores the days the earlier one did not.
+
+  To run next to the nightly pipeline the backfill keeps at most two batches per worker in flight, stays below
+  --max-rows-per-second and pauses while more than --max-active-queries other queries run on the database.
+"""
+
+CHUNK_LOCATIONS = 50
+# Rows per batch handed to a worker
+BATCH_ROWS = FETCH_SIZE * 5
+CHECKPOINT_FILE = os.path.join(PIPELINE_STATE_DIR, "rescore_backfill.json")
+# Seconds to wait before checking the database load again
+PAUSE_SECONDS = 30
+
+SCORE_COLUMNS = ['waveheight', 'windspeed', 'swellwaveheight', 'waveperiod', 'swellwaveperiod', 'windwaveheight']
+
+# Computed rows are keyed by the hour as written by process_location, e.g. '2024-01-31 06:00:00'
+CHUNK_SQL = f"""
+    SELECT LocationID, to_char(to_timestamp(TimeOfDay, 'YYYY-MM-DD HH24:MI'), 'YYYY-MM-DD HH24:MI:SS'),
+           {', '.join(f"({COLUMN_SQL.get(column, column)})::float8" for column in SCORE_COLUMNS)}
+    FROM SeaConditions
+    WHERE LocationID = ANY(%s) AND Date >= %s AND Date < %s AND DeletedAt IS NULL
+    ORDER BY LocationID, Date, TimeOfDay
+"""
+
+ACTIVE_QUERIES_SQL = """
+    SELECT COUNT(*) FROM pg_stat_activity
+    WHERE state = 'active' AND datname = current_database() AND pid <> pg_backend_pid()
+"""
+
+
+def score_batch(location_ids, times, values):
+    """
+    Scores one batch in a worker process and formats it for COPY into the staging table.
+
+    @param location_ids: Array of location ids.
+    @param times: List of TimeOfDay keys.
+    @param values: float64 array with one column per SCORE_COLUMNS entry, NaN for missing values.
+
+    @return: The batch as CSV text.
+    """
+    scores = score_arrays({column: values[:, i] for i, column in enumerate(SCORE_COLUMNS)})
+    # Missing values become empty fields, which COPY reads as NULL
+    wind_impact = np.char.replace(np.round(scores['windimpact'], 3).astype(str), 'nan', '')
+    quality_score = np.char.replace(scores['qualityscore'].astype(str), 'nan', '')
+    lines = [
+        f"{location_id},{time_of_day},{difficulty},{quality},{impact},{recommendation},{score}"
+        for location_id, time_of_day, difficulty, quality, impact, recommendation, score in zip(
+            location_ids, times, scores['surfdifficulty'], scores['wavequality'], wind_impact,
+            scores['recommendation'], quality_score
+        )
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def upsert_batch(conn, csv_text):
+    """
+    Copies a scored batch into a staging table and merges it into ComputedSeaConditions. SeaConditions may hold
+    an hour twice, one statement can not upsert a key twice, so the last copied row of an hour wins.
+
+    @return: The number of rows written.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS rescore_staging (
+                LocationID INT, TimeOfDay VARCHAR(50), SurfDifficulty VARCHAR(50), WaveQuality VARCHAR(50),
+                WindImpact DECIMAL, Recommendation VARCHAR(255), QualityScore DECIMAL
+            ) ON COMMIT DELETE ROWS
+        """)
+        cur.copy_expert("COPY rescore_staging FROM STDIN WITH (FORMAT csv)", io.StringIO(csv_text))
+        cur.execute("""
+            INSERT INTO ComputedSeaConditions (LocationID, TimeOfDay, SurfDifficulty, WaveQuality, WindImpact, Recommendation, QualityScore, CreatedAt)
+            SELECT DISTINCT ON (LocationID, TimeOfDay)
+                   LocationID, TimeOfDay, SurfDifficulty, WaveQuality, WindImpact, Recommendation, QualityScore, NOW()
+            FROM rescore_staging
+            ORDER BY LocationID, TimeOfDay, ctid DESC
+            ON CONFLICT ON CONSTRAINT computedseaconditions_locationid_timeofday
+            DO UPDATE SET
+                SurfDifficulty = EXCLUDED.SurfDifficulty,
+                WaveQuality = EXCLUDED.WaveQuality,
+                WindImpact = EXCLUDED.WindImpact,
+                Recommendation = EXCLUDED.Recommendation,
+                QualityScore = EXCLUDED.QualityScore,
+                CreatedAt = NOW()
+        """)
+        written = cur.rowcount
+    conn.commit()
+    return written
+
+
+class Throttle:
+    """
+    Keeps the backfill below a row rate and out of the way of a busy database.
+
+    @param conn: Connection used to look at the other queries.
+    @param max_rows_per_second: Upper bound of the average write rate, None for no bound.
+    @param max_active_queries: Pause while more queries than this are active, None to never pause.
+    """
+
+    def __init__(self, conn, max_rows_per_second=None, max_active_queries=None):
+        self.conn = conn
+        self.max_rows_per_second = max_rows_per_second
+        self.max_active_queries = max_active_queries
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def wait(self, rows):
+        self.rows += rows
+        if self.max_rows_per_second:
+            ahead = self.rows / self.max_rows_per_second - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        while self.max_active_queries is not None:
+            with self.conn.cursor() as cur:
+                cur.execute(ACTIVE_QUERIES_SQL)
+                active = cur.fetchone()[0]
+            self.conn.commit()
+            if active <= self.max_active_queries:
+                break
+            print(f"{active} active queries, pausing for {PAUSE_SECONDS}s")
+            metrics.increment('rescore_pauses')
+            time.sleep(PAUSE_SECONDS)
+            # The pause does not count against the row rate
+            self.started += PAUSE_SECONDS
+
+
+def plan_chunks(conn, location_ids=None, since=None, until=None):
+    """
+    Splits the history into chunks of CHUNK_LOCATIONS locations and one calendar year.
+
+    @return: List of (key, location ids, first day, day after the last day) in location and time order.
+    """
+    with conn.cursor() as cur:
+        if location_ids is None:
+            cur.execute("SELECT LocationID FROM Locations ORDER BY LocationID")
+            location_ids = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT MIN(Date), MAX(Date) FROM SeaConditions")
+        first, last = cur.fetchone()
+    conn.commit()
+    if first is None:
+        return []
+    first = max(first, since) if since else first
+    last = min(last, until) if until else last
+
+    chunks = []
+    for i in range(0, len(location_ids), CHUNK_LOCATIONS):
+        members = sorted(location_ids[i:i + CHUNK_LOCATIONS])
+        for year in range(first.year, last.year + 1):
+            start = max(datetime.date(year, 1, 1), first)
+            end = min(datetime.date(year + 1, 1, 1), last + datetime.timedelta(days=1))
+            # The days are part of the key, a checkpoint of another date range does not skip this chunk
+            chunks.append((f"{members[0]}-{members[-1]}:{start.isoformat()}:{end.isoformat()}", members, start, end))
+    return chunks
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'done': [], 'rows': 0}
+
+
+def write_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def rescore_chunk(read_conn, write_conn, executor, workers, throttle, key, location_ids, start, end):
+    """
+    Streams one chunk through the worker pool and upserts the scored batches as they come back.
+
+    @return: The number of rows written.
+    """
+    written = 0
+    running = set()
+
+    def collect(return_when):
+        nonlocal written, running
+        done, running = wait(running, return_when=return_when)
+        for future in done:
+            rows = upsert_batch(write_conn, future.result())
+            written += rows
+            throttle.wait(rows)
+
+    with read_conn.cursor(name=f"rescore_{key.replace('-', '_').replace(':', '_')}") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(CHUNK_SQL, (location_ids, start, end))
+        while True:
+            rows = cur.fetchmany(BATCH_ROWS)
+            if not rows:
+                break
+            values = np.array([row[2:] for row in rows], dtype=np.float64)
+            running.add(executor.submit(score_batch, np.array([row[0] for row in rows]), [row[1] for row in rows], values))
+            # At most two batches per worker in flight, reading waits for the upserts
+            if len(running) >= 2 * workers:
+                collect(FIRST_COMPLETED)
+    read_conn.commit()
+    if running:
+        collect(ALL_COMPLETED)
+    return written
+
+
+def run_backfill(chunks, workers, checkpoint_path=CHECKPOINT_FILE, max_rows_per_second=None, max_active_queries=None):
+    """
+    Re-scores every chunk not yet in the checkpoint.
+
+    @return: The number of rows written by this run.
+    """
+    register_decimal_typecaster()
+    state = read_checkpoint(checkpoint_path)
+    done = set(state['done'])
+    pending = [chunk for chunk in chunks if chunk[0] not in done]
+    print(f"{len(pending)} chunks to re-score, {len(chunks) - len(pending)} done")
+
+    read_conn = psycopg2.connect(**DB_CONFIG)
+    write_conn = psycopg2.connect(**DB_CONFIG)
+    throttle = Throttle(write_conn, max_rows_per_second, max_active_queries)
+    total = 0
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            for key, location_ids, start, end in pending:
+                with metrics.timer('rescore_chunk_seconds'):
+                    written = rescore_chunk(read_conn, write_conn, executor, workers, throttle, key, location_ids, start, end)
+                total += written
+                metrics.increment('rows_written', written, table='computedseaconditions')
+                state['done'].append(key)
+                state['rows'] += written
+                write_checkpoint(checkpoint_path, state)
+                print(f"Chunk {key}: {written} rows, {total} this run, {state['rows']} in total")
+    finally:
+        read_conn.close()
+        write_conn.close()
+    return total
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score the SeaConditions history into ComputedSeaConditions")
+    parser.add_argument("--since", type=parse_date, help="first day to re-score, YYYY-MM-DD")
+    parser.add_argument("--until", type=parse_date, help="last day to re-score, YYYY-MM-DD")
+    parser.add_argument("--locations", help="comma separated location ids, all by default")
+    parser.add_argument("--workers", type=int, default=2, help="scoring processes, keep low next to the pipeline")
+    parser.add_argument("--max-rows-per-second", type=float, help="upper bound of the write rate")
+    parser.add_argument("--max-active-queries", type=int, default=4, help="pause while more other queries are active")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and re-score everything")
+    args = parser.parse_args()
+    owns_run = metrics.start_run()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        location_ids = [int(value) for value in args.locations.split(",")] if args.locations else None
+        chunks = plan_chunks(conn, location_ids, args.since, args.until)
+    finally:
+        conn.close()
+
+    started = time.perf_counter()
+    rows = run_backfill(chunks, args.workers, args.checkpoint, args.max_rows_per_second, args.max_active_queries)
+    elapsed = time.perf_counter() - started
+    print(f"Re-scored {rows} rows in {elapsed:.0f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
+    if owns_run:
+        metrics.write_run_report()
@@ -0,0 +1,229 @@
+import argparse
+import datetime
+import gzip
+import os
+import shutil
+
+import psycopg2
+
+from database.db_constants import DAILY_ROLLUP_RETENTION_DAYS, DB_CONFIG, HOURLY_RETENTION_DAYS, RETENTION_ARCHIVE_DIR
+from history_loader import COLUMN_SQL, HISTORY_COLUMNS, ROLLUP_TABLES, rollup_column
+
+"""
+  Tiered retention of the SeaConditions history:
+
+      hourly    SeaConditions, the last HOURLY_RETENTION_DAYS days used by the forecasters
+      daily     SeaConditionsDaily, the DAILY_ROLLUP_RETENTION_DAYS days before that
+      weekly    SeaConditionsWeekly, everything older
+
+  Hourly rows past the window are rolled up chunk by chunk, every chunk a few whole weeks. A chunk is copied to
+  <RETENTION_ARCHIVE_DIR>/seaconditions-<first day>-<last day>.csv.gz, its daily and weekly aggregates are
+  inserted and its rows deleted in one transaction, so a stopped run leaves every hour either hourly or rolled
+  up. Both rollups are computed from the hourly rows, the weekly percentiles are exact.
+
+  Hours of an already rolled up week which arrive late are archived and deleted without changing its rollup.
+"""
+
+# Weeks rolled up per transaction and archive file
+CHUNK_WEEKS = 4
+
+PERCENTILES = [10, 50, 90]
+
+# Directions are averaged on the circle and only their mean is kept
+CIRCULAR_COLUMNS = ['wavedirection', 'windwavedirection', 'swellwavedirection', 'winddirection']
+
+
+def rollup_columns():
+    """
+    Columns of the rollup tables besides LocationID, PeriodStart and Hours, with the aggregate computing them.
+    """
+    columns = []
+    for column in HISTORY_COLUMNS:
+        if column in CIRCULAR_COLUMNS:
+            mean = f"degrees(atan2(AVG(sin(radians({column}))), AVG(cos(radians({column})))))"
+            columns.append((rollup_column(column, 'mean'), f"CASE WHEN {mean} < 0 THEN {mean} + 360 ELSE {mean} END"))
+            continue
+        columns.append((rollup_column(column, 'mean'), f"AVG({column})"))
+        columns.append((rollup_column(column, 'max'), f"MAX({column})"))
+        for percentile in PERCENTILES:
+            columns.append((rollup_column(column, f"p{percentile}"),
+                            f"percentile_cont({percentile / 100}) WITHIN GROUP (ORDER BY {column})"))
+    return columns
+
+
+def create_rollup_tables(cur):
+    for table, _ in ROLLUP_TABLES:
+        columns = ",\n".join(f"            {name} REAL" for name, _ in rollup_columns())
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                LocationID INT REFERENCES Locations(LocationID),
+                PeriodStart DATE,
+                Hours INT,
+{columns},
+                PRIMARY KEY (LocationID, PeriodStart)
+            )
+        """)
+    # Chunks are selected and deleted by day
+    cur.execute("CREATE INDEX IF NOT EXISTS seaconditions_date_idx ON SeaConditions (Date)")
+
+
+def rollup_sql(table, period):
+    """
+    Builds the query aggregating the hourly rows of a chunk into one rollup row per location and day or week.
+    """
+    hourly = ", ".join(["LocationID", "Date"] + [f"({COLUMN_SQL.get(column, column)})::float8 AS {column}"
+                                                 for column in HISTORY_COLUMNS])
+    columns = rollup_columns()
+    return f"""
+        INSERT INTO {table} (LocationID, PeriodStart, Hours, {', '.join(name for name, _ in columns)})
+        SELECT LocationID, date_trunc('{period}', Date)::date, COUNT(*), {', '.join(aggregate for _, aggregate in columns)}
+        FROM (
+            SELECT {hourly} FROM SeaConditions
+            WHERE Date >= %(start)s AND Date < %(end)s AND DeletedAt IS NULL
+        ) hourly
+        GROUP BY 1, 2
+        ON CONFLICT (LocationID, PeriodStart) DO NOTHING
+    """
+
+
+def week_start(day):
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def archive_chunk(cur, start, end, directory):
+    """
+    Writes the hourly rows of a chunk to a temporary gzipped CSV file next to its final name.
+
+    @return: (temporary path, final path).
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"seaconditions-{start.isoformat()}-{(end - datetime.timedelta(days=1)).isoformat()}.csv.gz")
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        cur.copy_expert(cur.mogrify(
+            "COPY (SELECT * FROM SeaConditions WHERE Date >= %s AND Date < %s ORDER BY LocationID, Date, TimeOfDay) "
+            "TO STDOUT WITH (FORMAT csv, HEADER)", (start, end)
+        ).decode(), f)
+    return tmp_path, path
+
+
+def publish_archive(tmp_path, path):
+    """
+    Moves an archive in place once its rows are deleted. Late rows of a chunk archived before are appended, a
+    file of concatenated gzip members is still one valid gzip stream.
+    """
+    if not os.path.exists(path):
+        os.replace(tmp_path, path)
+        return
+    with open(path, "ab") as target, open(tmp_path, "rb") as source:
+        shutil.copyfileobj(source, target)
+    os.remove(tmp_path)
+
+
+def roll_up_chunk(conn, start, end, archive_dir):
+    """
+    Archives, rolls up and deletes the hourly rows of days start (inclusive) to end (exclusive), whole weeks.
+
+    @return: The number of hourly rows removed.
+    """
+    tmp_path = None
+    try:
+        with conn.cursor() as cur:
+            if archive_dir:
+                tmp_path, path = archive_chunk(cur, start, end, archive_dir)
+            for (table, _), period in zip(ROLLUP_TABLES, ['day', 'week']):
+                cur.execute(rollup_sql(table, period), {'start': start, 'end': end})
+            cur.execute("DELETE FROM SeaConditions WHERE Date >= %s AND Date < %s", (start, end))
+            deleted = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if tmp_path:
+        publish_archive(tmp_path, path)
+    return deleted
+
+
+def run_retention(conn, hourly_days, daily_days, archive_dir=RETENTION_ARCHIVE_DIR, today=None):
+    """
+    Rolls up hourly rows older than hourly_days and drops daily rollups older than daily_days more.
+
+    @param conn: An open psycopg2 connection.
+    @param hourly_days: Days of hourly history kept.
+    @param daily_days: Days of daily rollups kept before the hourly window.
+    @param archive_dir: Directory of the CSV archive, None deletes without archiving.
+    @param today: The day the windows end, today by default.
+
+    @return: Dictionary with the number of hourly rows and daily rollups removed.
+    """
+    # The loaders only read the rollups while HOURLY_RETENTION_DAYS is set, other windows would lose history
+    if HOURLY_RETENTION_DAYS is None or hourly_days != HOURLY_RETENTION_DAYS:
+        raise ValueError(f"hourly_days {hourly_days} does not match HOURLY_RETENTION_DAYS {HOURLY_RETENTION_DAYS}")
+    today = today or datetime.date.today()
+    # Cutoffs fall on week starts, so no week is split between the hourly rows and the rollups
+    hourly_cutoff = week_start(today - datetime.timedelta(days=hourly_days))
+    daily_cutoff = week_start(hourly_cutoff - datetime.timedelta(days=daily_days))
+    with conn.cursor() as cur:
+        create_rollup_tables(cur)
+        cur.execute("SELECT MIN(Date) FROM SeaConditions WHERE Date < %s", (hourly_cutoff,))
+        oldest = cur.fetchone()[0]
+    conn.commit()
+
+    removed = 0
+    if oldest is not None:
+        start = week_start(oldest)
+        while start < hourly_cutoff:
+            end = min(start + datetime.timedelta(weeks=CHUNK_WEEKS), hourly_cutoff)
+            deleted = roll_up_chunk(conn, start, end, archive_dir)
+            print(f"Rolled up {deleted} hourly rows from {start} to {end - datetime.timedelta(days=1)}")
+            removed += deleted
+            start = end
+
+    daily_table = ROLLUP_TABLES[0][0]
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {daily_table} WHERE PeriodStart < %s", (daily_cutoff,))
+        pruned = cur.rowcount
+    conn.commit()
+    print(f"Retention: {removed} hourly rows rolled up before {hourly_cutoff}, {pruned} daily rollups dropped before {daily_cutoff}")
+    return {'hourly_rows': removed, 'daily_rollups': pruned}
+
+
+def vacuum(conn):
+    """
+    Returns the space of the deleted rows to the table and refreshes the planner statistics.
+    """
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM (ANALYZE) SeaConditions")
+    conn.autocommit = False
+
+
+if __name__ == "__main__":
+    """
+      Runs the retention job, e.g. after the nightly pipeline:
+          python retention.py
+          python retention.py --no-archive --vacuum
+    """
+    parser = argparse.ArgumentParser(description="Roll up and archive old SeaConditions history")
+    parser.add_argument("--hourly-days", type=int, default=HOURLY_RETENTION_DAYS,
+                        help="days of hourly history kept, has to match HOURLY_RETENTION_DAYS")
+    parser.add_argument("--daily-days", type=int, default=DAILY_ROLLUP_RETENTION_DAYS, help="days of daily rollups kept")
+    parser.add_argument("--archive-dir", default=RETENTION_ARCHIVE_DIR)
+    parser.add_argument("--no-archive", action="store_true", help="delete rolled up rows without archiving them")
+    parser.add_argument("--vacuum", action="store_true", help="vacuum SeaConditions afterwards")
+    args = parser.parse_args()
+    if HOURLY_RETENTION_DAYS is None:
+        parser.error("retention is disabled, set HOURLY_RETENTION_DAYS so the loaders read the rollups")
+    if args.hourly_days != HOURLY_RETENTION_DAYS:
+        parser.error(f"--hourly-days has to match HOURLY_RETENTION_DAYS ({HOURLY_RETENTION_DAYS}), "
+                     "the loaders read the rollups as of that window")
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        run_retention(conn, args.hourly_days, args.daily_days, None if args.no_archive else args.archive_dir)
+        if args.vacuum:
+            vacuum(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,139 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from history_loader import FETCH_SIZE, HISTORY_COLUMNS, history_count_sql, history_sql, register_decimal_typecaster
+
+"""
+  History of all locations of a run in one contiguous float32 block of shared memory.
+
+  The parent process loads every history once and the training workers attach to the block and take zero-copy
+  NumPy views, so memory stays flat as the number of workers grows. The block has one row per column and the
+  locations one after another along the second axis, every (column, location) slice is contiguous:
+
+      block[column, offset:offset + length]
+"""
+
+
+class SharedHistory:
+    """
+    Histories of many locations in one shared memory block.
+
+    @param shm: The SharedMemory holding the block.
+    @param index: Dictionary mapping location ids to (offset, length).
+    @param columns: The columns of the block, in row order.
+    @param width: Allocated rows per column, defaults to the sum of the lengths in index. Locations may end up
+                  shorter than allocated, so the width has to travel with the block.
+    """
+
+    def __init__(self, shm, index, columns, width=None):
+        self.shm = shm
+        self.index = index
+        self.columns = list(columns)
+        self.width = sum(length for _, length in index.values()) if width is None else width
+        self.block = np.ndarray((len(self.columns), self.width), dtype=np.float32, buffer=shm.buf)
+
+    @classmethod
+    def allocate(cls, lengths, columns=HISTORY_COLUMNS):
+        """
+        Creates an uninitialised block for the given number of rows per location.
+        """
+        index = {}
+        offset = 0
+        for location_id, length in lengths.items():
+            index[location_id] = (offset, length)
+            offset += length
+        size = max(1, offset * len(columns) * np.dtype(np.float32).itemsize)
+        return cls(shared_memory.SharedMemory(create=True, size=size), index, columns)
+
+    @classmethod
+    def from_database(cls, conn, location_ids, columns=HISTORY_COLUMNS):
+        """
+        Loads the histories of all locations with one streamed query.
+        """
+        register_decimal_typecaster()
+        with conn.cursor() as cur:
+            cur.execute(history_count_sql(where="LocationID = ANY(%s)", keys=["LocationID"]), (list(location_ids),))
+            counts = dict(cur.fetchall())
+        shared = cls.allocate({location_id: counts.get(location_id, 0) for location_id in location_ids}, columns)
+
+        filled = {location_id: 0 for location_id in location_ids}
+        with conn.cursor(name="shared_history") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(
+                history_sql(columns, where="LocationID = ANY(%s)", keys=["LocationID"], order_by="LocationID, Date, TimeOfDay"),
+                (list(location_ids),)
+            )
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                location_column = np.array([row[0] for row in rows])
+                values = np.array([row[1:] for row in rows], dtype=np.float32).T
+                # Rows come grouped by location, copy every run of one location at once
+                starts = np.flatnonzero(np.r_[True, location_column[1:] != location_column[:-1]])
+                ends = np.r_[starts[1:], len(rows)]
+                for start, end in zip(starts, ends):
+                    location_id = int(location_column[start])
+                    offset, length = shared.index[location_id]
+                    position = filled[location_id]
+                    # Rows inserted after counting are left out
+                    count = min(end - start, length - position)
+                    shared.block[:, offset + position:offset + position + count] = values[:, start:start + count]
+                    filled[location_id] += count
+        conn.commit()
+        # Shrink locations which lost rows after counting
+        shared.index = {location_id: (offset, filled[location_id]) for location_id, (offset, _) in shared.index.items()}
+        return shared
+
+    @classmethod
+    def from_store(cls, store, location_ids, columns=HISTORY_COLUMNS):
+        """
+        Copies the histories of all locations from a local HistoryStore.
+        """
+        histories = {location_id: store.read(location_id, columns) for location_id in location_ids}
+        shared = cls.allocate({location_id: len(history[columns[0]]) for location_id, history in histories.items()}, columns)
+        for location_id, history in histories.items():
+            offset, length = shared.index[location_id]
+            for row, column in enumerate(columns):
+                shared.block[row, offset:offset + length] = history[column]
+        return shared
+
+    def handle(self):
+        """
+        Picklable description of the block passed to worker processes.
+        """
+        return self.shm.name, self.index, self.columns, self.width
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attaches to a block created by another process.
+        """
+        name, index, columns, width = handle
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with the resource tracker again. Forked, spawned
+            # and forkserver workers all share the tracker of the parent, which keeps one registration per name,
+            # so this is a no-op. Unregistering here would drop the registration of the parent, only the
+            # parent unregisters, when it unlinks the block.
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, index, columns, width)
+
+    def read(self, location_id, columns=None):
+        """
+        Returns zero-copy float32 views of the history of one location, the format of history_loader.load_history.
+        """
+        offset, length = self.index[location_id]
+        return {column: self.block[self.columns.index(column), offset:offset + length] for column in (columns or self.columns)}
+
+    def __contains__(self, location_id):
+        return location_id in self.index
+
+    def close(self):
+        del self.block
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -2,9 +2,7 @@
 
 # Log file locations
 STARTUP_LOG="/var/log/startup-script.log"
-WEATHER_LOG="/var/log/weather_request.log"
-PREDICTION_LOG="/var/log/prediction_calculation.log"
-QUALITY_LOG="/var/log/quality_calculation.log"
+PIPELINE_LOG="/var/log/pipeline.log"
 
 # Ensure log directory exists
 mkdir -p /var/log
@@ -23,47 +21,35 @@ log_and_execute() {
 
 echo "Starting startup script..." | tee -a $STARTUP_LOG
 
-# Update package list and install required packages
-log_and_execute "apt-get update"
-log_and_execute "apt-get install -y python3-pip python3-venv google-cloud-sdk"
-
-# Create a virtual environment
-log_and_execute "python3 -m venv env"
+# Install system packages and Python dependencies only when the image does not have them yet.
+# The environment is built once, a boot with unchanged requirements goes straight to the pipeline.
+if [[ ! -d env ]]; then
+    log_and_execute "apt-get update"
+    log_and_execute "apt-get install -y python3-pip python3-venv google-cloud-sdk"
+    log_and_execute "python3 -m venv env"
+fi
 log_and_execute "source env/bin/activate"
 
-# Download the requirements fixwle
-log_and_execute "gsutil cp gs://weatherserver/requirements.txt ."
-
-# Install Python package dependencies
-log_and_execute "pip install -r requirements.txt"
-
-# Download the Python scripts from Google Cloud Storage
-log_and_execute "gsutil cp gs://weatherserver/weather_request.py ."
-log_and_execute "gsutil cp gs://weatherserver/prediction_calculation.py ."
-log_and_execute "gsutil cp gs://weatherserver/quality_calculation.py ."
-log_and_execute "gsutil cp gs://weatherserver/database/db_constants.py ."
-log_and_execute "gsutil cp gs://weatherserver/lstm_time_series_predictor.py ."
+# Download the server code from Google Cloud Storage
+log_and_execute "gsutil -m rsync -r gs://weatherserver weather_server"
 
-# Ensure the scripts are executable
-chmod +x weather_request.py
-chmod +x prediction_calculation.py
-chmod +x quality_calculation.py
-
-# Run the main Python scripts and log the output
-log_and_execute "python3 weather_request.py"
-WEATHER_EXIT_CODE=$?
-
-log_and_execute "python3 prediction_calculation.py"
-PREDICTION_EXIT_CODE=$?
+# Install Python package dependencies when requirements.txt changed since the last install
+REQUIREMENTS_HASH=$(sha256sum weather_server/requirements.txt | cut -d' ' -f1)
+if [[ ! -f env/.requirements.sha256 || "$(cat env/.requirements.sha256)" != "$REQUIREMENTS_HASH" ]]; then
+    log_and_execute "pip install -r weather_server/requirements.txt"
+    echo "$REQUIREMENTS_HASH" > env/.requirements.sha256
+fi
 
-log_and_execute "python3 quality_calculation.py"
-QUALITY_EXIT_CODE=$?
+# Run ingest, forecast and score, resuming today's checkpoint if an earlier boot stopped halfway
+echo "Executing: python3 -m weather_server.pipeline run" | tee -a $STARTUP_LOG
+python3 -m weather_server.pipeline run >> $PIPELINE_LOG 2>&1
+PIPELINE_EXIT_CODE=$?
 
-# Check for errors in the scripts
-if [[ $WEATHER_EXIT_CODE -ne 0 || $PREDICTION_EXIT_CODE -ne 0 || $QUALITY_EXIT_CODE -ne 0 ]]; then
-    echo "Error detected in one of the Python scripts. Check logs for details." | tee -a $STARTUP_LOG
+# Check for errors in the pipeline
+if [[ $PIPELINE_EXIT_CODE -ne 0 ]]; then
+    echo "Error detected in the pipeline. Check $PIPELINE_LOG for details." | tee -a $STARTUP_LOG
 else
-    echo "All scripts executed successfully." | tee -a $STARTUP_LOG
+    echo "Pipeline executed successfully." | tee -a $STARTUP_LOG
 fi
 
 # Shutdown the VM after the script completes
@@ -0,0 +1,188 @@
+import datetime
+import hashlib
+
+import numpy as np
+
+"""
+  Synthetic hourly marine and weather series for benchmarks, deterministic for a given seed.
+
+  The series follow the shape of Irish coastal data closely enough for the pipeline to do realistic work:
+  swell driven by the season with multi-day storms, wind waves driven by a gusty wind, periods growing with the
+  sea state and directions drifting around the prevailing westerlies. Responses of the two upstream APIs are
+  generated from the same series, so a stubbed ingest stores data that looks like the seeded history.
+"""
+
+# Variables requested from the marine API, in the order of weather_request.get_marine_weather
+MARINE_VARIABLES = [
+    "wave_height", "wave_direction", "wave_period",
+    "wind_wave_height", "wind_wave_direction", "wind_wave_period", "wind_wave_peak_period",
+    "swell_wave_height", "swell_wave_direction", "swell_wave_period", "swell_wave_peak_period",
+]
+
+COMPASS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+ICON = "//cdn.weatherapi.com/weather/64x64/day/116.png"
+
+# Rough outline of the Irish coast, beaches are placed on it
+COAST_CENTER = (53.4, -8.0)
+COAST_RADIUS = (1.9, 2.6)
+
+
+def rng_for(*key):
+    """
+    Random generator seeded from any key, stable across processes and Python versions.
+    """
+    digest = hashlib.sha256(repr(key).encode("utf-8")).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], "little"))
+
+
+def generate_locations(count, seed=0):
+    """
+    Beaches spread along the coast.
+
+    @return: List of (name, latitude, longitude).
+    """
+    rng = rng_for("locations", seed)
+    angles = rng.uniform(0, 2 * np.pi, count)
+    latitudes = COAST_CENTER[0] + COAST_RADIUS[0] * np.sin(angles) + rng.normal(0, 0.05, count)
+    longitudes = COAST_CENTER[1] + COAST_RADIUS[1] * np.cos(angles) + rng.normal(0, 0.05, count)
+    return [(f"Synthetic Beach {i + 1}", round(float(lat), 5), round(float(lon), 5))
+            for i, (lat, lon) in enumerate(zip(latitudes, longitudes))]
+
+
+def _ar1(rng, n, phi, sigma):
+    """
+    AR(1) noise, the slowly varying part of storms and wind.
+    """
+    from scipy.signal import lfilter
+
+    shocks = rng.normal(0, sigma, n)
+    # Start from the stationary distribution instead of zero
+    shocks[0] /= np.sqrt(1 - phi ** 2)
+    return lfilter([1.0], [1.0, -phi], shocks)
+
+
+def generate_conditions(start, hours, rng):
+    """
+    Hourly conditions starting at start.
+
+    @param start: datetime of the first hour.
+    @param hours: Number of hours.
+    @param rng: numpy Generator, e.g. from rng_for.
+
+    @return: Dictionary of float arrays: the MARINE_VARIABLES plus wind_kph, wind_degree and temp_c.
+    """
+    hour_of_year = (start - datetime.datetime(start.year, 1, 1)).total_seconds() / 3600 + np.arange(hours)
+    # 1 in mid January, 0 in mid July
+    winter = 0.5 * (1 + np.cos(2 * np.pi * (hour_of_year / 24 - 15) / 365.25))
+    hour_of_day = (start.hour + np.arange(hours)) % 24
+
+    storm = _ar1(rng, hours, 0.995, 0.03)
+    swell_height = (0.7 + 1.8 * winter) * np.exp(storm)
+    wind_kph = np.clip((12 + 14 * winter) * np.exp(_ar1(rng, hours, 0.97, 0.12) + 0.5 * storm)
+                       + 3 * np.sin(2 * np.pi * (hour_of_day - 14) / 24), 0, None)
+    wind_wave_height = 0.0035 * wind_kph ** 1.6 + np.abs(rng.normal(0, 0.05, hours))
+    wave_height = np.sqrt(swell_height ** 2 + wind_wave_height ** 2)
+
+    swell_period = np.clip(9 + 3 * winter + 2 * storm + _ar1(rng, hours, 0.98, 0.2), 5, 20)
+    wind_wave_period = np.clip(1.5 + 0.9 * np.sqrt(wind_kph), 1, 12)
+    wave_period = np.where(swell_height > wind_wave_height, swell_period, wind_wave_period)
+
+    # Prevailing south westerlies veering by about 70 degrees
+    wind_degree = (235 + 70 * _ar1(rng, hours, 0.98, 0.2)) % 360
+    swell_direction = (250 + 20 * np.tanh(_ar1(rng, hours, 0.99, 0.05))) % 360
+    wind_wave_direction = (wind_degree + rng.normal(0, 8, hours)) % 360
+    wave_direction = np.where(swell_height > wind_wave_height, swell_direction, wind_wave_direction)
+    temp_c = 14 - 7 * winter + 2.5 * np.sin(2 * np.pi * (hour_of_day - 9) / 24) + _ar1(rng, hours, 0.9, 0.4)
+
+    return {
+        "wave_height": wave_height,
+        "wave_direction": wave_direction,
+        "wave_period": wave_period,
+        "wind_wave_height": wind_wave_height,
+        "wind_wave_direction": wind_wave_direction,
+        "wind_wave_period": wind_wave_period,
+        "wind_wave_peak_period": wind_wave_period * 1.1,
+        "swell_wave_height": swell_height,
+        "swell_wave_direction": swell_direction,
+        "swell_wave_period": swell_period,
+        "swell_wave_peak_period": swell_period * 1.1,
+        "wind_kph": wind_kph,
+        "wind_degree": wind_degree,
+        "temp_c": temp_c,
+    }
+
+
+def compass(degrees):
+    """
+    Converts angles to the 16 point compass names used by weatherapi.com.
+    """
+    return [COMPASS[int(round(degree / 22.5)) % 16] for degree in degrees]
+
+
+def marine_response(latitude, longitude, start, conditions, variables=MARINE_VARIABLES):
+    """
+    Encodes conditions as a size prefixed Open-Meteo flatbuffers message, the wire format read by
+    openmeteo_requests.Client.weather_api.
+
+    @param latitude: Latitude of the grid cell reported back.
+    @param longitude: Longitude of the grid cell reported back.
+    @param start: datetime (UTC) of the first hour.
+    @param conditions: Output of generate_conditions.
+    @param variables: The requested hourly variables, in request order.
+
+    @return: The response body as bytes.
+    """
+    import flatbuffers
+    from openmeteo_sdk.Variable import Variable
+
+    builder = flatbuffers.Builder(4096)
+    hours = len(conditions[variables[0]])
+    values = []
+    for name in variables:
+        vector = builder.CreateNumpyVector(np.asarray(conditions[name], dtype=np.float32))
+        # VariableWithValues: variable (slot 0), values (slot 3)
+        builder.StartObject(13)
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+        builder.PrependUint8Slot(0, getattr(Variable, name, Variable.undefined), 0)
+        values.append(builder.EndObject())
+
+    builder.StartVector(4, len(values), 4)
+    for offset in reversed(values):
+        builder.PrependUOffsetTRelative(offset)
+    variables_vector = builder.EndVector()
+
+    # VariablesWithTime: time, time_end, interval, variables
+    first = int(start.replace(tzinfo=datetime.timezone.utc).timestamp())
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, first, 0)
+    builder.PrependInt64Slot(1, first + 3600 * hours, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    builder.PrependInt32Slot(2, 3600, 0)
+    hourly = builder.EndObject()
+
+    # WeatherApiResponse: latitude (slot 0), longitude (slot 1), hourly (slot 11)
+    builder.StartObject(15)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def weatherapi_response(start, conditions):
+    """
+    The body of a weatherapi.com history.json response with one day of hourly weather.
+    """
+    hours = []
+    for i, (temp_c, wind_kph, wind_dir) in enumerate(zip(conditions["temp_c"], conditions["wind_kph"],
+                                                         compass(conditions["wind_degree"]))):
+        time = start + datetime.timedelta(hours=i)
+        hours.append({
+            "time": time.strftime("%Y-%m-%d %H:%M"),
+            "temp_c": round(float(temp_c), 1),
+            "wind_kph": round(float(wind_kph), 1),
+            "wind_dir": wind_dir,
+            "condition": {"icon": ICON},
+        })
+    return {"forecast": {"forecastday": [{"date": start.strftime("%Y-%m-%d"), "hour": hours}]}}
@@ -0,0 +1,35 @@
+import importlib.util
+import tempfile
+import unittest
+
+"""
+  Parity of the TFLite export against Keras on a small synthetic series, run with
+      python -m unittest test_model_export
+  Needs TensorFlow, skipped without it.
+"""
+
+
+@unittest.skipUnless(importlib.util.find_spec("tensorflow"), "needs TensorFlow")
+class ParityTest(unittest.TestCase):
+
+    def test_tflite_rollout_matches_keras(self):
+        from keras import optimizers
+        from lstm_time_series_predictor import LSTMTimeSeriesPredictor
+        from model_export import parity_errors
+        from parity_check import PARITY_TOLERANCE, synthetic_history
+
+        history, columns = synthetic_history(24 * 14)
+        regression = LSTMTimeSeriesPredictor(optimizer=optimizers.Adam(learning_rate=0.001), look_back=16,
+                                             epochs=1, batch_size=16, neurons=16)
+        regression.train_and_predict(history, target_columns=columns[:1], steps=24)
+        with tempfile.TemporaryDirectory() as directory:
+            regression.export(directory, history)
+            errors = parity_errors(regression.models, history, directory, regression.look_back, steps=24)
+
+        self.assertEqual(set(errors), set(columns[:1]))
+        for column, error in errors.items():
+            self.assertLessEqual(error, PARITY_TOLERANCE, column)
+
+
+if __name__ == "__main__":
+    unittest.main()
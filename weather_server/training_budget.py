@@ -0,0 +1,79 @@
+import json
+import time
+
+import numpy as np
+
+"""
+  Keeps the nightly training inside its window. Every grid cell gets a share of the remaining worker time
+  proportional to its priority, training stops cleanly when that share is used up, and cells that can not be
+  reached in time get a cheap seasonal baseline forecast instead of no forecast at all.
+"""
+
+# Seconds kept free at the end of the window for scoring and shutdown
+RESERVE_SECONDS = 15 * 60
+# Seconds per cell for loading, rollout and storing the predictions
+OVERHEAD_SECONDS = 60
+# Seconds per trained cell for converting and writing its models, after training stopped
+EXPORT_SECONDS = 60
+# Cells with a smaller training share fall back to the baseline
+MIN_TRAINING_SECONDS = 120
+
+
+def allocate_budgets(deadline, priorities, workers, cells=None, reserve_seconds=RESERVE_SECONDS,
+                     overhead_seconds=OVERHEAD_SECONDS + EXPORT_SECONDS, min_seconds=MIN_TRAINING_SECONDS):
+    """
+    Splits the worker time left until the deadline between the cells, proportionally to their priority.
+    Cells whose share would be below min_seconds get no training budget, their share goes to the others,
+    lowest priorities are dropped first.
+
+    @param deadline: Wall clock time (time.time()) the run has to finish by.
+    @param priorities: Dictionary mapping cell keys to positive priorities.
+    @param workers: Number of parallel training processes.
+    @param cells: Number of cells in the run, including the ones that are not trained, all of them spend the
+                  overhead. Defaults to the number of priorities.
+
+    @return: Dictionary mapping cell keys to training seconds, 0 meaning baseline forecast.
+    """
+    available = (deadline - time.time() - reserve_seconds) * workers - overhead_seconds * (cells or len(priorities))
+    candidates = sorted(priorities, key=lambda key: priorities[key], reverse=True)
+    while candidates:
+        total_priority = sum(priorities[key] for key in candidates)
+        budgets = {key: available * priorities[key] / total_priority for key in candidates}
+        if min(budgets.values()) >= min_seconds:
+            return {key: budgets.get(key, 0.0) for key in priorities}
+        candidates.pop()
+    return {key: 0.0 for key in priorities}
+
+
+def baseline_forecast(y, steps, season=24):
+    """
+    Seasonal naive forecast repeating the last day of the history.
+
+    @param y: The history of one column.
+    @param steps: The number of future time steps to predict.
+
+    @return: np.array of predicted values.
+    """
+    y = np.asarray(y, dtype=float)
+    y = y[~np.isnan(y)]
+    if len(y) == 0:
+        return np.zeros(steps)
+    last_season = y[-season:]
+    return np.resize(last_season, steps)
+
+
+def write_report(path, entries, deadline):
+    """
+    Writes what every cell received and used to a JSON report and prints a summary.
+    """
+    report = {
+        "deadline": deadline,
+        "finished": time.time(),
+        "on_time": deadline is None or time.time() <= deadline,
+        "cells": entries,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    counts = {mode: sum(1 for entry in entries if entry["mode"] == mode) for mode in ["lstm", "reroll", "baseline", "failed"]}
+    print(f"Training report: {counts['lstm']} cells trained, {counts['reroll']} rerolled, {counts['baseline']} baseline, "
+          f"{counts['failed']} failed, written to {path}")
@@ -0,0 +1,241 @@
+import base64
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+"""
+  One HTTP client layer for every upstream API (Open-Meteo, weatherapi.com, Overpass and Positionstack).
+
+  Every endpoint gets its own session with:
+      - pooled keep-alive connections and retry with backoff on transient errors
+      - a persistent sqlite response cache with a per-endpoint time to live
+      - a token bucket for the request rate and a daily quota shared by all processes of the day
+      - a record/replay mode, so full ingest runs can be benchmarked offline
+
+  The mode is taken from the UPSTREAM_MODE environment variable:
+      live    (default) talk to the APIs
+      record  talk to the APIs and store every response in UPSTREAM_REPLAY_DIR
+      replay  only serve responses from UPSTREAM_REPLAY_DIR, never touch the network
+"""
+
+CACHE_DIR = ".upstream_cache"
+REPLAY_DIR = os.environ.get("UPSTREAM_REPLAY_DIR", "upstream_replay")
+MODE = os.environ.get("UPSTREAM_MODE", "live")
+
+# Query parameters holding API keys, left out of cache and replay keys
+SECRET_PARAMETERS = ["key", "access_key"]
+
+ENDPOINTS = {
+    # ttl in seconds, rate in requests per second, daily_quota in requests per day
+    "open-meteo": {"ttl": 3600, "rate": 5, "daily_quota": 10000},
+    # History of a past day does not change anymore
+    "weatherapi": {"ttl": 7 * 24 * 3600, "rate": 5, "daily_quota": 30000},
+    "overpass": {"ttl": 24 * 3600, "rate": 1, "daily_quota": 1000},
+    # Free plan is 25000 requests a month
+    "positionstack": {"ttl": 30 * 24 * 3600, "rate": 10, "daily_quota": 800},
+}
+
+
+class QuotaExceeded(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request once the daily quota of an endpoint is used up.
+    """
+
+
+class ReplayMiss(requests.exceptions.ConnectionError):
+    """
+    Raised in replay mode when no recorded response exists for a request.
+    """
+
+
+def normalise_coordinates(latitude, longitude, decimals=3):
+    """
+    Rounds coordinates so requests for the same spot share one cache entry. Three decimals are about 100 m,
+    far below the resolution of the weather models.
+    """
+    return round(float(latitude), decimals), round(float(longitude), decimals)
+
+
+class TokenBucket:
+    """
+    Limits the request rate to `rate` per second with bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class DailyQuota:
+    """
+    Counts the network requests of one endpoint per day in a small file, so the quota holds across the
+    separate processes of a nightly run. Reads and updates of the file hold an exclusive lock on a lock file
+    next to it, so concurrent processes do not lose counts.
+    """
+
+    def __init__(self, name, limit):
+        self.limit = limit
+        self.path = os.path.join(CACHE_DIR, f"{name}.quota.json")
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock excludes other processes, the threads of this process share its descriptor and need the lock
+        with self.lock, open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def used(self):
+        with self._locked():
+            return self._read().get(datetime.date.today().isoformat(), 0)
+
+    def check(self):
+        if self.used() >= self.limit:
+            raise QuotaExceeded(f"Daily quota of {self.limit} requests used up for {self.path}")
+
+    def add(self):
+        with self._locked():
+            today = datetime.date.today().isoformat()
+            counts = {today: self._read().get(today, 0) + 1}
+            tmp_path = f"{self.path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(counts, f)
+            os.replace(tmp_path, self.path)
+
+
+def request_key(method, url, params):
+    """
+    Stable key of a request used for replay files, without API keys.
+    """
+    items = sorted((k, str(v)) for k, v in (params or {}).items() if k not in SECRET_PARAMETERS)
+    raw = json.dumps([method.upper(), url, items])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class UpstreamSession(requests_cache.CachedSession):
+    """
+    Cached, pooled session of one upstream endpoint. Usable anywhere a requests.Session is expected,
+    e.g. as the session of openmeteo_requests.Client.
+    """
+
+    def __init__(self, name, ttl, rate, daily_quota, pool_size=16, retries=5, backoff_factor=0.2):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        super().__init__(
+            os.path.join(CACHE_DIR, name),
+            backend="sqlite",
+            expire_after=ttl,
+            ignored_parameters=SECRET_PARAMETERS,
+        )
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.quota = DailyQuota(name, daily_quota)
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "POST"])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, params=None, **kwargs):
+        key = request_key(method, url, params)
+        if MODE == "replay":
+            return self._replay(key, url)
+
+        prepared = self.prepare_request(requests.Request(method, url, params=params))
+        if not self.cache.contains(request=prepared):
+            self.quota.check()
+            self.bucket.acquire()
+        start = time.perf_counter()
+        response = super().request(method, url, params=params, **kwargs)
+        cached = getattr(response, "from_cache", False)
+        metrics.observe("http_request_seconds", time.perf_counter() - start, endpoint=self.name, cache=str(cached).lower())
+        metrics.increment("http_requests", endpoint=self.name, status=response.status_code)
+        if not cached:
+            self.quota.add()
+
+        if MODE == "record":
+            self._record(key, response)
+        return response
+
+    def _record(self, key, response):
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        with open(os.path.join(REPLAY_DIR, f"{key}.json"), "w") as f:
+            json.dump({
+                "status": response.status_code,
+                "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+                "body": base64.b64encode(response.content).decode("ascii"),
+            }, f)
+
+    def _replay(self, key, url):
+        path = os.path.join(REPLAY_DIR, f"{key}.json")
+        try:
+            with open(path) as f:
+                recorded = json.load(f)
+        except OSError:
+            raise ReplayMiss(f"No recorded response for {url} in {REPLAY_DIR}")
+        response = requests.Response()
+        response.status_code = recorded["status"]
+        response.headers.update(recorded["headers"])
+        response._content = base64.b64decode(recorded["body"])
+        response.url = url
+        response.from_cache = True
+        return response
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def reset_sessions():
+    global _sessions_lock
+    _sessions_lock = threading.Lock()
+    _sessions.clear()
+
+
+# The sqlite cache connection and the pooled sockets of a session must not be shared with forked workers
+os.register_at_fork(after_in_child=reset_sessions)
+
+
+def get_session(name):
+    """
+    Returns the shared session of an endpoint listed in ENDPOINTS, created on first use.
+    """
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = UpstreamSession(name, **ENDPOINTS[name])
+        return _sessions[name]
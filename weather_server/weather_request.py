@@ -1,20 +1,28 @@
 import psycopg2
 import datetime
-import requests
-import openmeteo_requests
-import datetime
-import requests_cache
-from retry_requests import retry
+from psycopg2.extras import execute_values
 
+import metrics
 from database.db_constants import API_WEATHER, DB_CONFIG
+from grid_cells import ensure_grid_columns, grid_key, store_grid_cell
+from upstream_client import get_session, normalise_coordinates
 
-# Establish a connection to the database
-conn = psycopg2.connect(**DB_CONFIG)
+# Upstream endpoints, replaced by the local stubs of the benchmark suite
+MARINE_API_URL = "https://marine-api.open-meteo.com/v1/marine"
+WEATHER_HISTORY_URL = "https://api.weatherapi.com/v1/history.json"
 
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
-retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-openmeteo = openmeteo_requests.Client(session = retry_session)
+# Open-Meteo API client, created on first use
+openmeteo = None
+
+def get_openmeteo():
+    """
+    Returns the Open-Meteo API client on the pooled, cached upstream session.
+    """
+    global openmeteo
+    if openmeteo is None:
+        import openmeteo_requests
+        openmeteo = openmeteo_requests.Client(session = get_session('open-meteo'))
+    return openmeteo
 
 def get_weather_history(latitude,longitude):
     #THis have to run every daypeobably at midnight
@@ -24,10 +32,12 @@ def get_weather_history(latitude,longitude):
     start_date = datetime.datetime.now() - datetime.timedelta(days=1)
     start_date_str = start_date.strftime("%Y-%m-%d")
     # Construct the URL query
-    url = f"https://api.weatherapi.com/v1/history.json?key={API_WEATHER}&q={latitude},{longitude}&dt={start_date_str}&hourly=1"
+    latitude, longitude = normalise_coordinates(latitude, longitude)
+    url = WEATHER_HISTORY_URL
+    params = {"key": API_WEATHER, "q": f"{latitude},{longitude}", "dt": start_date_str, "hourly": 1}
     try:
         # Make GET request to the URL
-        response = requests.get(url)
+        response = get_session('weatherapi').get(url, params=params)
         # Check if request was successful (status code 200)
         if response.status_code == 200:
             # Parse JSON response
@@ -63,47 +73,57 @@ def get_first_location(cur):
         return location_id, location_name, coordinates['latitude'], coordinates['longitude']
     return None, None, None, None
 
-def insert_marine_weather(cur, location_id, date, marine_weather_data):
-    # Convert all values in the dictionary to float
-    #marine_weather_data = {k: float(v) for k, v in marine_weather_data.items()}
-    cur.execute("""
+def insert_marine_weather(cur, location_ids, rows):
+    """
+    Inserts the hourly rows of one grid cell for every member location in a single statement.
+
+    @param location_ids: The locations sharing the grid cell.
+    @param rows: List of (date, marine_weather_data) tuples.
+    """
+    created_at = datetime.datetime.now()
+    values = []
+    for location_id in location_ids:
+        for date, marine_weather_data in rows:
+            values.append((
+                date, marine_weather_data['time_of_day'], location_id,
+                float(marine_weather_data['wave_height']), float(marine_weather_data['wind_wave_height']), float(marine_weather_data['swell_wave_height']),
+                float(marine_weather_data['wave_direction']), float(marine_weather_data['wind_wave_direction']), float(marine_weather_data['swell_wave_direction']),
+                float(marine_weather_data['wave_period']), float(marine_weather_data['wind_wave_period']), float(marine_weather_data['swell_wave_period']),
+                float(marine_weather_data['wind_wave_peak_period']), float(marine_weather_data['swell_wave_peak_period']), float(marine_weather_data['wind_speed']),
+                marine_weather_data['wind_direction'], marine_weather_data['temp_c'], created_at, marine_weather_data['icon']
+            ))
+    execute_values(cur, """
         INSERT INTO SeaConditions (
             Date, TimeOfDay, LocationID, WaveHeight, WindWaveHeight, SwellWaveHeight,
             WaveDirection, WindWaveDirection, SwellWaveDirection, WavePeriod,
             WindWavePeriod, SwellWavePeriod, WindWavePeakPeriod, SwellWavePeakPeriod,
             WindSpeed, WindDirection, Weather, CreatedAt, Icon
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """, (
-        date, marine_weather_data['time_of_day'], location_id,
-        float(marine_weather_data['wave_height']), float(marine_weather_data['wind_wave_height']), float(marine_weather_data['swell_wave_height']),
-        float(marine_weather_data['wave_direction']), float(marine_weather_data['wind_wave_direction']), float(marine_weather_data['swell_wave_direction']),
-        float(marine_weather_data['wave_period']), float(marine_weather_data['wind_wave_period']), float(marine_weather_data['swell_wave_period']),
-        float(marine_weather_data['wind_wave_peak_period']), float(marine_weather_data['swell_wave_peak_period']), float(marine_weather_data['wind_speed']),
-        marine_weather_data['wind_direction'], marine_weather_data['temp_c'],  datetime.datetime.now(), marine_weather_data['icon']
-    ))
+        ) VALUES %s
+    """, values, page_size=1000)
+    metrics.increment('rows_written', len(values), table='seaconditions')
 
-def is_specific_date_data_present(cur, location_id, date):
+def get_locations_missing_date(cur, location_ids, date):
     """
-    Check if data for a specific date is already present in the database for a given location.
+    Returns the locations of the given list which have no data for a specific date yet.
     """
     cur.execute("""
-        SELECT COUNT(*)
+        SELECT DISTINCT LocationID
         FROM SeaConditions
-        WHERE Date = %s AND LocationID = %s
-    """, (date, location_id))
-    count = cur.fetchone()[0]
-    return count > 0
+        WHERE Date = %s AND LocationID = ANY(%s)
+    """, (date, list(location_ids)))
+    present = {row[0] for row in cur.fetchall()}
+    return [location_id for location_id in location_ids if location_id not in present]
 
 def get_all_locations(cur):
     """
     This function fetches all locations from the Locations table in the database.
     """
-    cur.execute("SELECT LocationID, LocationName, Coordinates FROM Locations")
+    cur.execute("SELECT LocationID, LocationName, Coordinates, GridLatitude, GridLongitude FROM Locations")
     rows = cur.fetchall()
     locations = []
     for row in rows:
-        location_id, location_name, coordinates = row
-        locations.append((location_id, location_name, coordinates['latitude'], coordinates['longitude']))
+        location_id, location_name, coordinates, grid_latitude, grid_longitude = row
+        locations.append((location_id, location_name, coordinates['latitude'], coordinates['longitude'], grid_latitude, grid_longitude))
     return locations
 
 def get_marine_weather(latitude, longitude):
@@ -112,7 +132,8 @@ def get_marine_weather(latitude, longitude):
     start_date = datetime.datetime.now() - datetime.timedelta(days=1)
     start_date_str = start_date.strftime("%Y-%m-%d")
 
-    url = "https://marine-api.open-meteo.com/v1/marine"
+    latitude, longitude = normalise_coordinates(latitude, longitude)
+    url = MARINE_API_URL
     params = {
         "latitude": latitude,
         "longitude": longitude,
@@ -132,57 +153,148 @@ def get_marine_weather(latitude, longitude):
         "start_date": start_date_str,
 	    "end_date": start_date_str
     }
-    responses = openmeteo.weather_api(url, params=params)
+    responses = get_openmeteo().weather_api(url, params=params)
     return responses[0]
 
-try:
-    cur = conn.cursor()
-    locations = get_all_locations(cur)
-    for location in locations:
-        location_id, location_name, latitude, longitude = location
-        start_date = datetime.datetime.now() - datetime.timedelta(days=1)
-        start_date_str = start_date.strftime("%Y-%m-%d")
+def build_marine_rows(full_weather, history_weather):
+    """
+    Combines the hourly marine data of Open-Meteo with the hourly weather history of weatherapi.com.
+
+    @return: List of (date, marine_weather_data) tuples.
+    """
+    variables = [full_weather.Variables(v).ValuesAsNumpy() for v in range(11)]
+    rows = []
+    for i in range(0, len(variables[0])):
+        date_format = "%Y-%m-%d %H:%M"
+        date_object = datetime.datetime.strptime(history_weather[i]['time'], date_format)
+        date =  date_object.date()
+        marine_weather_data = {
+            'time_of_day': history_weather[i]['time'],
+            'wind_speed': history_weather[i]['wind_kph'] if history_weather[i] and i < len(history_weather) else None,
+            'wind_direction': history_weather[i]['wind_dir'] if history_weather[i] and i < len(history_weather) else None,
+            'temp_c': history_weather[i]['temp_c'] if history_weather[i] and i < len(history_weather) else None,
+            'icon' : history_weather[i]['icon'] if history_weather[i] and i < len(history_weather) else None,
+            'wave_height': variables[0][i],
+            'wave_direction': variables[1][i],
+            'wave_period': variables[2][i],
+            'wind_wave_height': variables[3][i],
+            'wind_wave_direction': variables[4][i],
+            'wind_wave_period': variables[5][i],
+            'wind_wave_peak_period': variables[6][i],
+            'swell_wave_height': variables[7][i],
+            'swell_wave_direction': variables[8][i],
+            'swell_wave_period': variables[9][i],
+            'swell_wave_peak_period': variables[10][i],
+        }
+        rows.append((date, marine_weather_data))
+    return rows
 
-        print("Location:", location_name, start_date_str)
+def group_by_grid_cell(cur, locations, resolve=True):
+    """
+    Groups the locations by their marine grid cell. Locations without a known cell are resolved with one marine
+    request each, which is kept and reused as the data of that cell.
+
+    @param resolve: False makes no requests, a location without a known cell gets a cell of its own keyed
+        (None, location id), which can not be ingested.
+
+    @return: Dictionary mapping grid keys to {'members': [(location_id, location_name)], 'marine': response or None}.
+    """
+    cells = {}
+    for location_id, location_name, latitude, longitude, grid_latitude, grid_longitude in locations:
+        if latitude is None or longitude is None:
+            print("Latitude or longitude is None. Unable to retrieve coordinates for", location_name)
+            continue
+        marine = None
         try:
-            if latitude is not None and longitude is not None:
-                if not is_specific_date_data_present(cur, location_id, start_date_str):
-                    full_weather = get_marine_weather(latitude, longitude).Hourly()
-                    history_weather = get_weather_history(latitude, longitude)
-                    timestamp = datetime.datetime.fromtimestamp(full_weather.Time())
-                    # Get the marine weather data for the past 7 days
-                    for i in range(0, len(full_weather.Variables(0).ValuesAsNumpy())): 
-                        date_format = "%Y-%m-%d %H:%M"
-                        date_object = datetime.datetime.strptime(history_weather[i]['time'], date_format)
-                        date =  date_object.date()
-                        marine_weather_data = {
-                            'time_of_day': history_weather[i]['time'],
-                            'wind_speed': history_weather[i]['wind_kph'] if history_weather[i] and i < len(history_weather) else None,
-                            'wind_direction': history_weather[i]['wind_dir'] if history_weather[i] and i < len(history_weather) else None,
-                            'temp_c': history_weather[i]['temp_c'] if history_weather[i] and i < len(history_weather) else None,
-                            'icon' : history_weather[i]['icon'] if history_weather[i] and i < len(history_weather) else None,
-                            'wave_height': full_weather.Variables(0).ValuesAsNumpy()[i],
-                            'wave_direction': full_weather.Variables(1).ValuesAsNumpy()[i],
-                            'wave_period': full_weather.Variables(2).ValuesAsNumpy()[i],
-                            'wind_wave_height': full_weather.Variables(3).ValuesAsNumpy()[i],
-                            'wind_wave_direction': full_weather.Variables(4).ValuesAsNumpy()[i],
-                            'wind_wave_period': full_weather.Variables(5).ValuesAsNumpy()[i],
-                            'wind_wave_peak_period': full_weather.Variables(6).ValuesAsNumpy()[i],
-                            'swell_wave_height': full_weather.Variables(7).ValuesAsNumpy()[i],
-                            'swell_wave_direction': full_weather.Variables(8).ValuesAsNumpy()[i],
-                            'swell_wave_period': full_weather.Variables(9).ValuesAsNumpy()[i],
-                            'swell_wave_peak_period': full_weather.Variables(10).ValuesAsNumpy()[i],
-                        }
-                        insert_marine_weather(cur, location_id, date, marine_weather_data)
-                else:
-                    print("Yesterday's data already present in the database.")
+            if (grid_latitude is None or grid_longitude is None) and not resolve:
+                key = (None, location_id)
+            elif grid_latitude is None or grid_longitude is None:
+                marine = get_marine_weather(latitude, longitude)
+                key = store_grid_cell(cur, location_id, marine)
             else:
-                print("Latitude or longitude is None. Unable to retrieve coordinates for the specified place.")
+                key = grid_key(grid_latitude, grid_longitude)
         except Exception as e:
             print(f"An error occurred for location {location_name}: {e}")
-except Exception as e:
-    print("An error occurred:", e)
-finally:
-    conn.commit()
-    cur.close()
-    conn.close()
\ No newline at end of file
+            continue
+        cell = cells.setdefault(key, {'members': [], 'marine': None})
+        cell['members'].append((location_id, location_name))
+        if cell['marine'] is None:
+            cell['marine'] = marine
+    return cells
+
+def plan_grid_cells(cur, resolve=True):
+    """
+    Resolves the grid cells of all locations, storing the cell of locations seen for the first time.
+
+    @param resolve: False only groups by the stored cells, without requesting the cell of new locations.
+
+    @return: Dictionary mapping grid keys to {'members': [(location_id, location_name)], 'marine': response or None}.
+    """
+    ensure_grid_columns(cur)
+    cells = group_by_grid_cell(cur, get_all_locations(cur), resolve)
+    print(f"{sum(len(cell['members']) for cell in cells.values())} locations in {len(cells)} grid cells")
+    return cells
+
+def ingest_cell(cur, key, location_ids, start_date_str, marine=None):
+    """
+    Fetches the marine and weather data of one grid cell for a day and stores it for every member location
+    which does not have it yet. The land weather (wind, temperature, icon) is also fetched once at the grid cell
+    coordinates, members get the weather of their cell rather than of their own beach.
+
+    @param key: The grid key of the cell.
+    @param location_ids: The member locations of the cell.
+    @param start_date_str: The day to fetch, YYYY-MM-DD.
+    @param marine: Optional marine response already fetched for the cell.
+
+    @return: The number of locations the data was stored for.
+    """
+    if key[0] is None:
+        # A location group_by_grid_cell did not resolve, it has no grid coordinates to fetch
+        print(f"Grid cell of location {key[1]} is not resolved, skipping it")
+        return 0
+    with metrics.timer('ingest_cell_seconds'):
+        missing = get_locations_missing_date(cur, list(location_ids), start_date_str)
+        if not missing:
+            print("Yesterday's data already present in the database.")
+            return 0
+        marine = marine or get_marine_weather(*key)
+        history_weather = get_weather_history(*key)
+        insert_marine_weather(cur, missing, build_marine_rows(marine.Hourly(), history_weather))
+        return len(missing)
+
+def main():
+    """
+    Fetches yesterday's marine and weather data once per marine grid cell and stores it for every location
+    in the cell.
+    """
+    owns_run = metrics.start_run()
+    # Establish a connection to the database
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    try:
+        start_date = datetime.datetime.now() - datetime.timedelta(days=1)
+        start_date_str = start_date.strftime("%Y-%m-%d")
+
+        cells = plan_grid_cells(cur)
+        conn.commit()
+
+        for key, cell in cells.items():
+            names = {location_id: location_name for location_id, location_name in cell['members']}
+            print("Grid cell:", key, ", ".join(names.values()), start_date_str)
+            try:
+                ingest_cell(cur, key, list(names), start_date_str, cell['marine'])
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"An error occurred for grid cell {key}: {e}")
+    except Exception as e:
+        print("An error occurred:", e)
+    finally:
+        conn.commit()
+        cur.close()
+        conn.close()
+        if owns_run:
+            metrics.write_run_report()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,10 @@
 <?php
 // Due the servers im running in crone job only supoort php i need to bypass it for setting up crone job
 // to run pyton script.
-// Install the Python requirements
-shell_exec('pip install -r requirements.txt');
+// Dependencies are installed once when the environment is built (see startup.sh), not on every run.
 
-// Execute the Python script
-$output = shell_exec('python weather_request.py');
+// Execute the ingest stage of the pipeline
+$output = shell_exec('python pipeline.py run --only ingest 2>&1');
 
 // Print the output of the Python script for validation if run succcesfully
 echo "Output: " . $output;